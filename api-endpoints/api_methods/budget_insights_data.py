@@ -1,10 +1,132 @@
 from firebase_admin import firestore
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from spending_analytics import SpendingTable, SOURCE_RECEIPT, SOURCE_MESSAGE
+from receipt_spend import SpendExtractor, BUDGET_CATEGORIES, stored_spend, to_amount
+from spending_store import receipts_between, expenses_between
+from spending_rollups import spending_between, category_breakdown, SPENDING_ROLLUPS_ENABLED
 import json
+import re
 
-def budget_insights_data(user_id: str = "testuser123", period: str = "monthly"):
+def extract_spend_with_gemini(doc_id: str, raw_data: str):
     """
-    Generate budget insights and spending analysis for the user.
+    Use Gemini API to extract the total amount and spending category of a receipt.
+    Returns: (total amount, category or None); raises if Gemini gave no usable answer
+    so that the failure is not cached.
+    """
+    if not raw_data:
+        return 0.0, None
+    import google.generativeai as genai
+    
+    # Prompt for extracting total amount and category
+    extraction_prompt = f"""
+    Analyze this receipt data and extract the total amount and categorize it:
+    
+    {raw_data}
+    
+    Return a JSON response with:
+    {{
+        "total_amount": <extracted_total_as_number>,
+        "category": "<category_name>"
+    }}
+    
+    Categories to choose from: {", ".join(BUDGET_CATEGORIES)}
+    
+    Rules:
+    1. Extract the total amount from fields like: total, total_amount, payment_amount, tender, grand_total, amount
+    2. If multiple amounts found, use the highest one that makes sense
+    3. Convert all amounts to numbers (remove currency symbols, commas)
+    4. Categorize based on items/merchant name
+    5. If unsure about category, use "miscellaneous"
+    6. Never return "unknown" as category
+    """
+    
+    model = genai.GenerativeModel("gemini-2.0-flash")
+    answer = model.generate_content(extraction_prompt).text.strip()
+    
+    # Extract JSON from AI response
+    json_match = re.search(r'\{.*\}', answer, re.DOTALL)
+    if not json_match:
+        raise ValueError(f"No JSON found in AI response for receipt {doc_id}")
+    extracted_data = json.loads(json_match.group())
+    category = extracted_data.get('category')
+    return to_amount(extracted_data.get('total_amount')) or 0.0, category if category and category != 'unknown' else None
+
+# Shared by all requests, so receipts are only sent to Gemini once per process
+spend_extractor = SpendExtractor(extract_spend_with_gemini)
+
+def resolved_spend(db, receipt_docs):
+    """
+    ({doc id: spend fields}, number still missing a field) for (doc id, receipt) pairs.
+    Totals and categories are stored at ingestion (or parsed from the receipt);
+    only receipts with neither go to Gemini, a bounded number per request.
+    """
+    spend = {doc_id: stored_spend(receipt) for doc_id, receipt in receipt_docs}
+    pending = [(doc_id, receipt.get('parsedData', {}).get('raw', ''))
+               for doc_id, receipt in receipt_docs if len(spend[doc_id]) < 2]
+    for doc_id, fields in spend_extractor.resolve(db, pending).items():
+        spend[doc_id] = {**fields, **spend[doc_id]}
+    return spend, sum(1 for doc_id, _ in pending if len(spend[doc_id]) < 2)
+
+def spending_from_documents(db, user_id: str, start_date: datetime):
+    """Period spending aggregated from the receipts and message expenses themselves"""
+    # Receipts for the period, a range query on the native createdAt
+    receipts_ref = receipts_between(db, user_id, start_date)
+    receipt_docs = [(doc.id, doc.to_dict()) for doc in receipts_ref.stream()]
+
+    spend, unresolved = resolved_spend(db, receipt_docs)
+
+    receipts = SpendingTable.from_rows(
+        (doc_id, receipt.get('createdAt'), spend[doc_id].get('totalAmount', 0.0),
+         spend[doc_id].get('spendCategory', 'miscellaneous'), None, SOURCE_RECEIPT)
+        for doc_id, receipt in receipt_docs
+    )
+    category_spending = receipts.group_by("category")
+    daily_spending = receipts.daily_totals()
+
+    # Expenses from messages dated within the period
+    expenses_ref = expenses_between(db, user_id, start_date.strftime('%Y-%m-%d'))
+
+    def expense_record(doc_id, expense):
+        return expense.get('date'), float(expense.get('amount', 0)), expense.get('category', 'unknown'), None, SOURCE_MESSAGE
+
+    messages = SpendingTable.from_documents(expenses_ref.stream(), expense_record)
+    message_expenses = {category: group['total'] for category, group in messages.group_by("category").items()}
+    return {
+        "category_breakdown": category_spending,
+        "message_expenses": message_expenses,
+        "daily_spending": daily_spending,
+        "total_spending": receipts.total() + messages.total(),
+        "receipt_count": len(receipts),
+        "receipts_pending_extraction": unresolved,
+        "source": "documents",
+    }
+
+def spending_from_rollups(db, user_id: str, start_date: datetime, end_date: datetime):
+    """
+    Period spending from the user's day/week/month rollups; None if they don't
+    cover it or it has receipts still missing a total or category (dirty months),
+    which the documents path sends to the extractor.
+    """
+    start_day = start_date.astimezone(timezone.utc).date()
+    end_day = end_date.astimezone(timezone.utc).date() + timedelta(days=1)
+    rollups = spending_between(db, user_id, start_day, end_day)
+    if rollups is None:
+        return None
+    receipts, messages = rollups[SOURCE_RECEIPT], rollups[SOURCE_MESSAGE]
+    return {
+        "category_breakdown": category_breakdown(receipts["categories"]),
+        "message_expenses": {category: group["total"] for category, group in messages["categories"].items() if group["count"]},
+        "daily_spending": {day: total for day, total in sorted(receipts["daily"].items())},
+        "total_spending": sum(group["total"] for source in (receipts, messages) for group in source["categories"].values()),
+        "receipt_count": sum(group["count"] for group in receipts["categories"].values()),
+        "receipts_pending_extraction": 0,
+        "source": "rollups",
+    }
+
+def budget_insights_data(user_id: str = "testuser123", period: str = "monthly", forecaster=None):
+    """
+    Generate budget insights and spending analysis for the user. With a
+    SpendingForecaster, next_month_prediction comes from the user's forecast.
     """
     try:
         # Get current date
@@ -17,187 +139,21 @@ def budget_insights_data(user_id: str = "testuser123", period: str = "monthly"):
             start_date = current_date - timedelta(days=30)
         else:
             start_date = current_date - timedelta(days=30)  # Default to monthly
+        # Rollups hold whole UTC days, so both sources read the period from the start of its first day
+        start_date = datetime.combine(start_date.astimezone(timezone.utc).date(), datetime.min.time(), tzinfo=timezone.utc)
         
-        # Get user's receipts for the period
         db = firestore.client()
-        if user_id:
-            receipts_ref = db.collection("receipts_parsed").where("userId", "==", user_id)
-        else:
-            receipts_ref = db.collection("receipts_parsed")
-            
-        receipts_docs = receipts_ref.stream()
-        
-        # Analyze spending by category
-        category_spending = {}
-        total_spending = 0
-        receipt_count = 0
-        daily_spending = {}
-        
-        for doc in receipts_docs:
-            receipt = doc.to_dict()
-            timestamp = receipt.get('timestamp', '')
-            parsed_data = receipt.get('parsedData', {})
-            
-            # Debug: Print receipt data
-            print(f"Processing receipt: {doc.id}")
-            print(f"Parsed data: {parsed_data}")
-            print(f"Timestamp: {timestamp}")
-            
-            # Check if receipt is within the period
-            try:
-                if not timestamp:
-                    print(f"Receipt {doc.id} has no timestamp, processing anyway (testing mode)")
-                    process_receipt = True
-                    receipt_date = current_date
-                else:
-                    try:
-                        receipt_date = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                        print(f"Receipt {doc.id} date: {receipt_date}, start_date: {start_date}")
-                        process_receipt = receipt_date >= start_date
-                    except Exception as e:
-                        print(f"Invalid timestamp for receipt {doc.id}: {timestamp}, error: {e}. Processing anyway (testing mode)")
-                        process_receipt = True
-                        receipt_date = current_date
-                if process_receipt:
-                    print(f"Receipt {doc.id} is within period or has no/invalid timestamp (processing)")
-                    category = parsed_data.get('category', 'unknown')
-                    
-                    # Use Gemini API to extract total amount and categorize receipt
-                    total_amount = 0.0
-                    raw_data = parsed_data.get('raw', '')
-                    
-                    print(f"Raw data length for receipt {doc.id}: {len(raw_data)}")
-                    print(f"Raw data for receipt {doc.id}: {raw_data[:200]}...")
-                    
-                    if raw_data:
-                        try:
-                            import google.generativeai as genai
-                            
-                            # Prompt for extracting total amount and category
-                            extraction_prompt = f"""
-                            Analyze this receipt data and extract the total amount and categorize it:
-                            
-                            {raw_data}
-                            
-                            Return a JSON response with:
-                            {{
-                                "total_amount": <extracted_total_as_number>,
-                                "category": "<category_name>"
-                            }}
-                            
-                            Categories to choose from: food, transportation, entertainment, shopping, healthcare, utilities, housing, miscellaneous
-                            
-                            Rules:
-                            1. Extract the total amount from fields like: total, total_amount, payment_amount, tender, grand_total, amount
-                            2. If multiple amounts found, use the highest one that makes sense
-                            3. Convert all amounts to numbers (remove currency symbols, commas)
-                            4. Categorize based on items/merchant name
-                            5. If unsure about category, use "miscellaneous"
-                            6. Never return "unknown" as category
-                            """
-                            
-                            model = genai.GenerativeModel("gemini-2.0-flash")
-                            result = model.generate_content(extraction_prompt)
-                            answer = result.text.strip()
-                            
-                            # Extract JSON from AI response
-                            import json
-                            import re
-                            json_match = re.search(r'\{.*\}', answer, re.DOTALL)
-                            
-                            if json_match:
-                                try:
-                                    extracted_data = json.loads(json_match.group())
-                                    total_amount = extracted_data.get('total_amount', 0.0)
-                                    extracted_category = extracted_data.get('category', 'miscellaneous')
-                                    
-                                    # Convert to float safely
-                                    try:
-                                        total_amount = float(total_amount) if total_amount else 0.0
-                                    except (ValueError, TypeError):
-                                        total_amount = 0.0
-                                    
-                                    # Use extracted category if valid
-                                    if extracted_category and extracted_category != 'unknown':
-                                        category = extracted_category
-                                    
-                                    print(f"AI extracted - total_amount: {total_amount}, category: {category} for receipt {doc.id}")
-                                    
-                                except json.JSONDecodeError as e:
-                                    print(f"Error parsing AI response for receipt {doc.id}: {e}")
-                                    total_amount = 0.0
-                            else:
-                                print(f"No JSON found in AI response for receipt {doc.id}")
-                                total_amount = 0.0
-                                
-                        except Exception as e:
-                            print(f"Error calling Gemini API for receipt {doc.id}: {e}")
-                            total_amount = 0.0
-                    
-                    print(f"Category: {category}, Amount: {total_amount}")
-                    
-                    # Convert unknown to miscellaneous
-                    if category == 'unknown':
-                        category = 'miscellaneous'
-                    
-                    if category not in category_spending:
-                        category_spending[category] = {
-                            'total': 0,
-                            'count': 0,
-                            'average': 0
-                        }
-                    
-                    category_spending[category]['total'] += total_amount
-                    category_spending[category]['count'] += 1
-                    total_spending += total_amount
-                    receipt_count += 1
-                    
-                    # Track daily spending
-                    date_key = receipt_date.strftime('%Y-%m-%d')
-                    if date_key not in daily_spending:
-                        daily_spending[date_key] = 0
-                    daily_spending[date_key] += total_amount
-            except (ValueError, TypeError) as e:
-                print(f"Error processing receipt {doc.id}: {e}")
-                continue
-        
-        # Calculate averages and percentages
-        for category in category_spending:
-            category_spending[category]['average'] = (
-                category_spending[category]['total'] / category_spending[category]['count']
-            )
-            category_spending[category]['percentage'] = (
-                (category_spending[category]['total'] / total_spending * 100) if total_spending > 0 else 0
-            )
-        
-        # Get expenses from messages
-        if user_id:
-            expenses_ref = db.collection("expenses_from_messages").where("userId", "==", user_id)
-        else:
-            expenses_ref = db.collection("expenses_from_messages")
-            
-        expenses_docs = expenses_ref.stream()
-        message_expenses = {}
-        
-        for doc in expenses_docs:
-            expense = doc.to_dict()
-            expense_date = expense.get('date', '')
-            
-            try:
-                expense_datetime = datetime.strptime(expense_date, '%Y-%m-%d')
-                if expense_datetime >= start_date:
-                    category = expense.get('category', 'unknown')
-                    amount = expense.get('amount', 0)
-                    
-                    if category not in message_expenses:
-                        message_expenses[category] = 0
-                    message_expenses[category] += float(amount)
-                    total_spending += float(amount)
-                    
-            except ValueError:
-                continue
-        
-
+        spending = None
+        if SPENDING_ROLLUPS_ENABLED and user_id:
+            spending = spending_from_rollups(db, user_id, start_date, current_date)
+        if spending is None:
+            spending = spending_from_documents(db, user_id, start_date)
+        category_spending = spending["category_breakdown"]
+        message_expenses = spending["message_expenses"]
+        daily_spending = spending["daily_spending"]
+        total_spending = spending["total_spending"]
+        receipt_count = spending["receipt_count"]
+        unresolved = spending["receipts_pending_extraction"]
         
         # Generate insights using AI
         import google.generativeai as genai
@@ -218,14 +174,8 @@ def budget_insights_data(user_id: str = "testuser123", period: str = "monthly"):
         # Check if we're using sample data
         is_sample_data = total_spending > 0 and len(spending_summary) > 0 and "sample" in str(spending_summary).lower()
         
-        # Debug output
-        print(f"Debug - total_spending: {total_spending}")
-        print(f"Debug - valid_categories: {valid_categories}")
-        print(f"Debug - spending_summary: {spending_summary}")
-        
         # If we have valid spending data, use our fallback logic directly
         if valid_categories and total_spending > 0:
-            print(f"Using fallback logic: valid_categories={valid_categories}, total_spending={total_spending}")
             # Find the actual top spending category
             top_category = max(valid_categories.items(), key=lambda x: x[1]['total'])[0]
             insights_data = {
@@ -245,7 +195,6 @@ def budget_insights_data(user_id: str = "testuser123", period: str = "monthly"):
                 "alert_level": "medium" if total_spending > 1000 else "low",
                 "next_month_prediction": f"Based on current spending, expect around ${total_spending:.2f} next month"
             }
-            print(f"Generated insights with top category: {top_category}")
         else:
             # Use AI for cases with no valid spending data
             prompt = (
@@ -376,6 +325,19 @@ def budget_insights_data(user_id: str = "testuser123", period: str = "monthly"):
             
             receipt_count = 8  # Update receipt count for sample data
         
+        # Next month from the local forecast models rather than Gemini or this period's total
+        forecast = None
+        if forecaster is not None and user_id:
+            try:
+                forecast = forecaster.forecast(user_id)
+            except Exception as e:
+                print(f"Spending forecast failed for user {user_id}: {e}")
+        if forecast and forecast["categories"]:
+            insights_data["next_month_prediction"] = (
+                f"Expect around ${forecast['total']:.2f} over the next {forecast['horizon_days']} days "
+                f"(80% range ${forecast['low']:.2f} to ${forecast['high']:.2f})"
+            )
+        
         # Calculate additional metrics
         avg_daily_spending = total_spending / len(daily_spending) if daily_spending else 0
         max_daily_spending = max(daily_spending.values()) if daily_spending else 0
@@ -388,6 +350,8 @@ def budget_insights_data(user_id: str = "testuser123", period: str = "monthly"):
             "summary": {
                 "total_spending": round(total_spending, 2),
                 "receipt_count": receipt_count,
+                "receipts_pending_extraction": unresolved,
+                "data_source": spending["source"],
                 "message_expenses_count": len(message_expenses),
                 "avg_daily_spending": round(avg_daily_spending, 2),
                 "max_daily_spending": round(max_daily_spending, 2),
@@ -397,6 +361,7 @@ def budget_insights_data(user_id: str = "testuser123", period: str = "monthly"):
             "message_expenses": message_expenses,
             "daily_spending": daily_spending,
             "insights": insights_data,
+            "forecast": forecast,
             "date_range": {
                 "start_date": start_date.strftime('%Y-%m-%d'),
                 "end_date": current_date.strftime('%Y-%m-%d')
@@ -1,19 +1,19 @@
 from firebase_admin import firestore
+from inventory_store import inventory_query, in_stock
 
 def get_inventories_data(order: str = 'desc', user_id: str = None):
     try:
         db = firestore.client()
         
-        # If user_id is provided, filter by userId
-        if user_id:
-            inventories_ref = db.collection("inventories").where("userId", "==", user_id)
-        else:
-            inventories_ref = db.collection("inventories")
-            
+        # The user's inventory subcollection, or every user's when no user_id is given
+        inventories_ref = inventory_query(db, user_id)
+
         docs = inventories_ref.stream()
         inventories = []
         for doc in docs:
             data = doc.to_dict()
+            if not in_stock(data):
+                continue
             data['document_id'] = doc.id
             inventories.append(data)
         
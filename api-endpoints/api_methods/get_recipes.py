@@ -1,41 +1,58 @@
 from firebase_admin import firestore
+from inventory_store import inventory_query, in_stock
 import google.generativeai as genai
 import json
+import re
 
-def get_recipes(user_id: str = None):
+def load_inventory_item_names(db, user_id: str = None):
+    """Item names in the user's inventory (every user's when no user_id is given)"""
+    docs = inventory_query(db, user_id).stream()
+    inventory_items = [data.get('item_name', '') for data in (doc.to_dict() for doc in docs) if in_stock(data)]
+    return [item for item in inventory_items if item]
+
+def generate_recipes_with_gemini(inventory_items):
+    """
+    Ask Gemini for up to 10 recipes from the inventory items.
+    Returns: (list of {"recipe", "ingredients"} or None if the answer had no JSON array, raw answer)
+    """
+    prompt = (
+        "Given the following list of available inventory items, suggest up to 10 recipes that can be prepared using these items. "
+        "For each recipe, return the recipe name and a short list of main ingredients (from the inventory). "
+        "Return the result as a JSON array of objects with 'recipe' and 'ingredients' fields. "
+        "If no recipes can be made, return an empty array.\n"
+        f"Inventory items: {json.dumps(inventory_items)}"
+    )
+    model = genai.GenerativeModel("gemini-2.0-flash")
+    result = model.generate_content(prompt)
+    answer = result.text.strip()
+    json_match = re.search(r'\[.*\]', answer, re.DOTALL)
+    if json_match:
+        return json.loads(json_match.group()), answer
+    return None, answer
+
+def get_recipes(user_id: str = None, cache=None):
+    """
+    Suggest recipes from the user's inventory. With a RecipeCache, Gemini is only
+    asked when no recipes are cached for this (or a near-identical) inventory set.
+    """
     try:
         db = firestore.client()
-        
-        # Filter inventories by user_id if provided
-        if user_id:
-            inventories_ref = db.collection("inventories").where("userId", "==", user_id)
-        else:
-            inventories_ref = db.collection("inventories")
-            
-        docs = inventories_ref.stream()
-        inventory_items = [doc.to_dict().get('item_name', '') for doc in docs]
-        inventory_items = [item for item in inventory_items if item]
-        
+        inventory_items = load_inventory_item_names(db, user_id)
+
         if not inventory_items:
             return {"recipes": [], "message": "No inventory items found."}
-        
+
+        if cache is not None:
+            cached = cache.lookup(user_id, inventory_items)
+            if cached is not None:
+                return {"user_id": user_id, **cached}
+
         # Use Gemini to suggest recipes
-        prompt = (
-            "Given the following list of available inventory items, suggest up to 10 recipes that can be prepared using these items. "
-            "For each recipe, return the recipe name and a short list of main ingredients (from the inventory). "
-            "Return the result as a JSON array of objects with 'recipe' and 'ingredients' fields. "
-            "If no recipes can be made, return an empty array.\n"
-            f"Inventory items: {json.dumps(inventory_items)}"
-        )
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        result = model.generate_content(prompt)
-        answer = result.text.strip()
-        import re
-        json_match = re.search(r'\[.*\]', answer, re.DOTALL)
-        if json_match:
-            recipes_json = json_match.group()
-            recipes = json.loads(recipes_json)
+        recipes, answer = generate_recipes_with_gemini(inventory_items)
+        if recipes is not None:
+            if cache is not None:
+                cache.store(user_id, inventory_items, recipes)
             return {"recipes": recipes, "user_id": user_id}
         return {"recipes": [], "raw": answer, "user_id": user_id}
     except Exception as e:
-        return {"error": str(e)} 
\ No newline at end of file
+        return {"error": str(e)}
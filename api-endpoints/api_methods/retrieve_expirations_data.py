@@ -1,58 +1,37 @@
 from firebase_admin import firestore
+from inventory_store import upcoming_expiries_query, count_upcoming_expiries, start_of_today
 from datetime import datetime
 
-def retrieve_expirations_data(user_id: str = "testuser123"):
+def retrieve_expirations_data(user_id: str = "testuser123", limit: int = 5, cache=None):
     """
     Retrieve top 5 products that are going to expire soon from user's inventory.
+    Served from the expiry cache when one is given, otherwise with an ordered query
+    on expiresAt that reads only the items returned.
     """
     try:
         # Get current date
         current_date = datetime.now()
-        
-        # Get user's inventory
+        today = start_of_today()
+
         db = firestore.client()
-        if user_id:
-            inventories_ref = db.collection("inventories").where("userId", "==", user_id)
+        if user_id and cache is not None:
+            upcoming, total_expiring = cache.upcoming(user_id, limit, today)
         else:
-            inventories_ref = db.collection("inventories")
-            
-        inventory_docs = inventories_ref.stream()
-        expiring_items = []
-        
-        for doc in inventory_docs:
-            data = doc.to_dict()
-            item_name = data.get('item_name', '')
-            expiry_date = data.get('expiryDate', '')
-            count = data.get('count', 0)
-            
-            if expiry_date:
-                try:
-                    # Parse expiry date
-                    expiry_datetime = datetime.strptime(expiry_date, '%Y-%m-%d')
-                    
-                    # Calculate days until expiry
-                    days_until_expiry = (expiry_datetime - current_date).days
-                    
-                    # Only include items that haven't expired yet
-                    if days_until_expiry >= 0:
-                        expiring_items.append({
-                            'item_name': item_name,
-                            'count': count,
-                            'expiry_date': expiry_date,
-                            'days_until_expiry': days_until_expiry,
-                            'document_id': doc.id,
-                            'last_bought_date': data.get('last_bought_date', ''),
-                            'original_names': data.get('original_names', [])
-                        })
-                except ValueError:
-                    # Skip items with invalid date format
-                    continue
-        
-        # Sort by days until expiry (ascending - most urgent first)
-        expiring_items.sort(key=lambda x: x['days_until_expiry'])
-        
-        # Get top 5 items
-        top_5_expiring = expiring_items[:5]
+            docs = upcoming_expiries_query(db, user_id, today, limit).stream()
+            upcoming = [(doc.id, doc.get('expiresAt'), doc.to_dict()) for doc in docs]
+            total_expiring = count_upcoming_expiries(db, user_id, today)
+
+        top_5_expiring = []
+        for document_id, expires_at, data in upcoming:
+            top_5_expiring.append({
+                'item_name': data.get('item_name', ''),
+                'count': data.get('count', 0),
+                'expiry_date': data.get('expiryDate') or expires_at.strftime('%Y-%m-%d'),
+                'days_until_expiry': (expires_at.date() - today.date()).days,
+                'document_id': document_id,
+                'last_bought_date': data.get('last_bought_date', ''),
+                'original_names': data.get('original_names', [])
+            })
         
         # Add urgency level to each item
         for item in top_5_expiring:
@@ -75,7 +54,7 @@ def retrieve_expirations_data(user_id: str = "testuser123"):
             "message": f"Retrieved {len(top_5_expiring)} items expiring soon",
             "expiring_items": top_5_expiring,
             "user_id": user_id,
-            "total_expiring_items": len(expiring_items),
+            "total_expiring_items": total_expiring,
             "current_date": current_date.strftime('%Y-%m-%d'),
             "summary": {
                 "critical": len([item for item in top_5_expiring if item['urgency'] == 'critical']),
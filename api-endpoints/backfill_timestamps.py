@@ -0,0 +1,78 @@
+"""
+Set the native Firestore timestamps that period analytics query on, for documents
+written before they existed:
+
+    receipts_parsed.createdAt         from the ISO `timestamp` string
+    expenses_from_messages.spentAt    from the YYYY-MM-DD `date` string
+
+Documents that already have the field, or whose string cannot be parsed, are left
+alone, so the script can be re-run safely. Documents without a timestamp are
+reported and stay out of range queries until they get one.
+
+Usage:
+    python backfill_timestamps.py [--dry-run] [--user-id UID]
+"""
+
+import os
+import argparse
+from typing import Callable, Dict
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from dotenv import load_dotenv
+
+from firestore_batch import BatchWriter
+from spending_store import RECEIPTS_COLLECTION, EXPENSES_COLLECTION, receipt_timestamp, expense_timestamp
+
+
+def backfill_field(db, writer: BatchWriter, collection: str, source: str, target: str,
+                   convert: Callable, dry_run: bool = False, user_id: str = None) -> Dict[str, int]:
+    """Set `target` from convert(`source`) on documents of a collection that lack it"""
+    query = db.collection(collection)
+    if user_id:
+        query = query.where("userId", "==", user_id)
+    counts = {"documents": 0, "backfilled": 0, "alreadySet": 0, "unparseable": 0}
+    for doc in query.select([source, target]).stream():
+        data = doc.to_dict()
+        counts["documents"] += 1
+        if data.get(target) is not None:
+            counts["alreadySet"] += 1
+            continue
+        value = convert(data.get(source))
+        if value is None:
+            counts["unparseable"] += 1
+            continue
+        counts["backfilled"] += 1
+        if not dry_run:
+            writer.update(doc.reference, {target: value})
+    writer.flush()
+    return counts
+
+
+def backfill(db, dry_run: bool = False, user_id: str = None) -> Dict:
+    writer = BatchWriter(db)
+    summary = {
+        "receipts": backfill_field(db, writer, RECEIPTS_COLLECTION, "timestamp", "createdAt",
+                                   receipt_timestamp, dry_run=dry_run, user_id=user_id),
+        "expenses": backfill_field(db, writer, EXPENSES_COLLECTION, "date", "spentAt",
+                                   expense_timestamp, dry_run=dry_run, user_id=user_id),
+        "dryRun": dry_run,
+        "firestoreStats": writer.stats(),
+    }
+    print(summary)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set createdAt on receipts and spentAt on message expenses")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be written without writing")
+    parser.add_argument("--user-id", default=None, help="Only backfill this user's documents")
+    args = parser.parse_args()
+
+    load_dotenv()
+    service_account = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
+    if not service_account:
+        raise ValueError("FIREBASE_SERVICE_ACCOUNT_JSON environment variable must be set to the path of your Firebase service account JSON file")
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(service_account))
+    backfill(firestore.client(), dry_run=args.dry_run, user_id=args.user_id)
@@ -0,0 +1,112 @@
+"""
+Benchmark receipt image preprocessing at several max-edge sizes.
+
+Reports bytes sent to Gemini and stored, preprocessing time and, when
+GEMINI_API_KEY is set, model latency and extraction accuracy. Accuracy is
+measured against the extraction from the original image: the total must match
+and we report the share of original line items that are still found.
+
+Usage:
+    python benchmarks/bench_image_preprocessing.py path/to/receipt1.jpg [receipt2.jpg ...]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_preprocessing import preprocess_receipt_image
+
+MAX_EDGES = [800, 1200, 1600, 2400]
+
+PROMPT = (
+    "If this image is a receipt, bill, invoice, or proof of purchase (including grocery bills, restaurant bills, online orders, utility bills, or pharmacy receipts), "
+    "extract all possible fields, tags, and categories in JSON. If not, reply with 'not a receipt'."
+)
+
+
+def extract(model, data, mime_type):
+    start = time.perf_counter()
+    result = model.generate_content([PROMPT, {"mime_type": mime_type, "data": data}])
+    latency = time.perf_counter() - start
+    text = re.sub(r"^```(?:json)?\s*|```$", "", result.text.strip(), flags=re.MULTILINE).strip()
+    try:
+        return json.loads(text), latency
+    except json.JSONDecodeError:
+        return {}, latency
+
+
+def summarize(parsed):
+    """Pull a comparable total and set of item names out of free-form Gemini JSON."""
+    total = None
+    names = set()
+
+    def walk(node):
+        nonlocal total
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if total is None and "total" in key.lower() and isinstance(value, (int, float, str)):
+                    numbers = re.findall(r"\d+\.?\d*", str(value))
+                    if numbers:
+                        total = float(numbers[0])
+                if key.lower() in ("name", "item_name", "description") and isinstance(value, str):
+                    names.add(value.lower().strip())
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(parsed)
+    return total, names
+
+
+def main(paths):
+    model = None
+    if os.getenv("GEMINI_API_KEY"):
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        model = genai.GenerativeModel("gemini-2.0-flash")
+    else:
+        print("GEMINI_API_KEY not set: reporting payload sizes only\n")
+
+    for path in paths:
+        with open(path, "rb") as f:
+            original = f.read()
+        print(f"=== {path} ({len(original) / 1024:.0f} KB) ===")
+
+        reference = None
+        if model:
+            mime_type = "image/png" if path.lower().endswith(".png") else "image/jpeg"
+            parsed, latency = extract(model, original, mime_type)
+            reference = summarize(parsed)
+            print(f"{'original':>9}: model {len(original) / 1024:7.0f} KB  latency {latency:5.2f}s  "
+                  f"total={reference[0]} items={len(reference[1])}")
+
+        for max_edge in MAX_EDGES:
+            start = time.perf_counter()
+            pre = preprocess_receipt_image(original, max_edge=max_edge)
+            prep_ms = (time.perf_counter() - start) * 1000
+            if pre is None:
+                print("  not a decodable image, skipping")
+                break
+            line = (f"{max_edge:>9}: model {len(pre['model_bytes']) / 1024:7.0f} KB  "
+                    f"storage {len(pre['storage_bytes']) / 1024:6.0f} KB  "
+                    f"thumb {len(pre['thumbnail_bytes']) / 1024:4.0f} KB  "
+                    f"size {pre['processed_size'][0]}x{pre['processed_size'][1]}  prep {prep_ms:5.0f} ms")
+            if model:
+                parsed, latency = extract(model, pre["model_bytes"], pre["mime_type"])
+                total, names = summarize(parsed)
+                item_recall = len(names & reference[1]) / len(reference[1]) if reference[1] else 1.0
+                line += f"  latency {latency:5.2f}s  total_match={total == reference[0]}  item_recall={item_recall:.0%}"
+            print(line)
+        print()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1:])
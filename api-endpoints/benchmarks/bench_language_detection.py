@@ -0,0 +1,111 @@
+"""
+Microbenchmark for language detection: the previous pattern-scanning detector
+(copied below as legacy_detect_language) against the single-pass script detector.
+Also reports accuracy of both on the labelled set in test-api-endpoints.
+
+Usage:
+    python benchmarks/bench_language_detection.py
+"""
+
+import os
+import sys
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, "test-api-endpoints"))
+
+from language_detection import detect_language
+from test_language_detection import ACCURACY_SET
+
+ITERATIONS = 2000
+
+
+def legacy_detect_language(text: str) -> str:
+    """
+    Detect the language of the input text using simple heuristics for Indian languages
+    
+    Args:
+        text: Text to detect language for
+    
+    Returns:
+        Language code (e.g., 'en', 'hi', 'ta', 'te', 'bn', 'mr') or 'en' as fallback
+    """
+    try:
+        # Simple language detection using common patterns for Indian languages
+        text_lower = text.lower()
+        
+        # Hindi patterns (Devanagari script)
+        hindi_patterns = ['नमस्ते', 'कैसे', 'हैं', 'धन्यवाद', 'कृपया', 'अलविदा', 'सुप्रभात', 'शुभ रात्रि', 'हाँ', 'नहीं']
+        if any(pattern in text_lower for pattern in hindi_patterns):
+            return 'hi'
+        
+        # Tamil patterns (Tamil script)
+        tamil_patterns = ['வணக்கம்', 'எப்படி', 'உள்ளீர்கள்', 'நன்றி', 'தயவுசெய்து', 'பிரியாவிடை', 'காலை வணக்கம்', 'இரவு வணக்கம்']
+        if any(pattern in text_lower for pattern in tamil_patterns):
+            return 'ta'
+        
+        # Telugu patterns (Telugu script)
+        telugu_patterns = ['నమస్కారం', 'ఎలా', 'ఉన్నారు', 'ధన్యవాదాలు', 'దయచేసి', 'వీడ్కోలు', 'శుభోదయం', 'శుభ రాత్రి']
+        if any(pattern in text_lower for pattern in telugu_patterns):
+            return 'te'
+        
+        # Bengali patterns (Bengali script)
+        bengali_patterns = ['নমস্কার', 'কেমন', 'আছেন', 'ধন্যবাদ', 'অনুগ্রহ করে', 'বিদায়', 'সুপ্রভাত', 'শুভ রাত্রি']
+        if any(pattern in text_lower for pattern in bengali_patterns):
+            return 'bn'
+        
+        # Marathi patterns (Devanagari script)
+        marathi_patterns = ['नमस्कार', 'कसे', 'आहात', 'धन्यवाद', 'कृपया', 'निरोप', 'सुप्रभात', 'शुभ रात्री', 'होय', 'नाही']
+        if any(pattern in text_lower for pattern in marathi_patterns):
+            return 'mr'
+        
+        # Check for Devanagari script (Hindi/Marathi)
+        devanagari_chars = sum(1 for char in text if '\u0900' <= char <= '\u097F')
+        if devanagari_chars > len(text) * 0.3:
+            # Try to distinguish between Hindi and Marathi
+            if any(word in text_lower for word in ['हैं', 'कैसे', 'नमस्ते']):
+                return 'hi'
+            elif any(word in text_lower for word in ['आहात', 'कसे', 'नमस्कार']):
+                return 'mr'
+            else:
+                return 'hi'  # Default to Hindi for Devanagari
+        
+        # Check for Tamil script
+        tamil_chars = sum(1 for char in text if '\u0B80' <= char <= '\u0BFF')
+        if tamil_chars > len(text) * 0.3:
+            return 'ta'
+        
+        # Check for Telugu script
+        telugu_chars = sum(1 for char in text if '\u0C00' <= char <= '\u0C7F')
+        if telugu_chars > len(text) * 0.3:
+            return 'te'
+        
+        # Check for Bengali script
+        bengali_chars = sum(1 for char in text if '\u0980' <= char <= '\u09FF')
+        if bengali_chars > len(text) * 0.3:
+            return 'bn'
+        
+        # Default to English
+        return 'en'
+            
+    except Exception as e:
+        print(f"Language detection error: {e}")
+        return 'en'
+
+
+def accuracy(detector):
+    return sum(detector(text) == expected for text, expected in ACCURACY_SET) / len(ACCURACY_SET)
+
+
+if __name__ == "__main__":
+    texts = [text for text, _ in ACCURACY_SET]
+    long_text = " ".join(texts) * 5
+
+    for name, detector in [("legacy", legacy_detect_language), ("single-pass", detect_language)]:
+        short_time = timeit.timeit(lambda: [detector(t) for t in texts], number=ITERATIONS)
+        long_time = timeit.timeit(lambda: detector(long_text), number=ITERATIONS)
+        per_message_us = short_time / (ITERATIONS * len(texts)) * 1e6
+        per_long_us = long_time / ITERATIONS * 1e6
+        print(f"{name:12s} accuracy={accuracy(detector):.0%}  "
+              f"{per_message_us:6.1f} us/message  {per_long_us:8.1f} us/{len(long_text)}-char text")
@@ -0,0 +1,162 @@
+"""
+Benchmark the spending aggregations behind /budget_insights, /analyze_spending,
+/receipt_stats and /generate_chart on synthetic Firestore-shaped documents.
+
+Compares the legacy path (per-document dict updates for the category breakdown,
+daily totals and a sorted list for percentiles) with SpendingTable (bincount
+over dictionary-encoded columns). Both read the same documents, so the table
+timings include building it; "prebuilt" is the aggregation alone, the cost of
+every further query on a table that is already built.
+
+Usage:
+    python benchmarks/bench_spending_analytics.py [--sizes 10000 100000] [--repeat 5]
+"""
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spending_analytics import SpendingTable, SOURCE_RECEIPT, SOURCE_MESSAGE
+
+
+CATEGORIES = ["food", "transportation", "entertainment", "shopping", "healthcare", "utilities", "housing", "miscellaneous"]
+VENDORS = [f"vendor {i}" for i in range(200)]
+
+
+class Document:
+    """The part of a Firestore DocumentSnapshot the endpoints use"""
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+def make_documents(n: int, days: int = 365, seed: int = 0):
+    """(receipt documents, message expense documents), about 80% receipts"""
+    rng = np.random.default_rng(seed)
+    start = datetime.now(timezone.utc) - timedelta(days=days)
+    seconds = rng.integers(0, days * 86400, n)
+    amounts = np.round(rng.lognormal(3.0, 1.0, n), 2)
+    categories = rng.integers(0, len(CATEGORIES), n)
+    vendors = rng.integers(0, len(VENDORS), n)
+    is_receipt = rng.random(n) < 0.8
+    receipts, messages = [], []
+    for i in range(n):
+        moment = start + timedelta(seconds=int(seconds[i]))
+        if is_receipt[i]:
+            receipts.append(Document(f"doc{i}", {
+                "createdAt": moment,
+                "totalAmount": float(amounts[i]),
+                "spendCategory": CATEGORIES[categories[i]],
+                "vendor": VENDORS[vendors[i]],
+            }))
+        else:
+            messages.append(Document(f"doc{i}", {
+                "date": moment.date().isoformat(),
+                "amount": float(amounts[i]),
+                "category": CATEGORIES[categories[i]],
+            }))
+    return receipts, messages
+
+
+def legacy_aggregate(documents):
+    receipt_docs, message_docs = documents
+    category_spending = {}
+    daily_spending = {}
+    message_expenses = {}
+    amounts = []
+    for doc in receipt_docs:
+        receipt = doc.to_dict()
+        amount = receipt.get("totalAmount", 0.0)
+        category = receipt.get("spendCategory", "miscellaneous")
+        if category not in category_spending:
+            category_spending[category] = {"total": 0, "count": 0, "average": 0}
+        category_spending[category]["total"] += amount
+        category_spending[category]["count"] += 1
+        day = receipt["createdAt"].date().isoformat()
+        daily_spending[day] = daily_spending.get(day, 0) + amount
+        amounts.append(amount)
+    for doc in message_docs:
+        expense = doc.to_dict()
+        amount = float(expense.get("amount", 0))
+        message_expenses[expense.get("category", "unknown")] = message_expenses.get(expense.get("category", "unknown"), 0) + amount
+        amounts.append(amount)
+    receipts_total = sum(data["total"] for data in category_spending.values())
+    for data in category_spending.values():
+        data["average"] = data["total"] / data["count"]
+        data["percentage"] = data["total"] / receipts_total * 100 if receipts_total > 0 else 0
+    amounts.sort()
+    percentiles = {q: amounts[int(q / 100 * (len(amounts) - 1))] for q in (50, 90)}
+    return category_spending, daily_spending, message_expenses, sum(amounts), percentiles
+
+
+def build_tables(documents):
+    receipt_docs, message_docs = documents
+    receipts = SpendingTable.from_documents(receipt_docs, lambda doc_id, receipt: (
+        receipt.get("createdAt"), receipt.get("totalAmount", 0.0), receipt.get("spendCategory", "miscellaneous"),
+        receipt.get("vendor"), SOURCE_RECEIPT
+    ))
+    messages = SpendingTable.from_documents(message_docs, lambda doc_id, expense: (
+        expense.get("date"), float(expense.get("amount", 0)), expense.get("category", "unknown"), None, SOURCE_MESSAGE
+    ))
+    return receipts, messages
+
+
+def aggregate(tables):
+    receipts, messages = tables
+    amounts = np.concatenate((receipts.amounts, messages.amounts))
+    return (receipts.group_by("category"), receipts.daily_totals(),
+            {category: group["total"] for category, group in messages.group_by("category").items()},
+            receipts.total() + messages.total(),
+            dict(zip((50, 90), np.percentile(amounts, (50, 90)))) if len(amounts) else {})
+
+
+def vectorized_aggregate(documents):
+    return aggregate(build_tables(documents))
+
+
+def best_of(fn, arg, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'records':>8} {'legacy':>10} {'table':>10} {'build':>10} {'prebuilt':>10}")
+    for n in args.sizes:
+        documents = make_documents(n)
+        legacy = legacy_aggregate(documents)
+        vectorized = vectorized_aggregate(documents)
+        # Same answers before timing anything
+        assert legacy[0].keys() == vectorized[0].keys()
+        assert all(abs(legacy[0][c]["total"] - vectorized[0][c]["total"]) < 1e-6 for c in legacy[0])
+        assert legacy[1].keys() == vectorized[1].keys()
+        assert abs(legacy[3] - vectorized[3]) < 1e-6
+
+        legacy_seconds = best_of(legacy_aggregate, documents, args.repeat)
+        table_seconds = best_of(vectorized_aggregate, documents, args.repeat)
+        build_seconds = best_of(build_tables, documents, args.repeat)
+        prebuilt_seconds = best_of(aggregate, build_tables(documents), args.repeat)
+        print(f"{n:>8} {legacy_seconds * 1000:>8.1f}ms {table_seconds * 1000:>8.1f}ms "
+              f"{build_seconds * 1000:>8.1f}ms {prebuilt_seconds * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
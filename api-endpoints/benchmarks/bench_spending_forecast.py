@@ -0,0 +1,102 @@
+"""
+Backtest the spending forecast models on synthetic daily spend.
+
+Each synthetic user has categories with different shapes: frequent small
+purchases with a weekend bump, a fixed weekly expense, a monthly bill, and
+sparse spending that drifts upwards. Models are fitted day by day (as
+SpendingForecaster does) and, at rolling origins every 7 days after the first
+SPENDING_FORECAST_HISTORY_DAYS, forecast the total of the next 30 days. Reported
+per model: mean absolute error, mean absolute percentage error of the 30-day
+total, coverage of the 80% interval, and fit time (a full history fit and one
+incremental day). spending_forecast.INTERVAL_CALIBRATION is set from the
+coverage of "auto" here; check it after changing the models or their errors.
+
+Usage:
+    python benchmarks/bench_spending_forecast.py [--users 50] [--days 365] [--horizon 30]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spending_forecast import SeriesForecaster, default_models, SPENDING_FORECAST_HISTORY_DAYS
+
+
+def make_series(rng, days: int):
+    t = np.arange(days)
+    weekend = (t % 7) >= 5
+    groceries = np.where(rng.random(days) < 0.45, rng.gamma(2.0, 18.0, days), 0.0) * np.where(weekend, 1.6, 1.0)
+    commute = np.where(t % 7 == 0, 45.0 + rng.normal(0, 3, days), 0.0)
+    utilities = np.where(t % 30 == 3, 120.0 + rng.normal(0, 10, days), 0.0)
+    drift = np.where(rng.random(days) < 0.1, rng.gamma(2.0, 15.0, days) * (1 + t / days), 0.0)
+    return {"groceries": groceries, "commute": commute, "utilities": utilities, "entertainment": drift}
+
+
+def backtest(users: int, days: int, horizon: int, history: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    names = list(default_models()) + ["auto"]
+    errors = {name: [] for name in names}
+    percent = {name: [] for name in names}
+    covered = {name: [] for name in names}
+    for _ in range(users):
+        for series in make_series(rng, days).values():
+            forecaster = SeriesForecaster(horizon=horizon)
+            forecaster.update_many(series[:history])
+            for origin in range(history, days - horizon, 7):
+                actual = series[origin:origin + horizon].sum()
+                for name in names:
+                    result = forecaster.forecast(horizon, None if name == "auto" else name)
+                    errors[name].append(abs(result["total"] - actual))
+                    if actual > 0:
+                        percent[name].append(abs(result["total"] - actual) / actual)
+                    covered[name].append(result["low"] <= actual <= result["high"])
+                forecaster.update_many(series[origin:origin + 7])
+    return {
+        name: {
+            "mae": float(np.mean(errors[name])),
+            "mape": float(np.mean(percent[name]) * 100),
+            "coverage": float(np.mean(covered[name]) * 100),
+        }
+        for name in names
+    }
+
+
+def fit_times(days: int, history: int, repeat: int = 20):
+    series = make_series(np.random.default_rng(1), days)["groceries"]
+    started = time.perf_counter()
+    for _ in range(repeat):
+        SeriesForecaster().update_many(series[:history])
+    full = (time.perf_counter() - started) / repeat
+    forecaster = SeriesForecaster()
+    forecaster.update_many(series[:history])
+    started = time.perf_counter()
+    for value in series[history:]:
+        forecaster.update(float(value))
+    incremental = (time.perf_counter() - started) / max(days - history, 1)
+    return full, incremental
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--horizon", type=int, default=30)
+    parser.add_argument("--history", type=int, default=SPENDING_FORECAST_HISTORY_DAYS)
+    args = parser.parse_args()
+
+    results = backtest(args.users, args.days, args.horizon, args.history)
+    print(f"{'model':<16} {'MAE':>9} {'MAPE':>8} {'80% coverage':>13}")
+    for name, result in results.items():
+        print(f"{name:<16} {result['mae']:>9.2f} {result['mape']:>7.1f}% {result['coverage']:>12.1f}%")
+    full, incremental = fit_times(args.days, args.history)
+    print(f"\nfit on {args.history} days: {full * 1000:.2f}ms per category; "
+          f"incremental update: {incremental * 1e6:.1f}us per category per day")
+
+
+if __name__ == "__main__":
+    main()
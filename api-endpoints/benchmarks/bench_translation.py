@@ -0,0 +1,73 @@
+"""
+Benchmark for the translation layer using the local stub provider.
+Compares the old one-request-per-message behaviour with the cached, batched service.
+
+Usage:
+    python benchmarks/bench_translation.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from translation_service import TranslationService, TranslationCache, CircuitBreaker, StubTranslationProvider
+
+PROVIDER_LATENCY = 0.05  # Simulated round trip per provider request (seconds)
+
+MESSAGES = [
+    "Show my recent expenses.",
+    "How much did I spend on groceries this month? Which vendor was the most expensive?",
+    "Analyze spending trends. Find budget insights. Generate shopping list.",
+    "Check expiring items.",
+] * 25
+
+
+def bench_uncached():
+    provider = StubTranslationProvider(latency=PROVIDER_LATENCY)
+    start = time.perf_counter()
+    for message in MESSAGES:
+        provider.translate(message, "en", "hi")
+    return time.perf_counter() - start, provider.calls
+
+
+def bench_service():
+    provider = StubTranslationProvider(latency=PROVIDER_LATENCY)
+    with tempfile.TemporaryDirectory() as tmp:
+        service = TranslationService(
+            provider=provider,
+            cache=TranslationCache(db_path=os.path.join(tmp, "cache.sqlite3"))
+        )
+        start = time.perf_counter()
+        for message in MESSAGES:
+            service.translate(message, "hi", "en")
+        return time.perf_counter() - start, provider.calls, service.stats
+
+
+def bench_breaker():
+    provider = StubTranslationProvider(latency=PROVIDER_LATENCY, fail=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        service = TranslationService(
+            provider=provider,
+            cache=TranslationCache(db_path=os.path.join(tmp, "cache.sqlite3")),
+            breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        )
+        start = time.perf_counter()
+        for message in MESSAGES:
+            assert service.translate(message, "hi", "en") == message
+        return time.perf_counter() - start, provider.calls
+
+
+if __name__ == "__main__":
+    print(f"{len(MESSAGES)} messages, {PROVIDER_LATENCY * 1000:.0f} ms simulated provider latency\n")
+
+    elapsed, calls = bench_uncached()
+    print(f"Uncached, one request per message: {elapsed:.2f}s, {calls} provider calls")
+
+    elapsed, calls, stats = bench_service()
+    print(f"Cached + batched service:          {elapsed:.2f}s, {calls} provider calls, {stats['cache_hits']} sentence cache hits")
+
+    elapsed, calls = bench_breaker()
+    print(f"Failing provider with breaker:     {elapsed:.2f}s, {calls} provider calls before falling back")
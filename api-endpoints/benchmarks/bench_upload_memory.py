@@ -0,0 +1,145 @@
+"""
+Benchmark peak memory of the /upload file handling for N concurrent uploads.
+
+Compares the legacy path (read the whole upload into bytes, copy it into a
+BytesIO for Storage) with the spooled path (decode the spooled upload in
+place, stream it to Storage in STORAGE_CHUNK_SIZE chunks). Storage and Gemini
+are replaced by stand-ins that consume the data the same way the real clients
+do, so only our own buffering is measured. Each mode runs in a fresh process
+and reports the growth of peak RSS over the baseline.
+
+Usage:
+    python benchmarks/bench_upload_memory.py [path/to/receipt.jpg|.pdf ...] [--concurrency 8]
+
+Without paths a synthetic 12 MP JPEG and a 20 MB PDF-like blob are used.
+"""
+
+import io
+import os
+import sys
+import json
+import hashlib
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_preprocessing import preprocess_receipt_image
+from upload_spooling import spool_file, file_size, STORAGE_CHUNK_SIZE
+
+
+# Simulated network time per request, so concurrent uploads overlap like they do in the server
+NETWORK_SECONDS = 0.3
+
+
+def fake_storage_upload_string(data: bytes):
+    # A single-request (multipart) upload builds the whole request body in memory
+    body = b"--boundary\r\ncontent-type: application/json\r\n\r\n{}\r\n--boundary\r\n" + data + b"\r\n--boundary--"
+    time.sleep(NETWORK_SECONDS)
+    return hashlib.sha256(body).hexdigest()
+
+
+def fake_storage_upload_file(f, size: int):
+    # A resumable upload only holds one chunk at a time
+    digest = hashlib.sha256()
+    f.seek(0)
+    remaining = size
+    while remaining > 0:
+        chunk = f.read(min(STORAGE_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+        time.sleep(NETWORK_SECONDS * len(chunk) / size)
+    return digest.hexdigest()
+
+
+def legacy_upload(upload):
+    upload.seek(0)
+    image_bytes = upload.read()
+    preprocessed = preprocess_receipt_image(image_bytes)
+    model_bytes = preprocessed["model_bytes"] if preprocessed else image_bytes
+    # The original upload was re-wrapped in a BytesIO and sent as one request
+    fake_storage_upload_string(io.BytesIO(image_bytes).read())
+    return len(model_bytes)
+
+
+def spooled_upload(upload):
+    upload.seek(0)
+    preprocessed = preprocess_receipt_image(upload)
+    if preprocessed:
+        model_bytes = preprocessed["model_bytes"]
+        fake_storage_upload_string(preprocessed["storage_bytes"])
+    else:
+        upload.seek(0)
+        model_bytes = upload.read()
+        fake_storage_upload_file(upload, file_size(upload))
+    return len(model_bytes)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_mode(mode: str, path: str, concurrency: int):
+    handler = legacy_upload if mode == "legacy" else spooled_upload
+
+    def one_upload(_):
+        # Starlette hands the endpoint a SpooledTemporaryFile (rolled to disk over 1 MB)
+        with open(path, "rb") as source, spool_file(source) as upload:
+            return handler(upload)
+
+    baseline = peak_rss_mb()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_upload, range(concurrency)))
+    growth = peak_rss_mb() - baseline
+    print(json.dumps({"growth_mb": growth, "per_upload_mb": growth / concurrency}))
+
+
+def make_samples(directory: str):
+    import numpy as np
+    from PIL import Image
+
+    jpeg_path = os.path.join(directory, "receipt_12mp.jpg")
+    noise = np.random.default_rng(0).integers(0, 255, (4000, 3000, 3), dtype=np.uint8)
+    Image.fromarray(noise).save(jpeg_path, quality=90)
+    pdf_path = os.path.join(directory, "receipt_20mb.pdf")
+    with open(pdf_path, "wb") as f:
+        f.write(b"%PDF-1.7\n" + os.urandom(20 * 1024 * 1024))
+    return [jpeg_path, pdf_path]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mode", choices=["legacy", "spooled"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.paths[0], args.concurrency)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = args.paths or make_samples(directory)
+        print(f"{'file':<24} {'size':>9} {'mode':<8} {'peak RSS growth':>16} {'per upload':>11}")
+        for path in paths:
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+            for mode in ("legacy", "spooled"):
+                output = subprocess.run(
+                    [sys.executable, __file__, path, "--mode", mode, "--concurrency", str(args.concurrency)],
+                    capture_output=True, text=True, check=True
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{os.path.basename(path):<24} {size_mb:>7.1f}MB {mode:<8} "
+                      f"{result['growth_mb']:>14.1f}MB {result['per_upload_mb']:>9.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
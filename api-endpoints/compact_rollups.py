@@ -0,0 +1,84 @@
+"""
+Recompute spending rollups (spending_rollups/{uid}_{day|week|month}_{bucket})
+from receipts_parsed and expenses_from_messages.
+
+Ingestion keeps rollups current with increments; this job corrects them for
+receipts whose total was only extracted later, documents edited or backfilled
+after the fact, and months marked dirty. Each run recomputes the last
+ROLLUP_COMPACT_MONTHS months (or --months) plus any older dirty months, and marks
+the rollups complete from the first of those months so /budget_insights can
+read them. Run it on a schedule (e.g. nightly); --months 12 after the timestamp
+backfill extends rollups over the past year.
+
+Receipts stored without a total or budget category are sent to Gemini (at most
+--extract-limit per user and run, when GEMINI_API_KEY is set) and the answer is
+written back to the receipt. Months that still hold such receipts stay dirty,
+and /budget_insights reads those periods from the documents until they are resolved.
+
+Usage:
+    python compact_rollups.py [--user-id UID] [--months N] [--discover] [--extract-limit N]
+"""
+
+import os
+import argparse
+from typing import Dict, Set
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from dotenv import load_dotenv
+
+from firestore_batch import BatchWriter
+from receipt_spend import SpendExtractor
+from spending_store import RECEIPTS_COLLECTION, EXPENSES_COLLECTION
+from spending_rollups import ROLLUP_STATE_COLLECTION, compact_user
+
+
+def rollup_users(db, discover: bool = False) -> Set[str]:
+    """Users with rollup state; with discover, also every user with receipts or message expenses"""
+    users = {doc.id for doc in db.collection(ROLLUP_STATE_COLLECTION).select([]).stream()}
+    if discover:
+        for collection in (RECEIPTS_COLLECTION, EXPENSES_COLLECTION):
+            for doc in db.collection(collection).select(["userId"]).stream():
+                user_id = doc.to_dict().get("userId")
+                if user_id:
+                    users.add(user_id)
+    return users
+
+
+def compact_all(db, user_id: str = None, months: int = None, discover: bool = False,
+                extractor: SpendExtractor = None) -> Dict:
+    users = [user_id] if user_id else sorted(rollup_users(db, discover))
+    writer = BatchWriter(db)
+    per_user = {}
+    for uid in users:
+        per_user[uid] = compact_user(db, uid, months, writer, extractor)
+        writer.flush()
+    summary = {"users": len(users), "compacted": per_user, "firestoreStats": writer.stats()}
+    print(summary)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute day/week/month spending rollups from raw documents")
+    parser.add_argument("--user-id", default=None, help="Only compact this user's rollups")
+    parser.add_argument("--months", type=int, default=None, help="Recent months to recompute (default: ROLLUP_COMPACT_MONTHS)")
+    parser.add_argument("--discover", action="store_true", help="Also compact users who have no rollups yet")
+    parser.add_argument("--extract-limit", type=int, default=50,
+                        help="Receipts without a stored total sent to Gemini per user and run; 0 turns it off")
+    args = parser.parse_args()
+
+    load_dotenv()
+    service_account = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
+    if not service_account:
+        raise ValueError("FIREBASE_SERVICE_ACCOUNT_JSON environment variable must be set to the path of your Firebase service account JSON file")
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(service_account))
+    extractor = None
+    if args.extract_limit > 0 and os.getenv("GEMINI_API_KEY"):
+        import google.generativeai as genai
+        from api_methods.budget_insights_data import extract_spend_with_gemini
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        # A batch job: wait for every extraction it submits
+        extractor = SpendExtractor(extract_spend_with_gemini, limit=args.extract_limit, timeout=600)
+    compact_all(firestore.client(), user_id=args.user_id, months=args.months, discover=args.discover,
+                extractor=extractor)
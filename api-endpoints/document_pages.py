@@ -0,0 +1,252 @@
+import os
+import re
+import math
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from image_preprocessing import encode_image, prepare_for_text, RECEIPT_MAX_EDGE, RECEIPT_THUMBNAIL_EDGE
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # PDFs are then sent to Gemini whole
+    pdfium = None
+
+# Resolution PDF pages are rendered at
+DOCUMENT_PDF_DPI = int(os.getenv("DOCUMENT_PDF_DPI", "150"))
+# Pages beyond this are ignored
+DOCUMENT_MAX_PAGES = int(os.getenv("DOCUMENT_MAX_PAGES", "10"))
+# Images taller than this many widths are tiled instead of downscaled as a whole
+TALL_IMAGE_RATIO = float(os.getenv("TALL_IMAGE_RATIO", "2.5"))
+# Tiles per image at most (each is one Gemini call); taller images get taller tiles, downscaled when encoded
+DOCUMENT_MAX_TILES = int(os.getenv("DOCUMENT_MAX_TILES", "8"))
+# Tile height in widths, and the share of each tile repeated at the top of the next one
+TILE_ASPECT = 1.5
+TILE_OVERLAP = 0.2
+# Slack (share of tile height) on the model's line positions when telling overlap repeats from real ones
+POSITION_TOLERANCE = 0.05
+
+SEGMENT_PDF_PAGES = "pdf_pages"
+SEGMENT_IMAGE_TILES = "image_tiles"
+
+TOTAL_FIELDS = ("subtotal", "tax", "discount", "total")
+ORIENTATION_TAG = 0x0112
+
+
+def is_pdf(f: BinaryIO) -> bool:
+    f.seek(0)
+    header = f.read(5)
+    f.seek(0)
+    return header == b"%PDF-"
+
+
+def render_pdf_pages(f: BinaryIO, dpi: int = None, max_pages: int = None) -> List[Image.Image]:
+    """Render the pages of a PDF to PIL images (requires pypdfium2)."""
+    f.seek(0)
+    pdf = pdfium.PdfDocument(f)
+    try:
+        scale = (dpi or DOCUMENT_PDF_DPI) / 72
+        count = min(len(pdf), max_pages or DOCUMENT_MAX_PAGES)
+        return [pdf[i].render(scale=scale).to_pil() for i in range(count)]
+    finally:
+        pdf.close()
+        f.seek(0)
+
+
+def tile_tall_image(image: Image.Image, tile_aspect: float = None, overlap: float = None,
+                    max_tiles: int = None) -> List[Image.Image]:
+    """
+    Cut a tall image into full-width tiles, each overlapping the previous one.
+    Past max_tiles the tiles are made taller instead, so there are never more.
+    Each tile after the first records the pixel rows it shares with the previous
+    one in info["overlap"].
+    """
+    width, height = image.size
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    max_tiles = max_tiles or DOCUMENT_MAX_TILES
+    tile_height = int(width * (tile_aspect or TILE_ASPECT))
+    if tile_height + (max_tiles - 1) * tile_height * (1 - overlap) < height:
+        # Exactly max_tiles tiles: height = tile + (max_tiles - 1) steps
+        tile_height = math.ceil(height / (1 + (max_tiles - 1) * (1 - overlap)))
+    step = max(1, math.ceil(tile_height * (1 - overlap)))
+    tiles = []
+    top = 0
+    while True:
+        bottom = min(top + tile_height, height)
+        tile = image.crop((0, top, width, bottom))
+        if tiles:
+            tile.info["overlap"] = tiles[-1].size[1] - step
+        tiles.append(tile)
+        if bottom >= height:
+            return tiles
+        top += step
+
+
+def segment_overlaps(images: List[Image.Image]) -> List[Optional[Tuple[float, float]]]:
+    """
+    Per segment, the share of the previous segment's height and of its own that
+    they have in common (None for the first segment and for PDF pages).
+    """
+    overlaps = [None]
+    for previous, image in zip(images, images[1:]):
+        shared = image.info.get("overlap")
+        overlaps.append((shared / previous.size[1], shared / image.size[1]) if shared else None)
+    return overlaps
+
+
+def split_document(f: BinaryIO) -> Optional[Tuple[str, List[Image.Image]]]:
+    """
+    Split a multi-page PDF into pages or a tall image into overlapping tiles.
+
+    Returns (segment type, images), or None for regular single images (and for
+    PDFs when pypdfium2 is not installed), which go through the normal path.
+    """
+    if is_pdf(f):
+        if pdfium is None:
+            return None
+        try:
+            return SEGMENT_PDF_PAGES, render_pdf_pages(f)
+        except pdfium.PdfiumError:
+            return None
+    try:
+        f.seek(0)
+        image = Image.open(f)
+        # Check the shape from the header before decoding; EXIF orientations 5-8 swap the axes
+        width, height = image.size
+        if image.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8):
+            width, height = height, width
+        if height < width * TALL_IMAGE_RATIO:
+            return None
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, OSError):
+        return None
+    finally:
+        f.seek(0)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return SEGMENT_IMAGE_TILES, tile_tall_image(image)
+
+
+def encode_segments(images: List[Image.Image], max_edge: int = None) -> List[bytes]:
+    """Downscale and encode each page or tile for the model, like preprocess_receipt_image does."""
+    max_edge = max_edge or RECEIPT_MAX_EDGE
+    encoded = []
+    for image in images:
+        if max(image.size) > max_edge:
+            image = image.copy()
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        encoded.append(encode_image(prepare_for_text(image)))
+    return encoded
+
+
+def segment_thumbnail(image: Image.Image, thumbnail_edge: int = None) -> bytes:
+    """List-view thumbnail of the first page or tile."""
+    thumbnail = image.copy()
+    edge = thumbnail_edge or RECEIPT_THUMBNAIL_EDGE
+    thumbnail.thumbnail((edge, edge), Image.LANCZOS)
+    return encode_image(thumbnail)
+
+
+def _item_key(item: Dict[str, Any]) -> Tuple[str, str]:
+    name = re.sub(r"[^a-z0-9]+", " ", str(item.get("name", "")).lower()).strip()
+    price = item.get("total_price", item.get("price"))
+    return name, str(price)
+
+
+def _in_band(item: Dict[str, Any], low: float, high: float) -> bool:
+    """Whether the line's position (y, 0 = top of the segment, 1 = bottom) is within [low, high]; True if unknown"""
+    y = _to_number(item.get("y"))
+    return y is None or low - POSITION_TOLERANCE <= y <= high + POSITION_TOLERANCE
+
+
+def _overlap_length(previous: List[Dict[str, Any]], current: List[Dict[str, Any]],
+                    overlap: Optional[Tuple[float, float]] = None) -> int:
+    """
+    Length of the longest run of items ending `previous` that also starts `current`.
+    With overlap (shares of both segments' heights they have in common), items
+    whose positions put them outside the shared band are not repeats, so the run
+    stops there: a line bought twice and printed either side of the seam is kept.
+    """
+    previous_keys = [_item_key(item) for item in previous]
+    current_keys = [_item_key(item) for item in current]
+    for k in range(min(len(previous_keys), len(current_keys)), 0, -1):
+        if previous_keys[-k:] != current_keys[:k]:
+            continue
+        if overlap and not (all(_in_band(item, 1 - overlap[0], 1) for item in previous[-k:])
+                            and all(_in_band(item, 0, overlap[1]) for item in current[:k])):
+            continue
+        return k
+    return 0
+
+
+def _to_number(value) -> Optional[float]:
+    if isinstance(value, (int, float)):
+        return float(value)
+    numbers = re.findall(r"-?\d+(?:\.\d+)?", str(value or "").replace(",", ""))
+    return float(numbers[0]) if numbers else None
+
+
+def _items_total(items: List[Dict[str, Any]]) -> float:
+    prices = [_to_number(item.get("total_price", item.get("price"))) for item in items]
+    return round(sum(p for p in prices if p is not None), 2)
+
+
+def merge_extractions(extractions: List[Optional[Dict[str, Any]]], segment_type: str,
+                      overlaps: List[Optional[Tuple[float, float]]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Merge per-page or per-tile extractions into one receipt.
+
+    Line items are concatenated in order. For overlapping tiles, items at the start
+    of a tile that repeat the end of the previous tile, inside the band the tiles
+    share (overlaps, from segment_overlaps), are dropped, unless the printed
+    subtotal or total only adds up with them kept. Totals come from the last
+    segment that has them (they are printed at the end); other header fields
+    from the first. Returns None when no segment looked like a receipt.
+    """
+    found = [e for e in extractions if e]
+    if not found:
+        return None
+
+    merged: Dict[str, Any] = {}
+    items: List[Dict[str, Any]] = []
+    all_items: List[Dict[str, Any]] = []
+    previous_items: List[Dict[str, Any]] = []
+    duplicates_dropped = 0
+    for index, extraction in enumerate(extractions):
+        if not extraction:
+            previous_items = []
+            continue
+        segment_items = [item for item in extraction.get("items") or [] if isinstance(item, dict)]
+        skip = 0
+        if segment_type == SEGMENT_IMAGE_TILES:
+            skip = _overlap_length(previous_items, segment_items, overlaps[index] if overlaps else None)
+        duplicates_dropped += skip
+        items.extend(segment_items[skip:])
+        all_items.extend(segment_items)
+        previous_items = segment_items
+        for key, value in extraction.items():
+            if key == "items" or value in (None, "", [], {}):
+                continue
+            if key in TOTAL_FIELDS:
+                merged[key] = value
+            else:
+                merged.setdefault(key, value)
+
+    if duplicates_dropped:
+        printed = [_to_number(merged.get(key)) for key in ("subtotal", "total")]
+        printed = [value for value in printed if value is not None]
+        matches = lambda total: any(abs(total - value) < 0.01 for value in printed)
+        if matches(_items_total(all_items)) and not matches(_items_total(items)):
+            items, duplicates_dropped = all_items, 0
+    for item in items:
+        item.pop("y", None)
+
+    merged["items"] = items
+    merged["itemsTotal"] = _items_total(items)
+    merged["segments"] = {
+        "type": segment_type,
+        "count": len(extractions),
+        "receiptSegments": len(found),
+        "overlapItemsDropped": duplicates_dropped,
+    }
+    return merged
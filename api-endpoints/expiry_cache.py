@@ -0,0 +1,139 @@
+import os
+import time
+import heapq
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from inventory_store import upcoming_expiries_query, count_upcoming_expiries
+
+# Soonest-expiring items per user loaded into the cache
+EXPIRY_CACHE_DEPTH = int(os.getenv("EXPIRY_CACHE_DEPTH", "50"))
+# Seconds before a user's cached expiries are reloaded, to pick up writes made by other instances
+EXPIRY_CACHE_TTL = int(os.getenv("EXPIRY_CACHE_TTL", "300"))
+
+# (item id, expiresAt, document data)
+ExpiringItem = Tuple[str, datetime, Dict[str, Any]]
+
+
+class _UserExpiries:
+    """
+    Min-heap of (expiresAt, item id) plus the current expiry of each item. Heap
+    entries that no longer match `items` (the item was consumed or re-bought with
+    another date) are dropped lazily when they reach the top.
+
+    When the load hit the depth limit, only items expiring up to `horizon` are known,
+    so later items are not tracked and answers needing them force a reload.
+    """
+
+    def __init__(self, loaded: List[ExpiringItem], depth: int):
+        self.items: Dict[str, Tuple[datetime, Dict[str, Any]]] = {
+            item_id: (expires_at, data) for item_id, expires_at, data in loaded
+        }
+        self.heap = [(expires_at, item_id) for item_id, (expires_at, _) in self.items.items()]
+        heapq.heapify(self.heap)
+        self.complete = len(loaded) < depth
+        self.horizon = None if self.complete else loaded[-1][1]
+        # Count of upcoming items beyond the horizon is unknown; fetched on demand
+        self.total: Optional[int] = None
+        self.loaded_at = time.monotonic()
+
+    def covers(self, expires_at: datetime) -> bool:
+        return self.complete or expires_at <= self.horizon
+
+    def upsert(self, item_id: str, expires_at: Optional[datetime], data: Dict[str, Any]):
+        if expires_at is None or not self.covers(expires_at):
+            self.items.pop(item_id, None)
+            return
+        current = self.items.get(item_id)
+        self.items[item_id] = (expires_at, data)
+        if current is None or current[0] != expires_at:
+            heapq.heappush(self.heap, (expires_at, item_id))
+
+    def peek(self, n: int, start: datetime) -> Optional[List[ExpiringItem]]:
+        """The n soonest items expiring on or after start, or None when the cache can't tell"""
+        found = []
+        seen = set()
+        while self.heap and len(found) < n:
+            expires_at, item_id = heapq.heappop(self.heap)
+            current = self.items.get(item_id)
+            # Stale entry, or a duplicate left by removing and re-adding the same date
+            if current is None or current[0] != expires_at or item_id in seen:
+                continue
+            if expires_at < start:
+                del self.items[item_id]
+                continue
+            seen.add(item_id)
+            found.append((item_id, expires_at, current[1]))
+        for item_id, expires_at, _ in found:
+            heapq.heappush(self.heap, (expires_at, item_id))
+        if len(found) < n and not self.complete:
+            return None
+        return found
+
+
+class ExpiryCache:
+    """
+    In-process cache of each user's soonest-expiring inventory items, loaded with one
+    ordered, limited query on users/{uid}/inventory and kept current by the inventory
+    writers through upsert(), remove() and invalidate().
+    """
+
+    def __init__(self, db, depth: int = None, ttl: int = None):
+        self.db = db
+        self.depth = depth or EXPIRY_CACHE_DEPTH
+        self.ttl = EXPIRY_CACHE_TTL if ttl is None else ttl
+        self._users: Dict[str, _UserExpiries] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, user_id: str, start: datetime, depth: int) -> _UserExpiries:
+        docs = upcoming_expiries_query(self.db, user_id, start, depth).stream()
+        loaded = [(doc.id, doc.get("expiresAt"), doc.to_dict()) for doc in docs]
+        state = _UserExpiries(loaded, depth)
+        with self._lock:
+            self._users[user_id] = state
+        return state
+
+    def upcoming(self, user_id: str, n: int, start: datetime) -> Tuple[List[ExpiringItem], int]:
+        """Return (the n soonest items expiring on or after start, number of such items)"""
+        with self._lock:
+            state = self._users.get(user_id)
+            found = None
+            if state is not None and time.monotonic() - state.loaded_at < self.ttl:
+                found = state.peek(n, start)
+        if found is None:
+            state = self._load(user_id, start, max(self.depth, n))
+            with self._lock:
+                found = state.peek(n, start)
+        if state.complete:
+            with self._lock:
+                return found, sum(1 for expires_at, _ in state.items.values() if expires_at >= start)
+        if state.total is None:
+            total = count_upcoming_expiries(self.db, user_id, start)
+            with self._lock:
+                state.total = total
+        return found, state.total
+
+    def upsert(self, user_id: str, item_id: str, expires_at: Optional[datetime], data: Dict[str, Any]):
+        """Record an item's new expiry and data after it was written (bought or updated)"""
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                state.upsert(item_id, expires_at, data)
+                state.total = None
+
+    def remove(self, user_id: str, item_id: str):
+        """Forget an item that was consumed or deleted"""
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                state.items.pop(item_id, None)
+                state.total = None
+
+    def invalidate(self, user_id: str = None):
+        """Drop one user's cached expiries (e.g. after a rebuild), or everyone's"""
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
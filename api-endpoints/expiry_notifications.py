@@ -0,0 +1,221 @@
+import os
+import math
+import uuid
+import heapq
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+from google.api_core import exceptions as google_exceptions
+
+from inventory_store import upcoming_expiries_query, start_of_today
+
+# Set to "true" to run the background expiry notifier (one instance in the cluster leads)
+EXPIRY_NOTIFICATIONS_ENABLED = os.getenv("EXPIRY_NOTIFICATIONS_ENABLED", "false").lower() == "true"
+# Notify this many days before an item expires (1 matches the "critical" urgency)
+EXPIRY_NOTIFY_DAYS = int(os.getenv("EXPIRY_NOTIFY_DAYS", "1"))
+# Seconds between scheduler ticks: lease renewal and firing due notifications
+EXPIRY_SCHEDULER_INTERVAL = int(os.getenv("EXPIRY_SCHEDULER_INTERVAL", "60"))
+# Seconds between reloads of upcoming expiries, to pick up inventory written by other instances
+EXPIRY_SCHEDULER_RELOAD = int(os.getenv("EXPIRY_SCHEDULER_RELOAD", "900"))
+
+
+class FirestoreLease:
+    """
+    Time-limited lease on a document in `scheduler_leases`, so only one instance
+    runs a cluster-wide job. The holder renews it by calling acquire() again before
+    it runs out; if the holder dies, another instance takes over after `duration`.
+    """
+
+    def __init__(self, db, name: str, duration: int, collection: str = "scheduler_leases"):
+        self.db = db
+        self.ref = db.collection(collection).document(name)
+        self.duration = duration
+        self.holder = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    def acquire(self) -> bool:
+        """Take or renew the lease; False while another holder's lease is still valid"""
+
+        @firestore.transactional
+        def take(transaction) -> bool:
+            snapshot = self.ref.get(transaction=transaction)
+            now = datetime.now(timezone.utc)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            if lease.get("holder") not in (None, self.holder) and lease.get("expiresAt") and lease["expiresAt"] > now:
+                return False
+            transaction.set(self.ref, {
+                "holder": self.holder,
+                "expiresAt": now + timedelta(seconds=self.duration),
+                "renewedAt": now,
+            })
+            return True
+
+        return take(self.db.transaction())
+
+    def release(self):
+        snapshot = self.ref.get()
+        if snapshot.exists and snapshot.to_dict().get("holder") == self.holder:
+            self.ref.delete(option=self.db.write_option(last_update_time=snapshot.update_time))
+
+
+class ExpiryNotifier:
+    """
+    Background scheduler that writes a notification to the `notifications` collection
+    (and hands it to the senders, e.g. email) when an inventory item becomes critical,
+    EXPIRY_NOTIFY_DAYS before it expires.
+
+    The leader loads only the items whose notification falls due before the next
+    reload, with one range query on the expiresAt collection-group index, into a
+    min-heap keyed by due date. Inventory writers report changes through
+    item_changed()/item_removed(); superseded heap entries are skipped when they
+    reach the top. Work grows with the number of upcoming expiries, not with users
+    times inventory size. Notification ids are deterministic and written with
+    create(), so a leader change never notifies twice.
+    """
+
+    def __init__(self, db, senders: List[Callable[[Dict[str, Any]], Any]] = None, notify_days: int = None,
+                 interval: int = None, reload_seconds: int = None, collection: str = "notifications"):
+        self.db = db
+        self.senders = senders or []
+        self.notify_days = EXPIRY_NOTIFY_DAYS if notify_days is None else notify_days
+        self.interval = interval or EXPIRY_SCHEDULER_INTERVAL
+        self.reload_seconds = reload_seconds or EXPIRY_SCHEDULER_RELOAD
+        self.collection = db.collection(collection)
+        self.lease = FirestoreLease(db, "expiry_notifications", duration=3 * self.interval)
+        self._heap: List[Tuple[datetime, str, str]] = []
+        self._items: Dict[Tuple[str, str], Tuple[datetime, Dict[str, Any]]] = {}
+        self._window_end: Optional[datetime] = None
+        self._loaded_at: Optional[datetime] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.fired = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="expiry-notifier", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+        try:
+            self.lease.release()
+        except Exception as e:
+            print(f"Could not release expiry notifier lease: {e}")
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.tick()
+            self._stop.wait(self.interval)
+
+    def tick(self):
+        """Renew the lease, reload when due, and fire due notifications (leader only)"""
+        try:
+            if not self.lease.acquire():
+                self._forget()
+                return
+            now = datetime.now(timezone.utc)
+            if self._loaded_at is None or (now - self._loaded_at).total_seconds() >= self.reload_seconds:
+                self.load()
+            self.fire_due(start_of_today())
+        except Exception as e:
+            print(f"Expiry notifier tick failed: {e}")
+            traceback.print_exc()
+
+    def _due_date(self, expires_at: datetime) -> datetime:
+        return expires_at - timedelta(days=self.notify_days)
+
+    def _forget(self):
+        with self._lock:
+            self._heap, self._items = [], {}
+            self._window_end = self._loaded_at = None
+
+    def load(self):
+        """Load items whose notification falls due before the next reload"""
+        today = start_of_today()
+        window_end = today + timedelta(days=self.notify_days + 1 + math.ceil(self.reload_seconds / 86400))
+        query = upcoming_expiries_query(self.db, None, today).where("expiresAt", "<", window_end)
+        items = {}
+        for doc in query.stream():
+            data = doc.to_dict()
+            if data.get("userId"):
+                items[(data["userId"], doc.id)] = (data["expiresAt"], data)
+        heap = [(self._due_date(expires_at), user_id, item_id) for (user_id, item_id), (expires_at, _) in items.items()]
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap, self._items = heap, items
+            self._window_end = window_end
+            self._loaded_at = datetime.now(timezone.utc)
+        print(f"Expiry notifier loaded {len(items)} upcoming expiries until {window_end.date()}")
+
+    def invalidate(self):
+        """Reload on the next tick, e.g. after an inventory rebuild"""
+        with self._lock:
+            self._loaded_at = None
+
+    def item_changed(self, user_id: str, item_id: str, expires_at: Optional[datetime], data: Dict[str, Any]):
+        """Schedule (or reschedule) an item after its expiry was written"""
+        with self._lock:
+            if self._window_end is None:
+                return
+            key = (user_id, item_id)
+            if expires_at is None or expires_at >= self._window_end:
+                self._items.pop(key, None)
+                return
+            current = self._items.get(key)
+            self._items[key] = (expires_at, data)
+            if current is None or current[0] != expires_at:
+                heapq.heappush(self._heap, (self._due_date(expires_at), user_id, item_id))
+
+    def item_removed(self, user_id: str, item_id: str):
+        with self._lock:
+            self._items.pop((user_id, item_id), None)
+
+    def fire_due(self, today: datetime) -> int:
+        """Notify every scheduled item whose due date has come; returns how many were sent"""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= today:
+                due_date, user_id, item_id = heapq.heappop(self._heap)
+                current = self._items.get((user_id, item_id))
+                if current is None or self._due_date(current[0]) != due_date:
+                    continue
+                del self._items[(user_id, item_id)]
+                if current[0] >= today:
+                    due.append((user_id, item_id, current[0], current[1]))
+        sent = sum(self._notify(*event) for event in due)
+        self.fired += sent
+        return sent
+
+    def _notify(self, user_id: str, item_id: str, expires_at: datetime, data: Dict[str, Any]) -> bool:
+        days = (expires_at.date() - start_of_today().date()).days
+        item_name = data.get("item_name", item_id)
+        when = "today" if days <= 0 else "tomorrow" if days == 1 else f"in {days} days"
+        notification = {
+            "userId": user_id,
+            "type": "expiry",
+            "itemId": item_id,
+            "itemName": item_name,
+            "expiryDate": expires_at.strftime('%Y-%m-%d'),
+            "daysUntilExpiry": days,
+            "title": f"{item_name.title()} expires {when}",
+            "message": f"Your {item_name} expires {when}. Use it soon or plan a recipe around it.",
+            "read": False,
+            "createdAt": datetime.now(timezone.utc),
+        }
+        try:
+            self.collection.document(f"expiry_{user_id}_{item_id}_{expires_at:%Y%m%d}").create(notification)
+        except google_exceptions.AlreadyExists:
+            return False
+        for send in self.senders:
+            try:
+                send(notification)
+            except Exception as e:
+                print(f"Expiry notification sender failed for {user_id}: {e}")
+        return True
@@ -0,0 +1,271 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1 import Increment
+
+# Firestore allows 500 writes per batch; stay below it so a caller's related writes
+# (e.g. the three documents of one receipt) never have to be split
+FIRESTORE_BATCH_SIZE = int(os.getenv("FIRESTORE_BATCH_SIZE", "450"))
+FIRESTORE_BATCH_LIMIT = 500
+FIRESTORE_MAX_RETRIES = int(os.getenv("FIRESTORE_MAX_RETRIES", "5"))
+
+# Errors worth retrying; anything else (e.g. a failed precondition) is raised at once
+RETRYABLE_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+)
+# The subset raised only when the commit was not applied. After the others the batch
+# may have been applied, so they are not retried for batches whose increments would
+# then count twice (see needs_safe_retry)
+NOT_APPLIED_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.ResourceExhausted,
+)
+
+# (method, document reference, data, option)
+Operation = Tuple[str, Any, Optional[Dict[str, Any]], Any]
+
+
+def _has_increment(value) -> bool:
+    if isinstance(value, Increment):
+        return True
+    if isinstance(value, dict):
+        return any(_has_increment(v) for v in value.values())
+    return False
+
+
+def needs_safe_retry(operations: List[Operation]) -> bool:
+    """
+    Whether committing operations twice would double-count: they hold an Increment
+    and no write has a precondition (which would make a second commit fail instead).
+    """
+    if any(option is not None for _, _, _, option in operations):
+        return False
+    return any(data is not None and _has_increment(data) for _, _, data, _ in operations)
+
+
+class BatchWriter:
+    """
+    Buffers Firestore set/update/delete operations and commits them in WriteBatches
+    of at most max_ops writes, retrying transient failures with exponential backoff
+    and jitter. Safe to share between threads. Batches holding Increments are only
+    retried after errors that guarantee nothing was written, so a commit that timed
+    out after being applied is not counted twice; those errors are raised instead.
+
+    Operations added with one add() call (or one group) always land in the same
+    batch, so they are committed atomically: batches are only cut between them, and
+    go past max_ops only for a single add() larger than that (up to Firestore's 500).
+    With auto_flush, batches are committed as soon as max_ops operations are
+    pending; otherwise only on flush() (or leaving the `with` block).
+
+        with BatchWriter(db) as writer:
+            for ref, data in docs:
+                writer.set(ref, data)
+        print(writer.stats())
+
+    group() collects one unit of work's writes (e.g. everything one receipt
+    writes) so they are added together, and tells its caller when the batch
+    holding them has committed.
+    """
+
+    def __init__(self, db, max_ops: int = None, max_retries: int = None, base_delay: float = 0.5,
+                 auto_flush: bool = True):
+        self.db = db
+        self.max_ops = max_ops or FIRESTORE_BATCH_SIZE
+        self.max_retries = FIRESTORE_MAX_RETRIES if max_retries is None else max_retries
+        self.base_delay = base_delay
+        self.auto_flush = auto_flush
+        self._pending: List[Operation] = []
+        # Number of pending operations at the end of each add(), where batches may be cut
+        self._boundaries: List[int] = []
+        # (number of pending operations once the group's are included, group future)
+        self._groups: List[Tuple[int, Future]] = []
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.committed = 0
+        self.batches = 0
+        self.retries = 0
+        self._commit_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def set(self, ref, data: Dict[str, Any], merge: bool = False):
+        self._add([("set_merge" if merge else "set", ref, data, None)])
+
+    def update(self, ref, data: Dict[str, Any], option=None):
+        self._add([("update", ref, data, option)])
+
+    def delete(self, ref, option=None):
+        self._add([("delete", ref, None, option)])
+
+    def add(self, writes: List[Tuple[Any, Dict[str, Any]]]):
+        """Add (document reference, data) sets that must be committed together."""
+        self._add([("set", ref, data, None) for ref, data in writes])
+
+    def group(self) -> "WriteGroup":
+        return WriteGroup(self)
+
+    def _add(self, operations: List[Operation], done: Future = None):
+        if len(operations) > FIRESTORE_BATCH_LIMIT:
+            raise ValueError(f"{len(operations)} writes cannot be committed atomically (limit {FIRESTORE_BATCH_LIMIT})")
+        with self._lock:
+            self._pending.extend(operations)
+            self._boundaries.append(len(self._pending))
+            if done is not None:
+                self._groups.append((len(self._pending), done))
+            if not self.auto_flush or len(self._pending) < self.max_ops:
+                return
+            pending, boundaries, groups = self._take()
+        self._commit_groups(pending, boundaries, groups)
+
+    def flush(self):
+        with self._lock:
+            pending, boundaries, groups = self._take()
+        self._commit_groups(pending, boundaries, groups)
+
+    def _take(self):
+        taken = self._pending, self._boundaries, self._groups
+        self._pending, self._boundaries, self._groups = [], [], []
+        return taken
+
+    def _batch_ends(self, boundaries: List[int]) -> List[int]:
+        """End offsets of batches of at most max_ops operations, cut only at add() boundaries"""
+        ends = []
+        start = 0
+        for previous, boundary in zip([0] + boundaries, boundaries):
+            if boundary - start > self.max_ops and previous > start:
+                ends.append(previous)
+                start = previous
+        if boundaries and boundaries[-1] > start:
+            ends.append(boundaries[-1])
+        return ends
+
+    def _commit_groups(self, pending: List[Operation], boundaries: List[int], groups: List[Tuple[int, Future]]):
+        """Commit pending in batches, resolving each group's future with the batch holding its last write"""
+        start = 0
+        for end in self._batch_ends(boundaries):
+            done = [future for offset, future in groups if offset <= end]
+            groups = [(offset, future) for offset, future in groups if offset > end]
+            try:
+                self._commit(pending[start:end])
+            except Exception as e:
+                # Later batches are not attempted either
+                for future in done + [future for _, future in groups]:
+                    future.set_exception(e)
+                raise
+            for future in done:
+                future.set_result(None)
+            start = end
+
+    def _build_batch(self, operations: List[Operation]):
+        batch = self.db.batch()
+        for method, ref, data, option in operations:
+            if method == "set":
+                batch.set(ref, data)
+            elif method == "set_merge":
+                batch.set(ref, data, merge=True)
+            elif method == "update":
+                batch.update(ref, data, option=option)
+            elif method == "delete":
+                batch.delete(ref, option=option)
+        return batch
+
+    def _commit(self, operations: List[Operation]):
+        if not operations:
+            return
+        started = time.perf_counter()
+        retryable = NOT_APPLIED_ERRORS if needs_safe_retry(operations) else RETRYABLE_ERRORS
+        attempt = 0
+        while True:
+            try:
+                # Rebuild the batch on every attempt rather than re-committing a used one
+                self._build_batch(operations).commit()
+                break
+            except retryable as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.base_delay * (2 ** attempt) * (0.5 + random.random())
+                print(f"Firestore batch commit failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay)
+        with self._lock:
+            self.committed += len(operations)
+            self.batches += 1
+            self._commit_seconds += time.perf_counter() - started
+
+    def stats(self) -> Dict[str, Any]:
+        """Writes committed, batches, retries and throughput since the writer was created."""
+        with self._lock:
+            elapsed = time.perf_counter() - self._started
+            return {
+                "writes": self.committed,
+                "batches": self.batches,
+                "retries": self.retries,
+                "pending": len(self._pending),
+                "elapsedMs": round(elapsed * 1000, 1),
+                "commitMs": round(self._commit_seconds * 1000, 1),
+                "writesPerSecond": round(self.committed / elapsed, 1) if elapsed > 0 else 0.0,
+            }
+
+
+class WriteGroup:
+    """
+    Writes of one unit of work, added to a BatchWriter together by submit().
+    `done` resolves once the batch holding them has committed, or holds the
+    commit error; on_commit callbacks run only after a successful commit.
+    Has the set/update/delete/add interface of BatchWriter, so it can be passed
+    wherever a writer is expected.
+    """
+
+    def __init__(self, writer: BatchWriter):
+        self.writer = writer
+        self.done: Future = Future()
+        self._operations: List[Operation] = []
+
+    def set(self, ref, data: Dict[str, Any], merge: bool = False):
+        self._operations.append(("set_merge" if merge else "set", ref, data, None))
+
+    def update(self, ref, data: Dict[str, Any], option=None):
+        self._operations.append(("update", ref, data, option))
+
+    def delete(self, ref, option=None):
+        self._operations.append(("delete", ref, None, option))
+
+    def add(self, writes: List[Tuple[Any, Dict[str, Any]]]):
+        self._operations.extend(("set", ref, data, None) for ref, data in writes)
+
+    def on_commit(self, callback: Callable[[], None]):
+        def run(future: Future):
+            if future.exception() is None:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Post-commit callback failed: {e}")
+        self.done.add_done_callback(run)
+
+    def submit(self):
+        """Hand the writes to the writer; an empty group is done at once. Commit errors go to `done`."""
+        if not self._operations:
+            self.done.set_result(None)
+            return
+        try:
+            self.writer._add(self._operations, self.done)
+        except Exception as e:
+            # An auto-flush this triggered failed; the error is on `done`, as on every group in that batch
+            if not self.done.done():
+                self.done.set_exception(e)
@@ -0,0 +1,92 @@
+import io
+import os
+from typing import Any, BinaryIO, Dict, Optional, Union
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Longest edge (px) of the image sent to Gemini and stored in Firebase
+RECEIPT_MAX_EDGE = int(os.getenv("RECEIPT_MAX_EDGE", "1600"))
+# Longest edge (px) of the list-view thumbnail
+RECEIPT_THUMBNAIL_EDGE = int(os.getenv("RECEIPT_THUMBNAIL_EDGE", "320"))
+# Re-encode format ("webp" or "jpeg") and quality
+RECEIPT_IMAGE_FORMAT = os.getenv("RECEIPT_IMAGE_FORMAT", "webp").lower()
+RECEIPT_IMAGE_QUALITY = int(os.getenv("RECEIPT_IMAGE_QUALITY", "80"))
+
+FORMAT_INFO = {
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+
+def encode_image(image: Image.Image, fmt: str = None, quality: int = None) -> bytes:
+    """Encode a PIL image as WebP or JPEG bytes."""
+    pil_format = FORMAT_INFO[fmt or RECEIPT_IMAGE_FORMAT][0]
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, format=pil_format, quality=quality or RECEIPT_IMAGE_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def prepare_for_text(image: Image.Image) -> Image.Image:
+    """Grayscale and stretch contrast so printed text stands out for the model."""
+    gray = ImageOps.grayscale(image)
+    return ImageOps.autocontrast(gray, cutoff=1)
+
+
+def preprocess_receipt_image(
+    source: Union[bytes, BinaryIO],
+    max_edge: int = None,
+    thumbnail_edge: int = None,
+    fmt: str = None,
+    quality: int = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Shrink a receipt photo before it is sent to Gemini and stored.
+
+    Applies the EXIF orientation, downscales to max_edge, and produces:
+    - model_bytes: grayscale, contrast-stretched copy for Gemini
+    - storage_bytes: colour copy for Firebase Storage
+    - thumbnail_bytes: small colour copy for list views
+
+    `source` may be bytes or a seekable file object (e.g. a spooled upload), which
+    is decoded in place without reading it into memory first.
+
+    Returns None when the input is not a decodable image (e.g. PDFs), in which
+    case callers should fall back to the original file.
+    """
+    fmt = fmt or RECEIPT_IMAGE_FORMAT
+    max_edge = max_edge or RECEIPT_MAX_EDGE
+    thumbnail_edge = thumbnail_edge or RECEIPT_THUMBNAIL_EDGE
+    try:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        source.seek(0)
+        image = Image.open(source)
+        original_size = image.size
+        # JPEGs can be decoded directly at a reduced scale, which is much cheaper
+        # than decoding the full photo and downscaling afterwards
+        image.draft("RGB", (max_edge, max_edge))
+        image.load()
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail((thumbnail_edge, thumbnail_edge), Image.LANCZOS)
+
+    _, mime_type, ext = FORMAT_INFO[fmt]
+    return {
+        "model_bytes": encode_image(prepare_for_text(image), fmt, quality),
+        "storage_bytes": encode_image(image, fmt, quality),
+        "thumbnail_bytes": encode_image(thumbnail, fmt, quality),
+        "mime_type": mime_type,
+        "ext": ext,
+        "original_size": original_size,
+        "processed_size": image.size,
+    }
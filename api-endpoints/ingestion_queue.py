@@ -0,0 +1,263 @@
+import os
+import hmac
+import json
+import uuid
+import hashlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+
+# Seconds without progress after which a queued or processing job is taken to be lost with its instance
+INGESTION_JOB_STALE_SECONDS = int(os.getenv("INGESTION_JOB_STALE_SECONDS", "900"))
+# Times a lost job is run before it is marked failed instead of requeued
+INGESTION_JOB_MAX_ATTEMPTS = int(os.getenv("INGESTION_JOB_MAX_ATTEMPTS", "3"))
+# Hosts job results may be POSTed to; callback_url is refused for any other host (and when unset)
+INGESTION_CALLBACK_HOSTS = {h.strip().lower() for h in os.getenv("INGESTION_CALLBACK_HOSTS", "").split(",") if h.strip()}
+# Key for the HMAC-SHA256 signature sent with callbacks in X-PocketSage-Signature
+INGESTION_CALLBACK_SECRET = os.getenv("INGESTION_CALLBACK_SECRET", "")
+
+JOB_QUEUED = "queued"
+JOB_PROCESSING = "processing"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+ACTIVE_STATUSES = [JOB_QUEUED, JOB_PROCESSING]
+
+
+def callback_allowed(url: str) -> bool:
+    """An https URL on one of INGESTION_CALLBACK_HOSTS"""
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return False
+    return parsed.scheme == "https" and (parsed.hostname or "").lower() in INGESTION_CALLBACK_HOSTS
+
+
+def sign_callback(body: bytes) -> str:
+    return "sha256=" + hmac.new(INGESTION_CALLBACK_SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+class LocalJobStore:
+    """In-memory job store for tests and single-process development."""
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: Dict[str, Any]):
+        with self._lock:
+            self._jobs[job["jobId"]] = dict(job)
+
+    def update(self, job_id: str, fields: Dict[str, Any]):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stale(self, before: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(job) for job in self._jobs.values()
+                    if job["status"] in ACTIVE_STATUSES and job.get("updatedAt", job["createdAt"]) < before]
+
+    def claim(self, job_id: str, attempts: int, fields: Dict[str, Any]) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job["status"] not in ACTIVE_STATUSES or job.get("attempts", 1) != attempts:
+                return False
+            job.update(fields)
+            return True
+
+
+class FirestoreJobStore:
+    """Job store backed by the `upload_jobs` collection so any instance can report status."""
+
+    def __init__(self, collection: str = "upload_jobs"):
+        from firebase_admin import firestore
+        self.db = firestore.client()
+        self.collection = self.db.collection(collection)
+
+    def create(self, job: Dict[str, Any]):
+        self.collection.document(job["jobId"]).set(job)
+
+    def update(self, job_id: str, fields: Dict[str, Any]):
+        self.collection.document(job_id).update(fields)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        doc = self.collection.document(job_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def stale(self, before: str) -> List[Dict[str, Any]]:
+        query = self.collection.where("status", "in", ACTIVE_STATUSES).where("updatedAt", "<", before)
+        return [doc.to_dict() for doc in query.stream()]
+
+    def claim(self, job_id: str, attempts: int, fields: Dict[str, Any]) -> bool:
+        """Update the job only if it is still active and no other instance has claimed it since it was read"""
+        from firebase_admin import firestore
+        ref = self.collection.document(job_id)
+
+        @firestore.transactional
+        def apply(transaction) -> bool:
+            snapshot = ref.get(transaction=transaction)
+            job = snapshot.to_dict() if snapshot.exists else None
+            if not job or job["status"] not in ACTIVE_STATUSES or job.get("attempts", 1) != attempts:
+                return False
+            transaction.update(ref, fields)
+            return True
+
+        return apply(self.db.transaction())
+
+
+class IngestionQueue:
+    """
+    Background worker pool for receipt ingestion. `submit` records a queued job and
+    returns immediately; a worker runs the handler and stores its result or error.
+    Jobs only live in this process's executor, so `recover` requeues the ones a
+    previous instance lost from the `input` they were submitted with. A running
+    job refreshes its updatedAt every third of stale_seconds, so a long job is
+    not taken for a lost one.
+
+    Completion can be pushed to the device (FCM notify_token) or POSTed to a
+    callback_url on INGESTION_CALLBACK_HOSTS, signed with INGESTION_CALLBACK_SECRET.
+    """
+
+    def __init__(self, store=None, max_workers: int = None, on_failed: Callable[[Dict[str, Any]], None] = None,
+                 stale_seconds: int = None, max_attempts: int = None):
+        self.store = store or LocalJobStore()
+        self.max_workers = max_workers or int(os.getenv("INGESTION_WORKERS", "4"))
+        self.on_failed = on_failed
+        self.stale_seconds = stale_seconds or INGESTION_JOB_STALE_SECONDS
+        self.max_attempts = max_attempts or INGESTION_JOB_MAX_ATTEMPTS
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ingestion")
+
+    def submit(self, handler: Callable[..., Dict[str, Any]], payload: Dict[str, Any],
+               user_id: str, receipt_id: str, callback_url: str = None, notify_token: str = None,
+               job_input: Dict[str, Any] = None) -> str:
+        """
+        job_input is what `recover` needs to rebuild payload after a restart (it is
+        stored with the job). Raises ValueError for a callback_url that is not allowed.
+        """
+        if callback_url and not callback_allowed(callback_url):
+            raise ValueError("callback_url must be an https URL on a configured callback host")
+        job_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        job = {
+            "jobId": job_id,
+            "userId": user_id,
+            "receiptId": receipt_id,
+            "status": JOB_QUEUED,
+            "createdAt": now,
+            "updatedAt": now,
+            "attempts": 1,
+            "callbackUrl": callback_url,
+            "notifyToken": notify_token,
+            "input": job_input,
+            "result": None,
+            "error": None,
+        }
+        self.store.create(job)
+        self._executor.submit(self._run, job, handler, payload, callback_url, notify_token)
+        return job_id
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(job_id)
+
+    def recover(self, handler: Callable[..., Dict[str, Any]],
+                rebuild: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Requeue queued or processing jobs that have not moved for stale_seconds
+        (their instance is gone). rebuild(job) returns the handler's payload from
+        job["input"]; jobs it raises for, or that have already been run
+        max_attempts times, are marked failed. Each job is claimed first, so
+        instances starting together requeue it once.
+        """
+        before = (datetime.utcnow() - timedelta(seconds=self.stale_seconds)).isoformat()
+        summary = {"requeued": 0, "failed": 0}
+        for job in self.store.stale(before):
+            attempts = job.get("attempts", 1)
+            claimed = {"status": JOB_QUEUED, "attempts": attempts + 1, "updatedAt": datetime.utcnow().isoformat()}
+            if not self.store.claim(job["jobId"], attempts, claimed):
+                continue
+            job.update(claimed)
+            try:
+                if attempts >= self.max_attempts:
+                    raise RuntimeError(f"Interrupted {attempts} times")
+                payload = rebuild(job)
+            except Exception as e:
+                print(f"Could not requeue ingestion job {job['jobId']}: {e}")
+                self._finish(job, {"status": JOB_FAILED, "error": f"Job was interrupted and could not be resumed: {e}",
+                                   "result": None}, job.get("callbackUrl"), job.get("notifyToken"))
+                summary["failed"] += 1
+                continue
+            self._executor.submit(self._run, job, handler, payload, job.get("callbackUrl"), job.get("notifyToken"))
+            summary["requeued"] += 1
+        return summary
+
+    def _run(self, job: Dict[str, Any], handler, payload, callback_url, notify_token):
+        now = datetime.utcnow().isoformat()
+        self.store.update(job["jobId"], {"status": JOB_PROCESSING, "startedAt": now, "updatedAt": now})
+        running = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job["jobId"], running), daemon=True).start()
+        try:
+            result = handler(**payload)
+            if isinstance(result, dict) and result.get("error"):
+                fields = {"status": JOB_FAILED, "error": result["error"], "result": None}
+            else:
+                fields = {"status": JOB_COMPLETED, "result": result}
+        except Exception as e:
+            traceback.print_exc()
+            fields = {"status": JOB_FAILED, "error": str(e), "result": None}
+        finally:
+            running.set()
+        self._finish(job, fields, callback_url, notify_token)
+
+    def _heartbeat(self, job_id: str, finished: threading.Event):
+        """Refresh updatedAt until the job finishes, so `recover` elsewhere leaves it alone"""
+        while not finished.wait(self.stale_seconds / 3):
+            try:
+                self.store.update(job_id, {"updatedAt": datetime.utcnow().isoformat()})
+            except Exception as e:
+                print(f"Could not refresh ingestion job {job_id}: {e}")
+
+    def _finish(self, job: Dict[str, Any], fields: Dict[str, Any], callback_url: str = None, notify_token: str = None):
+        fields["finishedAt"] = fields["updatedAt"] = datetime.utcnow().isoformat()
+        self.store.update(job["jobId"], fields)
+        if fields["status"] == JOB_FAILED and self.on_failed:
+            try:
+                self.on_failed({**job, **fields})
+            except Exception as e:
+                print(f"Failed-job hook failed for job {job['jobId']}: {e}")
+        self._notify(job["jobId"], fields, callback_url, notify_token)
+
+    def _notify(self, job_id: str, fields: Dict[str, Any], callback_url: str = None, notify_token: str = None):
+        """Optional completion push: signed webhook callback and/or FCM message to the device."""
+        # Checked again here: jobs recovered from the store may predate the current host list
+        if callback_url and callback_allowed(callback_url):
+            try:
+                body = json.dumps({"jobId": job_id, **fields}, default=str).encode("utf-8")
+                headers = {"Content-Type": "application/json"}
+                if INGESTION_CALLBACK_SECRET:
+                    headers["X-PocketSage-Signature"] = sign_callback(body)
+                requests.post(callback_url, data=body, headers=headers, timeout=5, allow_redirects=False)
+            except Exception as e:
+                print(f"Ingestion callback failed for job {job_id}: {e}")
+        if notify_token:
+            try:
+                from firebase_admin import messaging
+                messaging.send(messaging.Message(
+                    token=notify_token,
+                    data={"jobId": job_id, "status": fields["status"]},
+                    notification=messaging.Notification(
+                        title="Receipt processed" if fields["status"] == JOB_COMPLETED else "Receipt processing failed",
+                        body=fields.get("error") or "Your receipt is ready in PocketSage."
+                    )
+                ))
+            except Exception as e:
+                print(f"Ingestion push notification failed for job {job_id}: {e}")
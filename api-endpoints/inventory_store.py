@@ -0,0 +1,60 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+# Inventory lives under each user, users/{uid}/inventory/{item}, so per-user reads
+# are a subcollection scan and different users never write the same document
+USERS_COLLECTION = "users"
+INVENTORY_SUBCOLLECTION = "inventory"
+# Flat collection used before the move (inventories/{item} or inventories/{uid}_{item})
+LEGACY_INVENTORY_COLLECTION = "inventories"
+
+
+def inventory_item_id(item_name: str) -> str:
+    """Document id of an item within a user's inventory"""
+    return item_name.replace(' ', '_').replace('-', '_').replace('/', '_')
+
+
+def user_inventory(db, user_id: str):
+    """The user's inventory subcollection"""
+    return db.collection(USERS_COLLECTION).document(user_id).collection(INVENTORY_SUBCOLLECTION)
+
+
+def inventory_item_ref(db, user_id: str, item_name: str):
+    return user_inventory(db, user_id).document(inventory_item_id(item_name))
+
+
+def in_stock(item: dict) -> bool:
+    """Whether an inventory document has units left; used-up items stay for their purchase history"""
+    return (item.get('count') or 0) > 0
+
+
+def inventory_query(db, user_id: Optional[str] = None):
+    """One user's inventory, or every user's through a collection group query"""
+    if user_id:
+        return user_inventory(db, user_id)
+    return db.collection_group(INVENTORY_SUBCOLLECTION)
+
+
+def expiry_timestamp(expiry_date: Optional[str]) -> Optional[datetime]:
+    """expiresAt for an expiryDate (YYYY-MM-DD): the start of that day, stored as UTC"""
+    try:
+        return datetime.strptime(expiry_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+def start_of_today() -> datetime:
+    """Today's date in the same encoding as expiresAt, so items expiring today still count"""
+    return datetime.combine(datetime.now().date(), datetime.min.time(), tzinfo=timezone.utc)
+
+
+def upcoming_expiries_query(db, user_id: Optional[str], start: datetime, limit: int = None):
+    """Items expiring on or after start, soonest first (uses the expiresAt index)"""
+    query = inventory_query(db, user_id).where("expiresAt", ">=", start).order_by("expiresAt")
+    return query.limit(limit) if limit else query
+
+
+def count_upcoming_expiries(db, user_id: Optional[str], start: datetime) -> int:
+    """Number of items expiring on or after start, from a count aggregation"""
+    result = inventory_query(db, user_id).where("expiresAt", ">=", start).count().get()
+    return int(result[0][0].value)
@@ -0,0 +1,68 @@
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Set
+
+# Set to "false" to stop /upload from updating inventory in the background
+INVENTORY_AUTO_UPDATE = os.getenv("INVENTORY_AUTO_UPDATE", "true").lower() == "true"
+
+
+class InventoryUpdateScheduler:
+    """
+    Runs handler(user_id) in the background after uploads. Requests are coalesced
+    per user: a user is queued at most once, and requests that arrive while that
+    user's update is running schedule exactly one more run, so bursts of uploads
+    (e.g. /upload/bulk) cause one or two updates rather than one per receipt.
+
+    run() does an update in the calling thread (e.g. /add_inventories); a user's
+    updates, background or not, never run at the same time.
+    """
+
+    def __init__(self, handler: Callable[[str], object], max_workers: int = None):
+        self.handler = handler
+        self.max_workers = max_workers or int(os.getenv("INVENTORY_UPDATE_WORKERS", "2"))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inventory")
+        self._queued: Set[str] = set()
+        self._running: Set[str] = set()
+        self._dirty: Set[str] = set()
+        self._user_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.Lock())
+
+    def run(self, user_id: str, handler: Callable[[str], object] = None):
+        """Run handler (default: the scheduler's) for user_id now, after any update of that user in progress"""
+        with self._user_lock(user_id):
+            return (handler or self.handler)(user_id)
+
+    def request(self, user_id: str):
+        if not user_id:
+            return
+        with self._lock:
+            if user_id in self._running:
+                self._dirty.add(user_id)
+                return
+            if user_id in self._queued:
+                return
+            self._queued.add(user_id)
+        self._executor.submit(self._run, user_id)
+
+    def _run(self, user_id: str):
+        with self._lock:
+            self._queued.discard(user_id)
+            self._running.add(user_id)
+        try:
+            self.run(user_id)
+        except Exception as e:
+            print(f"Background inventory update failed for {user_id}: {e}")
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._running.discard(user_id)
+                rerun = user_id in self._dirty
+                self._dirty.discard(user_id)
+            if rerun:
+                self.request(user_id)
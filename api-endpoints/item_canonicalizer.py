@@ -0,0 +1,297 @@
+import os
+import re
+import hashlib
+import threading
+import importlib.util
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# Minimum trigram similarity (Dice coefficient, 0-1) for a fuzzy match to count
+ITEM_MATCH_THRESHOLD = float(os.getenv("ITEM_MATCH_THRESHOLD", "0.6"))
+
+# Common grocery and household items, the vocabulary names are canonicalized to
+CANONICAL_ITEMS = (
+    "milk", "curd", "yogurt", "paneer", "cheese", "butter", "ghee", "cream", "eggs",
+    "bread", "bun", "biscuits", "cookies", "cake", "rusk",
+    "rice", "basmati rice", "wheat flour", "atta", "maida", "sooji", "poha", "oats", "pasta", "noodles",
+    "toor dal", "moong dal", "chana dal", "urad dal", "masoor dal", "rajma", "chickpeas",
+    "sugar", "salt", "jaggery", "tea", "coffee", "honey", "jam", "ketchup",
+    "cooking oil", "sunflower oil", "mustard oil", "olive oil", "coconut oil",
+    "turmeric", "chilli powder", "coriander powder", "cumin", "garam masala",
+    "chicken", "mutton", "fish", "prawns",
+    "tomato", "potato", "onion", "garlic", "ginger", "carrot", "cabbage", "cauliflower",
+    "spinach", "capsicum", "cucumber", "brinjal", "beans", "peas", "green chilli", "coriander leaves",
+    "lemon", "apple", "banana", "orange", "mango", "grapes", "papaya", "watermelon", "pomegranate",
+    "juice", "soft drink", "water", "chips", "chocolate", "ice cream", "frozen peas",
+    "soap", "shampoo", "toothpaste", "detergent", "dishwash", "toilet paper", "tissues",
+)
+
+# Receipt shorthand for item names
+SEED_ALIASES = {
+    "ckn": "chicken", "chkn": "chicken", "chick": "chicken",
+    "tom": "tomato", "tomatoes": "tomato", "tmt": "tomato",
+    "pot": "potato", "potatoes": "potato", "aloo": "potato",
+    "onions": "onion", "pyaz": "onion", "pyaaz": "onion",
+    "egg": "eggs", "dahi": "curd", "doodh": "milk", "chawal": "rice",
+    "bread loaf": "bread", "brd": "bread", "wht brd": "bread",
+    "bnna": "banana", "bananas": "banana", "apples": "apple",
+    "tp": "toilet paper", "choc": "chocolate", "ccnut oil": "coconut oil",
+    "veg oil": "cooking oil", "refined oil": "cooking oil",
+    "tur dal": "toor dal", "arhar dal": "toor dal",
+    "haldi": "turmeric", "jeera": "cumin", "mirchi": "green chilli",
+    "dhania": "coriander leaves", "palak": "spinach", "gobi": "cauliflower",
+}
+
+# Words that describe or brand an item without changing what it is. A canonical name
+# is only taken from a longer text when every other word is one of these: in
+# "peanut butter" or "coconut water" the other word makes it a different product.
+MODIFIER_WORDS = {
+    "fresh", "organic", "natural", "pure", "premium", "classic", "regular", "special", "select", "gold",
+    "toned", "double", "full", "low", "fat", "skimmed", "homogenised", "pasteurised", "lite", "light", "diet",
+    "whole", "sliced", "chopped", "boneless", "curry", "cut", "raw", "frozen", "loose", "local", "desi", "farm",
+    "small", "medium", "large", "big", "mini", "jumbo", "family", "value", "pack", "refill", "combo",
+    "red", "green", "yellow", "white", "brown", "plain", "salted", "unsalted", "sweet", "fine", "extra", "virgin",
+    "amul", "nandini", "heritage", "aashirvaad", "fortune", "saffola", "tata", "britannia", "parle", "nestle",
+    "dabur", "patanjali", "everest", "mdh", "kissan", "cadbury", "colgate", "dove", "surf", "ariel", "tide", "vim",
+}
+
+# Items named by their form, so whatever comes before the name is a flavour or brand:
+# "lays potato chips" is chips and "dairy milk chocolate" is chocolate
+FLAVOURED_ITEMS = {
+    "chips", "chocolate", "juice", "ice cream", "biscuits", "cookies", "cake", "jam", "noodles", "tea", "ketchup",
+}
+
+# Cuts and forms written after the item they are part of, as in "chicken breast"
+PART_WORDS = {
+    "breast", "breasts", "thigh", "thighs", "leg", "legs", "wings", "drumstick", "drumsticks", "mince", "keema",
+    "fillet", "fillets", "loaf", "slices", "cubes", "florets", "bunch",
+}
+
+_UNIT_PATTERN = re.compile(
+    r"\b\d+(?:\.\d+)?\s*(?:kg|kgs|g|gm|gms|grams?|l|ltr|ltrs|litres?|liters?|ml|pcs?|pieces?|pack|pkt|x)?\b"
+)
+_PERCENT_PATTERN = re.compile(r"\d+(?:\.\d+)?\s*%")
+_NON_WORD_PATTERN = re.compile(r"[^a-z ]+")
+
+
+def _load_abbreviations() -> Dict[str, str]:
+    """
+    Item abbreviations from evaluation/normalization.py (ReceiptNormalizer.abbreviation_map),
+    if present. That map also holds merchants, address words, payment methods and units
+    (Cash, Qty, KG), so only entries expanding to a canonical item name are kept.
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "evaluation", "normalization.py")
+    if not os.path.exists(path):
+        return {}
+    try:
+        spec = importlib.util.spec_from_file_location("receipt_normalization", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        abbreviations = module.ReceiptNormalizer().abbreviation_map.items()
+        return {k.lower(): v.lower() for k, v in abbreviations if v.lower() in CANONICAL_ITEMS}
+    except Exception as e:
+        print(f"Could not load ReceiptNormalizer abbreviations: {e}")
+        return {}
+
+
+# Alias dictionary: the evaluation normalizer's item abbreviations plus item shorthand
+ALIASES = {**_load_abbreviations(), **SEED_ALIASES}
+
+
+def clean_item_name(name: str) -> str:
+    """Lowercase and drop pack sizes, percentages and punctuation."""
+    text = _PERCENT_PATTERN.sub(" ", str(name or "").lower())
+    text = _UNIT_PATTERN.sub(" ", text)
+    text = _NON_WORD_PATTERN.sub(" ", text)
+    return " ".join(text.split())
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def dice(a: str, b: str) -> float:
+    grams_a, grams_b = trigrams(a), trigrams(b)
+    return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def strip_parts(words: List[str]) -> List[str]:
+    """Drop cuts and descriptors after the item, e.g. "chicken breast" or "onion red" -> the item's words"""
+    end = len(words)
+    while end > 1 and (words[end - 1] in PART_WORDS or words[end - 1] in MODIFIER_WORDS):
+        end -= 1
+    return words[:end]
+
+
+def same_shape(text: str, name: str, threshold: float) -> bool:
+    """
+    Whether a fuzzy match can be a misspelling of name rather than another product:
+    as many words (modifiers aside) and a last word one or two edits away (one for
+    words of up to five letters), or scoring above threshold. Accepts "toor dhal"
+    for "toor dal"; rejects "mango pickle" for "mango" and "coconut water" for
+    "coconut oil", which score high on trigrams.
+    """
+    words = strip_parts(text.split())
+    words = [word for word in words if word not in MODIFIER_WORDS] or words
+    name_words = name.split()
+    if len(words) != len(name_words):
+        return False
+    head, name_head = words[-1], name_words[-1]
+    allowed = 1 if len(name_head) <= 5 else 2
+    return edit_distance(head, name_head) <= allowed or dice(head, name_head) >= threshold
+
+
+class TrigramIndex:
+    """Character-trigram inverted index over canonical names, scored with the Dice coefficient."""
+
+    def __init__(self, names=()):
+        self._grams: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._grams
+
+    def contained_in(self, text: str) -> Optional[str]:
+        """
+        Canonical name that is the head of text (its last words, cuts and
+        descriptors after it aside), e.g. "milk" in "amul toned milk" or "chicken"
+        in "chicken breast", when every word before it is in MODIFIER_WORDS or the
+        name is one of FLAVOURED_ITEMS. Longer names win ("basmati rice" over
+        "rice"). None otherwise, so "mango pickle" or "peanut butter" go on to the
+        fuzzy match and the model.
+        """
+        words = strip_parts(text.split())
+        best = None
+        for name in self._grams:
+            name_words = name.split()
+            if len(name_words) > len(words) or words[-len(name_words):] != name_words:
+                continue
+            if name not in FLAVOURED_ITEMS and not all(word in MODIFIER_WORDS for word in words[:-len(name_words)]):
+                continue
+            if best is None or len(name) > len(best):
+                best = name
+        return best
+
+    def add(self, name: str):
+        if name in self._grams:
+            return
+        grams = trigrams(name)
+        self._grams[name] = grams
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(name)
+
+    def search(self, text: str, limit: int = 5) -> List[Tuple[str, float]]:
+        """Best matching names as (name, score), highest score first."""
+        grams = trigrams(text)
+        shared = Counter()
+        for gram in grams:
+            for name in self._postings.get(gram, ()):
+                shared[name] += 1
+        scored = [(name, 2 * count / (len(grams) + len(self._grams[name]))) for name, count in shared.items()]
+        scored.sort(key=lambda pair: pair[1], reverse=True)
+        return scored[:limit]
+
+
+class ItemCanonicalizer:
+    """
+    Maps raw receipt item names to canonical inventory names without a model call
+    for names we have seen before:
+
+        aliases -> user's learned aliases -> exact canonical name -> canonical name
+        heading the text after brand/descriptor words -> trigram fuzzy match -> resolver
+
+    The resolver (Gemini in the server) is only called for unseen names; its answer
+    is written back to the user's alias table in the `item_aliases` collection so
+    the same name never needs the model again.
+    """
+
+    def __init__(self, db=None, threshold: float = None, collection: str = "item_aliases"):
+        self.db = db
+        self.threshold = ITEM_MATCH_THRESHOLD if threshold is None else threshold
+        self.collection = collection
+        self._users: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def _alias_doc_id(self, user_id: str, alias: str) -> str:
+        return f"{user_id}_{hashlib.sha1(alias.encode('utf-8')).hexdigest()[:16]}"
+
+    def _user_state(self, user_id: str) -> Dict:
+        """Per-user learned aliases and canonical-name index, loaded from Firestore on first use."""
+        with self._lock:
+            if user_id in self._users:
+                return self._users[user_id]
+        aliases = {}
+        if self.db is not None and user_id:
+            for doc in self.db.collection(self.collection).where("userId", "==", user_id).stream():
+                data = doc.to_dict()
+                aliases[data["alias"]] = data["canonical"]
+        index = TrigramIndex(CANONICAL_ITEMS)
+        for canonical in aliases.values():
+            index.add(canonical)
+        with self._lock:
+            return self._users.setdefault(user_id, {"aliases": aliases, "index": index})
+
+    def learn(self, user_id: str, alias: str, canonical: str):
+        """Record alias -> canonical for this user, in memory and in Firestore."""
+        state = self._user_state(user_id)
+        with self._lock:
+            state["aliases"][alias] = canonical
+            state["index"].add(canonical)
+        if self.db is not None and user_id:
+            self.db.collection(self.collection).document(self._alias_doc_id(user_id, alias)).set({
+                "userId": user_id,
+                "alias": alias,
+                "canonical": canonical,
+                "createdAt": datetime.utcnow().isoformat(),
+            })
+
+    def canonicalize(
+        self,
+        user_id: str,
+        raw_name: str,
+        resolver: Optional[Callable[[str, List[str]], str]] = None
+    ) -> Tuple[str, str]:
+        """
+        Return (canonical name, source), where source is one of
+        "alias", "learned", "exact", "contained", "fuzzy", "model" or "unmatched".
+        The resolver is called as resolver(raw_name, candidate_names).
+        """
+        cleaned = clean_item_name(raw_name) or str(raw_name or "").lower().strip()
+        if cleaned in ALIASES:
+            return ALIASES[cleaned], "alias"
+        state = self._user_state(user_id)
+        if cleaned in state["aliases"]:
+            return state["aliases"][cleaned], "learned"
+        # Expand shorthand words, e.g. "chkn breast" -> "chicken breast"
+        expanded = " ".join(SEED_ALIASES.get(word, word) for word in cleaned.split())
+        if expanded in state["index"]:
+            return expanded, "exact"
+        contained = state["index"].contained_in(expanded)
+        if contained:
+            return contained, "contained"
+        # Brand and descriptor words only dilute the trigram score
+        core = " ".join(word for word in expanded.split() if word not in MODIFIER_WORDS) or expanded
+        matches = state["index"].search(core)
+        for name, score in matches:
+            if score >= self.threshold and same_shape(expanded, name, self.threshold):
+                return name, "fuzzy"
+        if resolver is None:
+            return cleaned, "unmatched"
+
+        canonical = clean_item_name(resolver(raw_name, [name for name, _ in matches])) or cleaned
+        self.learn(user_id, cleaned, canonical)
+        return canonical, "model"
@@ -0,0 +1,140 @@
+import re
+from typing import Dict, Tuple
+
+# Detection only needs a sample; long messages are classified from their first characters
+MAX_SAMPLE_CHARS = 100
+
+# Unicode blocks for the scripts we support, as (start, end, script)
+SCRIPT_BLOCKS = (
+    (0x0041, 0x005A, "latin"),
+    (0x0061, 0x007A, "latin"),
+    (0x00C0, 0x024F, "latin"),
+    (0x0900, 0x097F, "devanagari"),
+    (0x0980, 0x09FF, "bengali"),
+    (0x0A00, 0x0A7F, "gurmukhi"),
+    (0x0A80, 0x0AFF, "gujarati"),
+    (0x0B00, 0x0B7F, "oriya"),
+    (0x0B80, 0x0BFF, "tamil"),
+    (0x0C00, 0x0C7F, "telugu"),
+    (0x0C80, 0x0CFF, "kannada"),
+    (0x0D00, 0x0D7F, "malayalam"),
+    (0xA8E0, 0xA8FF, "devanagari"),  # Devanagari Extended
+)
+
+# Script -> language code for scripts used by a single supported language
+SCRIPT_LANGUAGE = {
+    "latin": "en",
+    "bengali": "bn",
+    "tamil": "ta",
+    "telugu": "te",
+    "gurmukhi": "pa",
+    "gujarati": "gu",
+    "oriya": "or",
+    "kannada": "kn",
+    "malayalam": "ml",
+}
+
+# Words (and verb endings) that are frequent in one of Hindi or Marathi but rare in the other
+HINDI_MARKERS = (
+    "है", "हैं", "था", "थी", "थे", "हूँ", "हूं", "का", "की", "के", "में", "से", "को", "और",
+    "नहीं", "कैसे", "क्या", "मेरे", "मेरा", "मेरी", "यह", "वह", "नमस्ते", "हाँ", "रहा", "रही", "करें", "दिखाएं",
+    "पर", "किया", "कितना", "मैंने", "मुझे",
+)
+MARATHI_MARKERS = (
+    "आहे", "आहेत", "आहात", "होते", "होता", "नाही", "आणि", "मध्ये", "चा", "ची", "चे", "ला",
+    "कसे", "काय", "माझे", "माझा", "माझी", "हे", "ते", "नमस्कार", "होय", "करा", "दाखवा", "किती",
+)
+
+_HINDI_WORDS = frozenset(HINDI_MARKERS)
+_MARATHI_WORDS = frozenset(MARATHI_MARKERS)
+
+_DEVANAGARI_WORD = re.compile(r"[ऀ-ॿ]+")
+
+
+# One ASCII letter per script. Every ASCII letter is itself translated to the Latin
+# code, so after translation these letters can only stand for their script.
+_SCRIPT_CODES = {"latin": "l", "devanagari": "d", "bengali": "b", "gurmukhi": "p", "gujarati": "g",
+                 "oriya": "o", "tamil": "t", "telugu": "e", "kannada": "k", "malayalam": "m"}
+
+
+def _build_script_table() -> Dict[int, str]:
+    table = {}
+    for start, end, script in SCRIPT_BLOCKS:
+        for code_point in range(start, end + 1):
+            table[code_point] = _SCRIPT_CODES[script]
+    return table
+
+
+# Code point -> script code, so classifying a sample is one str.translate and a count per script
+_SCRIPT_TABLE = _build_script_table()
+
+
+def script_histogram(text: str) -> Dict[str, int]:
+    """Count letters per script in the first MAX_SAMPLE_CHARS characters."""
+    coded = text[:MAX_SAMPLE_CHARS].translate(_SCRIPT_TABLE)
+    counts = {}
+    for script, code in _SCRIPT_CODES.items():
+        count = coded.count(code)
+        if count:
+            counts[script] = count
+    return counts
+
+
+def disambiguate_devanagari(text: str) -> Tuple[str, float]:
+    """Pick Hindi or Marathi for Devanagari text using the marker lexicons."""
+    words = _DEVANAGARI_WORD.findall(text)
+    hindi_hits = sum(word in _HINDI_WORDS for word in words)
+    marathi_hits = sum(word in _MARATHI_WORDS for word in words)
+    total = hindi_hits + marathi_hits
+    if total == 0:
+        # No markers: Hindi is far more common, but we are not sure
+        return "hi", 0.5
+    if marathi_hits > hindi_hits:
+        return "mr", marathi_hits / total
+    return "hi", hindi_hits / total
+
+
+def detect_language_with_confidence(text: str) -> Tuple[str, float]:
+    """
+    Detect the language of the input text from the Unicode scripts it uses.
+
+    Args:
+        text: Text to detect language for
+
+    Returns:
+        Tuple of (language code, confidence between 0 and 1). Falls back to ('en', 0.0)
+        when the text has no letters.
+    """
+    if not text:
+        return "en", 0.0
+
+    counts = script_histogram(text)
+    letters = sum(counts.values())
+    if letters == 0:
+        return "en", 0.0
+
+    script, script_count = max(counts.items(), key=lambda kv: kv[1])
+    script_share = script_count / letters
+
+    # Mixed-script messages usually carry English product or brand names, so
+    # prefer the Indic script unless Latin letters clearly dominate.
+    if script == "latin" and script_share < 0.7:
+        non_latin = {k: v for k, v in counts.items() if k != "latin"}
+        if non_latin:
+            script, script_count = max(non_latin.items(), key=lambda kv: kv[1])
+            script_share = script_count / letters
+
+    if script == "devanagari":
+        language, lexicon_confidence = disambiguate_devanagari(text[:MAX_SAMPLE_CHARS])
+        return language, round(script_share * lexicon_confidence, 3)
+
+    return SCRIPT_LANGUAGE.get(script, "en"), round(script_share, 3)
+
+
+def detect_language(text: str) -> str:
+    """Return only the language code from detect_language_with_confidence, 'en' if detection fails."""
+    try:
+        return detect_language_with_confidence(text)[0]
+    except Exception as e:
+        print(f"Language detection error: {e}")
+        return "en"
@@ -0,0 +1,133 @@
+"""
+Move inventory documents from the flat `inventories` collection to per-user
+subcollections, users/{uid}/inventory/{item}.
+
+Documents are grouped by (userId, item_name). When a user has both an old global
+document (inventories/{item}, shared between users) and a per-user one
+(inventories/{uid}_{item}) for the same item, the per-user document wins, then the
+most recently updated one. Items already present in the new location are left
+alone unless --overwrite is given, so the script can be re-run safely.
+
+Every run also sets the native `expiresAt` timestamp on migrated items that only
+have the `expiryDate` string.
+
+Usage:
+    python migrate_inventory.py [--dry-run] [--overwrite] [--delete-legacy] [--user-id UID]
+"""
+
+import os
+import argparse
+from typing import Dict, List, Tuple
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from dotenv import load_dotenv
+
+from firestore_batch import BatchWriter
+from inventory_store import (
+    LEGACY_INVENTORY_COLLECTION, inventory_item_ref, inventory_item_id, inventory_query, expiry_timestamp
+)
+
+
+def pick_documents(docs) -> Tuple[Dict[Tuple[str, str], dict], List[str]]:
+    """
+    Choose one legacy document per (userId, item_name).
+    Returns ({(user id, item name): data}, ids of documents without a user or item name).
+    """
+    chosen: Dict[Tuple[str, str], Tuple[tuple, dict]] = {}
+    skipped = []
+    for doc in docs:
+        data = doc.to_dict()
+        user_id, item_name = data.get("userId"), data.get("item_name")
+        if not user_id or not item_name:
+            skipped.append(doc.id)
+            continue
+        per_user = doc.id == f"{user_id}_{inventory_item_id(item_name)}"
+        rank = (per_user, data.get("updated_at") or data.get("created_at") or "")
+        key = (user_id, item_name)
+        if key not in chosen or rank > chosen[key][0]:
+            chosen[key] = (rank, data)
+    return {key: data for key, (_, data) in chosen.items()}, skipped
+
+
+def backfill_expires_at(db, writer: BatchWriter, dry_run: bool = False, user_id: str = None) -> int:
+    """Set expiresAt from expiryDate on inventory items written before it existed"""
+    backfilled = 0
+    for doc in inventory_query(db, user_id).stream():
+        data = doc.to_dict()
+        expires_at = expiry_timestamp(data.get("expiryDate"))
+        if data.get("expiresAt") is not None or expires_at is None:
+            continue
+        backfilled += 1
+        if not dry_run:
+            writer.update(doc.reference, {"expiresAt": expires_at})
+    writer.flush()
+    return backfilled
+
+
+def migrate(db, dry_run: bool = False, overwrite: bool = False, delete_legacy: bool = False,
+            user_id: str = None) -> Dict:
+    legacy_ref = db.collection(LEGACY_INVENTORY_COLLECTION)
+    query = legacy_ref.where("userId", "==", user_id) if user_id else legacy_ref
+    legacy_docs = list(query.stream())
+    chosen, skipped = pick_documents(legacy_docs)
+    print(f"Found {len(legacy_docs)} legacy documents for {len(chosen)} user items ({len(skipped)} without userId/item_name)")
+
+    targets = {key: inventory_item_ref(db, *key) for key in chosen}
+    existing = set()
+    if not overwrite and targets:
+        existing = {doc.reference.path for doc in db.get_all(list(targets.values())) if doc.exists}
+
+    writer = BatchWriter(db)
+    copied = 0
+    for key, data in chosen.items():
+        ref = targets[key]
+        if ref.path in existing:
+            continue
+        copied += 1
+        if not dry_run:
+            writer.set(ref, {**data, "expiresAt": expiry_timestamp(data.get("expiryDate"))})
+    deleted = 0
+    if delete_legacy:
+        # Documents without a user are left for manual review
+        skipped_ids = set(skipped)
+        for doc in legacy_docs:
+            if doc.id in skipped_ids:
+                continue
+            deleted += 1
+            if not dry_run:
+                writer.delete(doc.reference)
+    writer.flush()
+    expiry_backfilled = backfill_expires_at(db, writer, dry_run=dry_run, user_id=user_id)
+
+    summary = {
+        "legacyDocuments": len(legacy_docs),
+        "userItems": len(chosen),
+        "copied": copied,
+        "alreadyMigrated": len(existing),
+        "skippedWithoutUser": skipped,
+        "legacyDeleted": deleted,
+        "expiryBackfilled": expiry_backfilled,
+        "dryRun": dry_run,
+        "firestoreStats": writer.stats(),
+    }
+    print(summary)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move inventories/{item} documents to users/{uid}/inventory/{item}")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be written without writing")
+    parser.add_argument("--overwrite", action="store_true", help="Replace items that already exist in the new location")
+    parser.add_argument("--delete-legacy", action="store_true", help="Delete the migrated documents from `inventories`")
+    parser.add_argument("--user-id", default=None, help="Only migrate this user's documents")
+    args = parser.parse_args()
+
+    load_dotenv()
+    service_account = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
+    if not service_account:
+        raise ValueError("FIREBASE_SERVICE_ACCOUNT_JSON environment variable must be set to the path of your Firebase service account JSON file")
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(service_account))
+    migrate(firestore.client(), dry_run=args.dry_run, overwrite=args.overwrite,
+            delete_legacy=args.delete_legacy, user_id=args.user_id)
@@ -0,0 +1,208 @@
+import io
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from receipt_spend import parse_vendor, parse_receipt_date
+from upload_spooling import sha256_file
+
+# Maximum Hamming distance (out of 64 bits) for two receipts to count as possible duplicates.
+# Receipts from one store can hash within a few bits of each other, so a near match is only
+# a duplicate once the parsed total, vendor and date agree. 0 keeps exact SHA-256 matching only.
+# Re-encoded, resized, brightened and slightly cropped copies of a bill stay within 10 bits.
+DEDUP_PHASH_THRESHOLD = int(os.getenv("DEDUP_PHASH_THRESHOLD", "10"))
+# Users whose perceptual hash index is kept in memory (least recently used dropped first)
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "1024"))
+# Nearest possible duplicates whose parsed receipts are compared
+DEDUP_MAX_CANDIDATES = 3
+
+HASH_SIZE = 8
+HIGHFREQ_FACTOR = 4
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT = _dct_matrix(HASH_SIZE * HIGHFREQ_FACTOR)
+
+
+def perceptual_hash(source: Union[bytes, BinaryIO]) -> Optional[int]:
+    """
+    64-bit DCT perceptual hash. Robust to re-encoding, resizing and small
+    brightness changes, so screenshots and re-photographed bills still match.
+    Returns None for non-images (e.g. PDFs).
+    """
+    try:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        source.seek(0)
+        image = Image.open(source)
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, OSError):
+        return None
+    finally:
+        source.seek(0)
+    size = HASH_SIZE * HIGHFREQ_FACTOR
+    pixels = np.asarray(ImageOps.grayscale(image).resize((size, size), Image.LANCZOS), dtype=np.float64)
+    low_freq = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    bits = (low_freq > np.median(low_freq)).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def receipt_identity(raw, total: Optional[float]) -> Dict[str, Any]:
+    """The fields a possible duplicate is confirmed on: total, vendor and purchase date"""
+    return {"total": total, "vendor": parse_vendor(raw), "date": parse_receipt_date(raw)}
+
+
+def same_receipt(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """Totals and vendors must be known and agree; dates must agree when both receipts have one"""
+    if a["total"] is None or b["total"] is None or not a["vendor"] or a["vendor"] != b["vendor"]:
+        return False
+    if abs(a["total"] - b["total"]) >= 0.01:
+        return False
+    return not (a["date"] and b["date"] and a["date"] != b["date"])
+
+
+class ReceiptHashIndex:
+    """
+    Per-user index of receipt hashes stored in the `receipt_hashes` collection.
+    Exact matches are a direct document lookup on {userId}_{sha256}; possible
+    duplicates compare perceptual hashes against a per-user in-process copy of the
+    index, loaded from Firestore on first use, and are left to the caller to confirm.
+
+    The copy only learns of receipts this instance stores; ones stored through
+    another instance are seen once the user is evicted and reloaded, so near
+    duplicates across instances can be missed until then (exact ones never are).
+    """
+
+    def __init__(self, db, threshold: int = None, collection: str = "receipt_hashes", size: int = None):
+        self.db = db
+        self.threshold = DEDUP_PHASH_THRESHOLD if threshold is None else threshold
+        self.collection = collection
+        self.size = size or DEDUP_CACHE_SIZE
+        self._phashes: "OrderedDict[str, List[Tuple[int, Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def compute(data: Union[bytes, BinaryIO]) -> Dict[str, Any]:
+        """SHA-256 and perceptual hash of bytes or a seekable file object."""
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            sha256 = hashlib.sha256(data).hexdigest()
+        else:
+            sha256 = sha256_file(data)
+        return {
+            "sha256": sha256,
+            "phash": perceptual_hash(data),
+        }
+
+    def _doc_id(self, user_id: str, sha256: str) -> str:
+        return f"{user_id}_{sha256}"
+
+    def _user_phashes(self, user_id: str) -> List[Tuple[int, Dict[str, Any]]]:
+        with self._lock:
+            if user_id in self._phashes:
+                self._phashes.move_to_end(user_id)
+                return self._phashes[user_id]
+        entries = []
+        for doc in self.db.collection(self.collection).where("userId", "==", user_id).stream():
+            data = doc.to_dict()
+            if data.get("phash"):
+                entries.append((int(data["phash"], 16), data))
+        with self._lock:
+            entries = self._phashes.setdefault(user_id, entries)
+            while len(self._phashes) > self.size:
+                self._phashes.popitem(last=False)
+            return entries
+
+    def find_duplicate(self, user_id: str, hashes: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Return the index entry of a byte-identical receipt plus match type and distance, or None."""
+        doc = self.db.collection(self.collection).document(self._doc_id(user_id, hashes["sha256"])).get()
+        if doc.exists:
+            return {**doc.to_dict(), "match": "exact", "distance": 0}
+        return None
+
+    def find_similar(self, user_id: str, hashes: Dict[str, Any], limit: int = DEDUP_MAX_CANDIDATES) -> List[Dict[str, Any]]:
+        """Index entries within threshold bits of the perceptual hash, nearest first: possible duplicates only."""
+        if self.threshold <= 0 or hashes.get("phash") is None:
+            return []
+        matches = []
+        for phash, entry in self._user_phashes(user_id):
+            distance = hamming_distance(phash, hashes["phash"])
+            if distance <= self.threshold:
+                matches.append({**entry, "match": "near", "distance": distance})
+        return sorted(matches, key=lambda match: match["distance"])[:limit]
+
+    def entry(self, user_id: str, hashes: Dict[str, Any], receipt_id: str, parsed_id: str):
+        """Return (document reference, data) for registering a receipt, e.g. inside a batch."""
+        data = {
+            "userId": user_id,
+            "sha256": hashes["sha256"],
+            "phash": format(hashes["phash"], "016x") if hashes.get("phash") is not None else None,
+            "receiptId": receipt_id,
+            "parsedId": parsed_id,
+            "createdAt": datetime.utcnow().isoformat(),
+        }
+        return self.db.collection(self.collection).document(self._doc_id(user_id, hashes["sha256"])), data
+
+    def remember(self, user_id: str, data: Dict[str, Any]):
+        """Add a committed entry to the in-process near-duplicate index."""
+        if not data.get("phash"):
+            return
+        with self._lock:
+            if user_id in self._phashes:
+                self._phashes[user_id].append((int(data["phash"], 16), data))
+
+
+class BatchHashes:
+    """
+    Exact hashes of the files in one bulk request, whose writes may not be committed
+    yet. The first file with a hash claims it; later copies wait until that file is
+    settled and are duplicates of it only if it was stored. If it was not (not a
+    receipt, a Gemini or write error), the claim is released and the next copy is
+    processed in its place.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # sha256 -> (receipt id of the claiming file, future resolved with whether it was stored)
+        self._claims: Dict[str, Tuple[str, Future]] = {}
+        self._owned: Dict[str, str] = {}
+
+    def claim(self, sha256: str, receipt_id: str) -> Optional[str]:
+        """None once receipt_id holds the claim, else the receipt id of the stored earlier copy"""
+        while True:
+            with self._lock:
+                claim = self._claims.get(sha256)
+                if claim is None:
+                    self._claims[sha256] = (receipt_id, Future())
+                    self._owned[receipt_id] = sha256
+                    return None
+            first, stored = claim
+            if stored.result():
+                return first
+
+    def settle(self, receipt_id: str, stored: bool):
+        """Record whether a claiming file was stored; a no-op for files that hold no claim"""
+        with self._lock:
+            sha256 = self._owned.pop(receipt_id, None)
+            if sha256 is None:
+                return
+            _, outcome = self._claims[sha256]
+            if not stored:
+                del self._claims[sha256]
+        outcome.set_result(stored)
@@ -0,0 +1,291 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Receipts without stored spend fields sent to Gemini per request; the rest are
+# counted with what can be parsed locally until a later request resolves them
+SPEND_FALLBACK_LIMIT = int(os.getenv("SPEND_FALLBACK_LIMIT", "8"))
+# Seconds a request waits for those extractions (they finish in the background)
+SPEND_FALLBACK_TIMEOUT = float(os.getenv("SPEND_FALLBACK_TIMEOUT", "5"))
+# Concurrent Gemini fallback extractions
+SPEND_FALLBACK_WORKERS = int(os.getenv("SPEND_FALLBACK_WORKERS", "4"))
+
+BUDGET_CATEGORIES = ["food", "transportation", "entertainment", "shopping", "healthcare", "utilities", "housing", "miscellaneous"]
+
+# Keywords in the free-form categories stored with each receipt, per budget category
+CATEGORY_KEYWORDS = {
+    "food": ["food", "grocer", "restaurant", "dining", "cafe", "coffee", "bakery", "supermarket", "meal", "beverage"],
+    "transportation": ["transport", "fuel", "gas station", "petrol", "taxi", "ride", "parking", "travel", "airline", "transit"],
+    "entertainment": ["entertainment", "movie", "cinema", "music", "game", "streaming", "event", "ticket"],
+    "healthcare": ["health", "pharmacy", "medical", "clinic", "hospital", "dental", "drug"],
+    "utilities": ["utilit", "electric", "water", "internet", "phone", "telecom", "mobile"],
+    "housing": ["housing", "rent", "home", "furniture", "hardware", "maintenance"],
+    "shopping": ["shopping", "retail", "clothing", "apparel", "electronics", "department", "store"],
+}
+
+# Categories of /generate_chart and /receipt_stats
+CHART_CATEGORIES = ["groceries", "utilities", "transportation", "dining", "travel", "reimbursement", "home"]
+
+# Keywords in a receipt's free-form categories per chart category, checked in this
+# order so that e.g. "restaurant food" is dining rather than groceries
+CHART_CATEGORY_KEYWORDS = {
+    "reimbursement": ["reimburs", "expense claim"],
+    "dining": ["restaurant", "dining", "cafe", "coffee", "meal", "fast food", "takeaway"],
+    "travel": ["travel", "airline", "flight", "hotel", "lodging"],
+    "transportation": ["transport", "fuel", "gas station", "petrol", "taxi", "ride", "parking", "transit"],
+    "utilities": ["utilit", "electric", "water", "internet", "phone", "telecom", "mobile"],
+    "groceries": ["grocer", "supermarket", "food", "produce", "bakery", "dairy", "beverage"],
+    "home": ["home", "housing", "rent", "furniture", "hardware", "maintenance", "household"],
+}
+
+# Chart category for a budget category when the free-form categories name none
+BUDGET_TO_CHART_CATEGORY = {"food": "groceries", "transportation": "transportation", "utilities": "utilities", "housing": "home"}
+
+# Receipt fields holding the amount paid, most specific first
+TOTAL_KEYS = ["grand_total", "total_amount", "totalamount", "total", "amount_paid", "payment_amount", "tender", "amount"]
+
+# Receipt fields naming the merchant, most specific first
+VENDOR_KEYS = ["vendor", "vendor_name", "merchant", "merchant_name", "store", "store_name", "business_name"]
+
+# Receipt fields holding the purchase date, most specific first
+DATE_KEYS = ["transaction_date", "purchase_date", "receipt_date", "invoice_date", "date"]
+
+DATE_FORMATS = ["%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%m/%d/%Y", "%d %b %Y", "%d %B %Y", "%b %d, %Y", "%B %d, %Y"]
+
+AMOUNT_PATTERN = re.compile(r"-?\d[\d,]*(?:\.\d+)?")
+
+
+def to_amount(value) -> Optional[float]:
+    """A number or a string like "$1,234.50" as a float; None if there is none"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = AMOUNT_PATTERN.search(value)
+        if match:
+            try:
+                return float(match.group().replace(",", ""))
+            except ValueError:
+                return None
+    return None
+
+
+def _load_raw(raw) -> Optional[Any]:
+    """Gemini's parse output (JSON text, possibly fenced) as an object"""
+    if isinstance(raw, (dict, list)):
+        return raw
+    if not isinstance(raw, str) or not raw.strip():
+        return None
+    cleaned = re.sub(r"^```(?:json)?\s*|```$", "", raw.strip(), flags=re.MULTILINE).strip()
+    try:
+        return json.loads(cleaned)
+    except ValueError:
+        match = re.search(r"\{.*\}", cleaned, re.DOTALL)
+        if match:
+            try:
+                return json.loads(match.group())
+            except ValueError:
+                return None
+    return None
+
+
+def _find_totals(data, found: Dict[str, float], depth: int = 0):
+    if depth > 3:
+        return
+    if isinstance(data, dict):
+        for key, value in data.items():
+            name = str(key).lower().replace(" ", "_")
+            if name in TOTAL_KEYS and name not in found:
+                amount = to_amount(value)
+                if amount is not None and amount > 0:
+                    found[name] = amount
+            elif isinstance(value, dict):
+                _find_totals(value, found, depth + 1)
+
+
+def parse_total(raw) -> Optional[float]:
+    """The receipt total from its parsed data, without calling Gemini"""
+    found: Dict[str, float] = {}
+    _find_totals(_load_raw(raw), found)
+    for key in TOTAL_KEYS:
+        if key in found:
+            return found[key]
+    return None
+
+
+def parse_vendor(raw) -> Optional[str]:
+    """The merchant name from the receipt's parsed data, normalized; None if absent"""
+    data = _load_raw(raw)
+    if not isinstance(data, dict):
+        return None
+    fields = {str(key).lower().replace(" ", "_"): value for key, value in data.items()}
+    for key in VENDOR_KEYS:
+        value = fields.get(key)
+        if isinstance(value, dict):
+            value = value.get("name")
+        if isinstance(value, str) and value.strip():
+            return " ".join(value.lower().split())
+    return None
+
+
+def parse_receipt_date(raw) -> Optional[str]:
+    """The purchase date from the receipt's parsed data as YYYY-MM-DD (or the text as printed); None if absent"""
+    data = _load_raw(raw)
+    if not isinstance(data, dict):
+        return None
+    fields = {str(key).lower().replace(" ", "_"): value for key, value in data.items()}
+    for key in DATE_KEYS:
+        value = fields.get(key)
+        if not isinstance(value, str) or not value.strip():
+            continue
+        words = value.split()
+        # The date alone, without a time printed after it
+        candidates = [" ".join(words), words[0].split("T")[0], " ".join(words[:3])]
+        for text in candidates:
+            for date_format in DATE_FORMATS:
+                try:
+                    return datetime.strptime(text, date_format).date().isoformat()
+                except ValueError:
+                    continue
+        return " ".join(words).lower()
+    return None
+
+
+def spend_category(categories: Iterable[str]) -> Optional[str]:
+    """First budget category matching the receipt's free-form categories"""
+    for category in categories or []:
+        name = str(category).lower()
+        if name in BUDGET_CATEGORIES and name != "miscellaneous":
+            return name
+        for budget_category, keywords in CATEGORY_KEYWORDS.items():
+            if any(keyword in name for keyword in keywords):
+                return budget_category
+    return None
+
+
+def chart_category(receipt: Dict[str, Any]) -> Optional[str]:
+    """
+    Chart category of a receipts_parsed document from its stored free-form
+    categories, else its budget category; None if neither tells.
+    """
+    for category in receipt.get("categories") or []:
+        name = str(category).lower()
+        for chart, keywords in CHART_CATEGORY_KEYWORDS.items():
+            if name == chart or any(keyword in name for keyword in keywords):
+                return chart
+    return BUDGET_TO_CHART_CATEGORY.get(stored_spend(receipt).get("spendCategory"))
+
+
+def spend_fields(raw, categories: Iterable[str] = None, answer: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    totalAmount and spendCategory for a receipts_parsed document, from Gemini's
+    answer when it gave usable values and the parsed data otherwise. Only fields
+    that could be determined are returned.
+    """
+    answer = answer if isinstance(answer, dict) else {}
+    fields = {}
+    total = to_amount(answer.get("totalAmount"))
+    if total is None:
+        total = parse_total(raw)
+    if total is not None:
+        fields["totalAmount"] = total
+    category = str(answer.get("spendCategory") or "").lower()
+    if category not in BUDGET_CATEGORIES:
+        category = spend_category(categories)
+    if category:
+        fields["spendCategory"] = category
+    return fields
+
+
+def stored_spend(receipt: Dict[str, Any]) -> Dict[str, Any]:
+    """Spend fields of a receipts_parsed document: stored ones, else parsed locally"""
+    fields = {key: receipt[key] for key in ("totalAmount", "spendCategory") if receipt.get(key) is not None}
+    if len(fields) < 2:
+        local = spend_fields(receipt.get("parsedData", {}).get("raw", ""), receipt.get("categories"))
+        fields = {**local, **fields}
+    return fields
+
+
+class SpendExtractor:
+    """
+    Gemini fallback for receipts whose total or category is neither stored nor
+    parseable. Answers are cached by receipt text and written back to the
+    receipt, so each receipt is sent to Gemini at most once. resolve() submits at
+    most `limit` receipts and waits at most `timeout` seconds, so a request stays
+    bounded however many receipts are missing fields; unfinished extractions keep
+    running and are picked up by the next request.
+    """
+
+    def __init__(self, extract: Callable[[str, str], Tuple[float, Optional[str]]], limit: int = None,
+                 timeout: float = None, workers: int = None, size: int = 4096,
+                 collection: str = "receipts_parsed"):
+        self.extract = extract
+        self.limit = SPEND_FALLBACK_LIMIT if limit is None else limit
+        self.timeout = SPEND_FALLBACK_TIMEOUT if timeout is None else timeout
+        self.size = size
+        self.collection = collection
+        self._answers: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._running: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers or SPEND_FALLBACK_WORKERS)
+
+    @staticmethod
+    def _key(raw) -> str:
+        text = raw if isinstance(raw, str) else json.dumps(raw, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def cached(self, raw) -> Optional[Dict[str, Any]]:
+        key = self._key(raw)
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is not None:
+                self._answers.move_to_end(key)
+            return answer
+
+    def _remember(self, key: str, answer: Dict[str, Any]):
+        with self._lock:
+            self._answers[key] = answer
+            self._answers.move_to_end(key)
+            while len(self._answers) > self.size:
+                self._answers.popitem(last=False)
+
+    def _run(self, db, doc_id: str, raw, key: str) -> Dict[str, Any]:
+        try:
+            total, category = self.extract(doc_id, raw if isinstance(raw, str) else json.dumps(raw))
+            answer = {"totalAmount": total, "spendCategory": category if category in BUDGET_CATEGORIES else "miscellaneous"}
+            self._remember(key, answer)
+            if db is not None:
+                db.collection(self.collection).document(doc_id).update(answer)
+            return answer
+        finally:
+            with self._lock:
+                self._running.pop(key, None)
+
+    def resolve(self, db, pending: List[Tuple[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """{doc id: spend fields} for the (doc id, raw) pairs answered within the time limit"""
+        resolved, futures = {}, {}
+        for doc_id, raw in pending:
+            key = self._key(raw)
+            answer = self.cached(raw)
+            if answer is not None:
+                resolved[doc_id] = answer
+                continue
+            with self._lock:
+                future = self._running.get(key)
+                if future is None and len(futures) < self.limit:
+                    future = self._running[key] = self._pool.submit(self._run, db, doc_id, raw, key)
+            if future is not None:
+                futures[doc_id] = future
+        if futures:
+            wait(list(futures.values()), timeout=self.timeout)
+        for doc_id, future in futures.items():
+            if future.done() and future.exception() is None:
+                resolved[doc_id] = future.result()
+        return resolved
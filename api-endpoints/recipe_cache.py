@@ -0,0 +1,171 @@
+import os
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from inventory_updates import InventoryUpdateScheduler
+
+# Inventory sets whose recipes are kept in memory (entries are shared by all users with that set)
+RECIPE_CACHE_SIZE = int(os.getenv("RECIPE_CACHE_SIZE", "256"))
+# Days before cached recipes for an inventory set are generated again
+RECIPE_CACHE_TTL_DAYS = int(os.getenv("RECIPE_CACHE_TTL_DAYS", "7"))
+# Minimum Jaccard similarity for serving recipes of a near-identical inventory; 0 turns it off
+RECIPE_SIMILARITY_THRESHOLD = float(os.getenv("RECIPE_SIMILARITY_THRESHOLD", "0.85"))
+
+
+def inventory_key_items(names: Iterable[str]) -> List[str]:
+    """Sorted, de-duplicated, normalized item names: the set recipes depend on"""
+    return sorted({" ".join(str(name).lower().split()) for name in names if name and str(name).strip()})
+
+
+def inventory_fingerprint(items: List[str]) -> str:
+    """Stable hash of an inventory set (as returned by inventory_key_items)"""
+    return hashlib.sha256("\n".join(items).encode("utf-8")).hexdigest()
+
+
+class RecipeCache:
+    """
+    Recipe suggestions keyed by the fingerprint of an inventory set, so Gemini is
+    asked once per distinct set rather than on every /get_recipes call. Entries live
+    in memory (LRU) and in the `recipe_cache` collection, shared across users and
+    instances.
+
+    lookup() tries, in order: the exact set in memory, the exact set in Firestore,
+    the most similar set in memory (Jaccard >= threshold), and the user's previous
+    answer. The last two are served at once while the exact set is generated in the
+    background, as is any user's set when their inventory changes
+    (inventory_changed()).
+    """
+
+    def __init__(self, db=None, generate: Callable[[List[str]], Optional[List[Dict[str, Any]]]] = None,
+                 load_items: Callable[[str], List[str]] = None, size: int = None, ttl_days: int = None,
+                 similarity: float = None, collection: str = "recipe_cache"):
+        self.db = db
+        self.generate = generate
+        self.load_items = load_items
+        self.size = size or RECIPE_CACHE_SIZE
+        self.ttl = timedelta(days=RECIPE_CACHE_TTL_DAYS if ttl_days is None else ttl_days)
+        self.similarity = RECIPE_SIMILARITY_THRESHOLD if similarity is None else similarity
+        self.collection = collection
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._postings: Dict[str, set] = {}
+        self._users: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._refresher = InventoryUpdateScheduler(self.refresh, max_workers=1)
+
+    def _fresh(self, entry: Dict[str, Any]) -> bool:
+        return datetime.now(timezone.utc) - entry["createdAt"] < self.ttl
+
+    def _remember(self, fingerprint: str, entry: Dict[str, Any]):
+        with self._lock:
+            if fingerprint not in self._entries:
+                for item in entry["items"]:
+                    self._postings.setdefault(item, set()).add(fingerprint)
+            self._entries[fingerprint] = entry
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.size:
+                evicted, old = self._entries.popitem(last=False)
+                for item in old["items"]:
+                    self._postings.get(item, set()).discard(evicted)
+
+    def _most_similar(self, items: List[str]) -> Optional[tuple]:
+        """(similarity, fingerprint) of the closest fresh set in memory"""
+        shared = Counter()
+        with self._lock:
+            for item in items:
+                for fingerprint in self._postings.get(item, ()):
+                    shared[fingerprint] += 1
+            best = None
+            for fingerprint, overlap in shared.items():
+                entry = self._entries[fingerprint]
+                score = overlap / (len(items) + len(entry["items"]) - overlap)
+                if self._fresh(entry) and (best is None or score > best[0]):
+                    best = (score, fingerprint)
+        return best
+
+    def _load(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        if self.db is None:
+            return None
+        doc = self.db.collection(self.collection).document(fingerprint).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        entry = {"items": data["items"], "recipes": data["recipes"], "createdAt": data["createdAt"]}
+        self._remember(fingerprint, entry)
+        return entry
+
+    def lookup(self, user_id: Optional[str], names: Iterable[str]) -> Optional[Dict[str, Any]]:
+        """
+        Cached recipes for this inventory as {"recipes", "cache", "fingerprint", ...},
+        where "cache" is "exact", "similar" or "stale"; None on a miss.
+        """
+        items = inventory_key_items(names)
+        fingerprint = inventory_fingerprint(items)
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is not None:
+                self._entries.move_to_end(fingerprint)
+        if entry is None or not self._fresh(entry):
+            entry = self._load(fingerprint)
+        if entry is not None and self._fresh(entry):
+            self._point(user_id, fingerprint)
+            return {"recipes": entry["recipes"], "cache": "exact", "fingerprint": fingerprint}
+
+        result = None
+        if self.similarity > 0:
+            best = self._most_similar(items)
+            if best and best[0] >= self.similarity:
+                with self._lock:
+                    result = {"recipes": self._entries[best[1]]["recipes"], "cache": "similar",
+                              "similarity": round(best[0], 3), "fingerprint": best[1]}
+        if result is None and user_id:
+            with self._lock:
+                previous = self._entries.get(self._users.get(user_id))
+                if previous is not None:
+                    result = {"recipes": previous["recipes"], "cache": "stale", "fingerprint": self._users[user_id]}
+        if result is not None and user_id and self.generate and self.load_items:
+            self._refresher.request(user_id)
+        return result
+
+    def _point(self, user_id: Optional[str], fingerprint: str):
+        if user_id:
+            with self._lock:
+                self._users[user_id] = fingerprint
+
+    def store(self, user_id: Optional[str], names: Iterable[str], recipes: List[Dict[str, Any]]) -> str:
+        """Cache recipes generated for this inventory; returns its fingerprint"""
+        items = inventory_key_items(names)
+        fingerprint = inventory_fingerprint(items)
+        entry = {"items": items, "recipes": recipes, "createdAt": datetime.now(timezone.utc)}
+        self._remember(fingerprint, entry)
+        self._point(user_id, fingerprint)
+        if self.db is not None:
+            self.db.collection(self.collection).document(fingerprint).set({**entry, "fingerprint": fingerprint})
+        return fingerprint
+
+    def refresh(self, user_id: str):
+        """Generate and cache recipes for the user's current inventory unless they are cached"""
+        names = self.load_items(user_id)
+        items = inventory_key_items(names)
+        if not items:
+            return
+        fingerprint = inventory_fingerprint(items)
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+        if entry is None or not self._fresh(entry):
+            entry = self._load(fingerprint)
+        if entry is not None and self._fresh(entry):
+            self._point(user_id, fingerprint)
+            return
+        recipes = self.generate(items)
+        if recipes is not None:
+            self.store(user_id, items, recipes)
+
+    def inventory_changed(self, user_id: str):
+        """Regenerate in the background for users who have asked for recipes before"""
+        with self._lock:
+            known = user_id in self._users
+        if known and self.generate and self.load_items:
+            self._refresher.request(user_id)
@@ -0,0 +1,104 @@
+import os
+from datetime import date
+from typing import Any, Dict, List
+
+import numpy as np
+
+from shelf_life import shelf_life_days
+
+# Items predicted to run out within this many days go on the shopping list
+REPLENISH_HORIZON_DAYS = int(os.getenv("REPLENISH_HORIZON_DAYS", "7"))
+# Longest list /generate-shopping-list returns
+SHOPPING_LIST_MAX_ITEMS = int(os.getenv("SHOPPING_LIST_MAX_ITEMS", "12"))
+
+NO_DATE = np.datetime64("NaT", "D")
+
+
+def _to_day(value) -> np.datetime64:
+    """First 10 characters of an ISO date or timestamp as a day, NaT if unusable"""
+    try:
+        return np.datetime64(str(value)[:10], "D")
+    except ValueError:
+        return NO_DATE
+
+
+def _purchases(item: Dict[str, Any]) -> int:
+    """Number of purchases of an inventory item (see predict_depletion)"""
+    if item.get("purchase_dates"):
+        return len(set(item["purchase_dates"]))
+    return int(item.get("purchases") or item.get("count") or 0)
+
+
+def predict_depletion(inventory: List[Dict[str, Any]], today: date = None) -> Dict[str, np.ndarray]:
+    """
+    Vectorized depletion forecast for inventory documents.
+
+    The purchase interval of an item bought more than once is the average gap
+    between its first and last purchase, (last - first) / (purchases - 1), where
+    purchases counts the distinct days it was bought on (`purchase_dates`, else
+    the `purchases` counter). `count` is units on hand, which /consume_inventory
+    decrements, so it is only used for documents written before purchases were
+    tracked. Items bought once fall back to their shelf life. An item runs out
+    at its last purchase plus one interval, or at its expiry date if that comes first.
+    """
+    today = np.datetime64(today or date.today(), "D")
+    first = np.array([_to_day(item.get("first_bought_date")) for item in inventory], dtype="datetime64[D]")
+    last = np.array([_to_day(item.get("last_bought_date")) for item in inventory], dtype="datetime64[D]")
+    expiry = np.array([_to_day(item.get("expiryDate")) if item.get("expiryDate") else NO_DATE
+                       for item in inventory], dtype="datetime64[D]")
+    purchases = np.array([max(_purchases(item), 1) for item in inventory], dtype=np.int64)
+    quantity = np.array([float(item.get("quantity") or 0) for item in inventory], dtype=np.float64)
+    shelf_life = np.array([shelf_life_days(item.get("item_name", ""))[0] for item in inventory], dtype=np.float64)
+
+    span = (last - first).astype(np.float64)
+    repeat = (purchases > 1) & ~np.isnat(first) & ~np.isnat(last) & (span > 0)
+    interval = np.where(repeat, span / np.maximum(purchases - 1, 1), shelf_life)
+    depletion = last + np.rint(interval).astype(np.int64).astype("timedelta64[D]")
+    by_expiry = ~np.isnat(expiry) & (np.isnat(depletion) | (expiry < depletion))
+    depletion = np.where(by_expiry, expiry, depletion)
+    return {
+        "interval": interval,
+        "depletion": depletion,
+        "days_left": np.where(np.isnat(depletion), np.nan, (depletion - today).astype(np.float64)),
+        "repeat": repeat,
+        "by_expiry": by_expiry,
+        "per_purchase": np.where(quantity > 0, quantity / purchases, 1.0),
+        "purchases": purchases,
+    }
+
+
+def replenishment_list(inventory: List[Dict[str, Any]], horizon_days: int = None,
+                       max_items: int = None, today: date = None) -> List[Dict[str, Any]]:
+    """Items predicted to run out within the horizon (or recently run out), soonest first"""
+    if not inventory:
+        return []
+    horizon = REPLENISH_HORIZON_DAYS if horizon_days is None else horizon_days
+    forecast = predict_depletion(inventory, today)
+    days_left = forecast["days_left"]
+    # Items overdue by more than one interval are taken as no longer bought
+    due = np.flatnonzero(~np.isnan(days_left) & (days_left <= horizon) & (days_left >= -forecast["interval"]))
+    # Soonest first; among equals, items bought more often first
+    order = due[np.lexsort((-forecast["purchases"][due], days_left[due]))]
+
+    items = []
+    for i in order[:max_items or SHOPPING_LIST_MAX_ITEMS]:
+        item = inventory[i]
+        if forecast["by_expiry"][i]:
+            reason = "expiry"
+        elif forecast["repeat"][i]:
+            reason = "purchase_interval"
+        else:
+            reason = "shelf_life"
+        items.append({
+            "item_name": item.get("item_name", ""),
+            "predicted_depletion_date": str(forecast["depletion"][i]),
+            "days_until_depletion": int(days_left[i]),
+            "purchase_interval_days": round(float(forecast["interval"][i]), 1),
+            "purchases": int(forecast["purchases"][i]),
+            "suggested_quantity": round(float(forecast["per_purchase"][i]), 2),
+            "unit": item.get("unit"),
+            "last_price": item.get("last_price"),
+            "confidence": "high" if forecast["purchases"][i] >= 3 else "medium" if forecast["repeat"][i] else "low",
+            "reason": reason,
+        })
+    return items
@@ -5,11 +5,19 @@ from fastmcp import FastMCP
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
 import google.generativeai as genai
+from google.api_core.exceptions import FailedPrecondition
 from datetime import datetime
 from dotenv import load_dotenv
 import re
 import json
 import io
+import time
+import asyncio
+import threading
+import zipfile
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from PIL import Image
 from typing import List, Dict, Any
 import numpy as np
@@ -17,15 +25,37 @@ from sentence_transformers import SentenceTransformer
 import faiss
 from email_service import EmailService
 from api_methods.get_inventories_data import get_inventories_data
-from api_methods.get_recipes import get_recipes
+from api_methods.get_recipes import get_recipes, generate_recipes_with_gemini, load_inventory_item_names
 from api_methods.retrieve_expirations_data import retrieve_expirations_data
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse
 import tempfile
 import shutil
 from live_ai_service import LiveAIService
 from news_service import NewsService
-from api_methods.budget_insights_data import budget_insights_data
+from api_methods.budget_insights_data import budget_insights_data, resolved_spend
 from wallet import create_wallet_pass
+from image_preprocessing import preprocess_receipt_image, FORMAT_INFO, RECEIPT_IMAGE_FORMAT
+from document_pages import split_document, encode_segments, segment_thumbnail, segment_overlaps, merge_extractions, is_pdf
+from receipt_dedup import ReceiptHashIndex, BatchHashes, receipt_identity, same_receipt
+from item_canonicalizer import ItemCanonicalizer
+from shelf_life import has_printed_expiry, estimate_expiry_date
+from inventory_updates import InventoryUpdateScheduler, INVENTORY_AUTO_UPDATE
+from firestore_batch import BatchWriter
+from inventory_store import user_inventory, inventory_item_ref, expiry_timestamp
+from expiry_cache import ExpiryCache
+from expiry_notifications import ExpiryNotifier, EXPIRY_NOTIFICATIONS_ENABLED
+from recipe_cache import RecipeCache
+from replenishment import replenishment_list, REPLENISH_HORIZON_DAYS
+from spending_analytics import SpendingTable, SOURCE_RECEIPT
+from receipt_spend import spend_fields, stored_spend, parse_vendor, chart_category, BUDGET_CATEGORIES, CHART_CATEGORIES
+from spending_store import receipt_timestamp, expense_timestamp
+from spending_rollups import record_receipt, record_expense
+from spending_forecast import SpendingForecaster
+from spending_alerts import SpendingAlerts, SPEND_ALERTS_ENABLED
+from upload_spooling import spool_file, as_file, file_size, UploadTooLarge, STORAGE_CHUNK_SIZE, UPLOAD_SPOOL_THRESHOLD
+from language_detection import detect_language, detect_language_with_confidence
+from ingestion_queue import IngestionQueue, LocalJobStore, FirestoreJobStore, callback_allowed
+from translation_service import TranslationService, MyMemoryProvider, StubTranslationProvider
 import requests
 
 # Load environment variables from .env
@@ -52,6 +82,44 @@ genai.configure(api_key=GEMINI_API_KEY)
 # Initialize sentence transformer for embeddings
 embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
 
+def mark_upload_failed(job: dict):
+    """Ingestion queue hook: a receipt whose job failed is no longer left queued"""
+    ref = db.collection("receipts_raw").document(job["receiptId"])
+    snapshot = ref.get()
+    if snapshot.exists and snapshot.get("status") == "queued":
+        ref.update({"status": "failed", "error": job.get("error")})
+
+# Background ingestion for async uploads (INGESTION_QUEUE_BACKEND=local keeps jobs in memory)
+ingestion_queue = IngestionQueue(
+    store=LocalJobStore() if os.getenv("INGESTION_QUEUE_BACKEND") == "local" else FirestoreJobStore(),
+    on_failed=mark_upload_failed
+)
+
+# Per-user receipt hash index for duplicate detection
+receipt_hash_index = ReceiptHashIndex(db)
+# Local item-name canonicalization; Gemini is only asked about names it has never seen
+item_canonicalizer = ItemCanonicalizer(db)
+# "combined" extracts all items of a receipt in one Gemini call; "per_item" uses the older per-item calls
+INVENTORY_EXTRACTION_MODE = os.getenv("INVENTORY_EXTRACTION_MODE", "combined").lower()
+# Times a receipt that changed while its inventory was being applied is re-read and applied again
+INVENTORY_APPLY_ATTEMPTS = 3
+
+# Storage folder async uploads are staged in until their job has stored the processed receipt
+RECEIPT_STAGING_FOLDER = "receipts_staging"
+
+# Bulk upload limits
+BULK_UPLOAD_CONCURRENCY = int(os.getenv("BULK_UPLOAD_CONCURRENCY", "4"))
+BULK_UPLOAD_MAX_FILES = int(os.getenv("BULK_UPLOAD_MAX_FILES", "200"))
+# Largest receipt accepted from inside a zip archive (uncompressed)
+BULK_ZIP_MAX_ENTRY_BYTES = int(os.getenv("BULK_ZIP_MAX_ENTRY_BYTES", str(25 * 1024 * 1024)))
+# Total uncompressed size of the receipts expanded from one bulk request's archives
+BULK_ZIP_MAX_TOTAL_BYTES = int(os.getenv("BULK_ZIP_MAX_TOTAL_BYTES", str(500 * 1024 * 1024)))
+
+# Shared pool for upload stages that can overlap (Storage upload vs Gemini parse)
+upload_stage_executor = ThreadPoolExecutor(max_workers=int(os.getenv("UPLOAD_STAGE_WORKERS", "8")), thread_name_prefix="upload-stage")
+# Pages of multi-page PDFs and tiles of tall receipts are extracted concurrently
+document_page_executor = ThreadPoolExecutor(max_workers=int(os.getenv("DOCUMENT_PAGE_WORKERS", "4")), thread_name_prefix="document-page")
+
 # In-memory conversation storage (in production, use Redis or database)
 conversations = {}
 
@@ -60,6 +128,12 @@ user_rag_cache = {}  # user_id: { 'index': ..., 'embeddings': ..., 'receipts_dat
 
 # Translation service configuration
 TRANSLATION_API_URL = "https://api.mymemory.translated.net/get"
+translation_service = TranslationService(
+    provider=StubTranslationProvider() if os.getenv("TRANSLATION_PROVIDER") == "stub" else MyMemoryProvider(
+        api_url=TRANSLATION_API_URL,
+        timeout=float(os.getenv("TRANSLATION_TIMEOUT_SECONDS", "3"))
+    )
+)
 
 # Available languages for the chatbot (5 Indian languages + English)
 AVAILABLE_LANGUAGES = {
@@ -73,7 +147,7 @@ AVAILABLE_LANGUAGES = {
 
 def translate_text(text: str, target_lang: str, source_lang: str = 'auto') -> str:
     """
-    Translate text to target language using MyMemory Translation API
+    Translate text to target language using the cached, batched translation service
     
     Args:
         text: Text to translate
@@ -87,24 +161,7 @@ def translate_text(text: str, target_lang: str, source_lang: str = 'auto') -> st
         # If target language is English or same as source, return original text
         if target_lang == 'en' or target_lang == source_lang:
             return text
-        
-        # Use MyMemory Translation API
-        params = {
-            'q': text,
-            'langpair': f"{source_lang}|{target_lang}" if source_lang != 'auto' else f"auto|{target_lang}"
-        }
-        
-        response = requests.get(TRANSLATION_API_URL, params=params, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        if data.get('responseStatus') == 200:
-            translated_text = data['responseData']['translatedText']
-            return translated_text
-        else:
-            print(f"Translation API error: {data.get('responseDetails', 'Unknown error')}")
-            return text
-            
+        return translation_service.translate(text, target_lang, source_lang)
     except Exception as e:
         print(f"Translation error: {e}")
         return text
@@ -185,78 +242,6 @@ def get_follow_up_chips(language: str) -> list:
     }
     return chips.get(language, chips["en"])
 
-def detect_language(text: str) -> str:
-    """
-    Detect the language of the input text using simple heuristics for Indian languages
-    
-    Args:
-        text: Text to detect language for
-    
-    Returns:
-        Language code (e.g., 'en', 'hi', 'ta', 'te', 'bn', 'mr') or 'en' as fallback
-    """
-    try:
-        # Simple language detection using common patterns for Indian languages
-        text_lower = text.lower()
-        
-        # Hindi patterns (Devanagari script)
-        hindi_patterns = ['नमस्ते', 'कैसे', 'हैं', 'धन्यवाद', 'कृपया', 'अलविदा', 'सुप्रभात', 'शुभ रात्रि', 'हाँ', 'नहीं']
-        if any(pattern in text_lower for pattern in hindi_patterns):
-            return 'hi'
-        
-        # Tamil patterns (Tamil script)
-        tamil_patterns = ['வணக்கம்', 'எப்படி', 'உள்ளீர்கள்', 'நன்றி', 'தயவுசெய்து', 'பிரியாவிடை', 'காலை வணக்கம்', 'இரவு வணக்கம்']
-        if any(pattern in text_lower for pattern in tamil_patterns):
-            return 'ta'
-        
-        # Telugu patterns (Telugu script)
-        telugu_patterns = ['నమస్కారం', 'ఎలా', 'ఉన్నారు', 'ధన్యవాదాలు', 'దయచేసి', 'వీడ్కోలు', 'శుభోదయం', 'శుభ రాత్రి']
-        if any(pattern in text_lower for pattern in telugu_patterns):
-            return 'te'
-        
-        # Bengali patterns (Bengali script)
-        bengali_patterns = ['নমস্কার', 'কেমন', 'আছেন', 'ধন্যবাদ', 'অনুগ্রহ করে', 'বিদায়', 'সুপ্রভাত', 'শুভ রাত্রি']
-        if any(pattern in text_lower for pattern in bengali_patterns):
-            return 'bn'
-        
-        # Marathi patterns (Devanagari script)
-        marathi_patterns = ['नमस्कार', 'कसे', 'आहात', 'धन्यवाद', 'कृपया', 'निरोप', 'सुप्रभात', 'शुभ रात्री', 'होय', 'नाही']
-        if any(pattern in text_lower for pattern in marathi_patterns):
-            return 'mr'
-        
-        # Check for Devanagari script (Hindi/Marathi)
-        devanagari_chars = sum(1 for char in text if '\u0900' <= char <= '\u097F')
-        if devanagari_chars > len(text) * 0.3:
-            # Try to distinguish between Hindi and Marathi
-            if any(word in text_lower for word in ['हैं', 'कैसे', 'नमस्ते']):
-                return 'hi'
-            elif any(word in text_lower for word in ['आहात', 'कसे', 'नमस्कार']):
-                return 'mr'
-            else:
-                return 'hi'  # Default to Hindi for Devanagari
-        
-        # Check for Tamil script
-        tamil_chars = sum(1 for char in text if '\u0B80' <= char <= '\u0BFF')
-        if tamil_chars > len(text) * 0.3:
-            return 'ta'
-        
-        # Check for Telugu script
-        telugu_chars = sum(1 for char in text if '\u0C00' <= char <= '\u0C7F')
-        if telugu_chars > len(text) * 0.3:
-            return 'te'
-        
-        # Check for Bengali script
-        bengali_chars = sum(1 for char in text if '\u0980' <= char <= '\u09FF')
-        if bengali_chars > len(text) * 0.3:
-            return 'bn'
-        
-        # Default to English
-        return 'en'
-            
-    except Exception as e:
-        print(f"Language detection error: {e}")
-        return 'en'
-
 def upload_to_firebase(file: UploadFile, user_id: str, receipt_id: str):
     ext = file.filename.split('.')[-1]
     blob = bucket.blob(f"receipts_raw/{user_id}/{receipt_id}.{ext}")
@@ -264,9 +249,14 @@ def upload_to_firebase(file: UploadFile, user_id: str, receipt_id: str):
     blob.make_public()
     return blob.public_url
 
-def verify_and_parse_with_gemini(image_bytes):
-    # Upload the image to Gemini first
-    image = Image.open(io.BytesIO(image_bytes)) # or "image/png" as per your input
+def verify_and_parse_with_gemini(image_bytes, mime_type: str = None):
+    # Preprocessed images are already encoded at the size we want, so send the
+    # bytes as-is instead of letting the SDK re-encode a PIL image
+    if mime_type:
+        image = {"mime_type": mime_type, "data": image_bytes}
+    else:
+        # Accepts bytes or a file object (e.g. the spooled upload), decoded in place
+        image = Image.open(as_file(image_bytes)) # or "image/png" as per your input
 
     model = genai.GenerativeModel("gemini-2.0-flash")
     prompt = (
@@ -279,6 +269,45 @@ def verify_and_parse_with_gemini(image_bytes):
     answer = result.text.strip()
     return {"raw": answer}
 
+def extract_segment_with_gemini(segment_bytes: bytes, index: int, count: int, segment_type: str):
+    """Extract one page or tile of a longer receipt as JSON. Returns None if it has no receipt content."""
+    part = "page" if segment_type == "pdf_pages" else "section (sections overlap slightly)"
+    prompt = (
+        f"This image is {part} {index + 1} of {count} of one receipt, bill, or invoice. "
+        "Extract what is visible on it as a JSON object with the fields vendor, date, currency, "
+        "items (list of objects with name, quantity, unit_price, total_price, and y: where the line is on this image, "
+        "from 0 at the top to 1 at the bottom), subtotal, tax, discount and total. "
+        "Use null for fields that are not on this part. Return ONLY the JSON object, without markdown. "
+        "If it contains no receipt content at all, reply with 'not a receipt'."
+    )
+    model = genai.GenerativeModel("gemini-2.0-flash")
+    result = model.generate_content([prompt, {"mime_type": FORMAT_INFO[RECEIPT_IMAGE_FORMAT][1], "data": segment_bytes}])
+    answer = result.text.strip()
+    if "not a receipt" in answer.lower():
+        return None
+    try:
+        cleaned = re.sub(r"^```(?:json)?\s*|```$", "", answer, flags=re.MULTILINE).strip()
+        return json.loads(cleaned)
+    except Exception:
+        print(f"Could not parse {segment_type} segment {index + 1} as JSON.")
+        return None
+
+def extract_document_with_gemini(segment_type: str, segments: List[bytes], overlaps: list = None):
+    """
+    Extract every page or tile concurrently and merge them into one receipt.
+    overlaps (from segment_overlaps) tells the merge where tiles repeat each other.
+    Returns the same {"raw": ...} shape as verify_and_parse_with_gemini.
+    """
+    count = len(segments)
+    extractions = list(document_page_executor.map(
+        lambda indexed: extract_segment_with_gemini(indexed[1], indexed[0], count, segment_type),
+        enumerate(segments)
+    ))
+    merged = merge_extractions(extractions, segment_type, overlaps)
+    if merged is None:
+        return {"raw": "not a receipt"}
+    return {"raw": json.dumps(merged), "segments": merged["segments"]}
+
 def get_user_receipts_embeddings(user_id: str) -> List[Dict[str, Any]]:
     """Get user's parsed receipts and create embeddings for RAG"""
     try:
@@ -467,12 +496,13 @@ async def translate_endpoint(
     """Translate text to target language"""
     try:
         translated_text = translate_text(text, target_language, source_language)
-        detected_lang = detect_language(text)
+        detected_lang, confidence = detect_language_with_confidence(text)
         
         return {
             "original_text": text,
             "translated_text": translated_text,
             "source_language": detected_lang,
+            "source_language_confidence": confidence,
             "target_language": target_language
         }
     except Exception as e:
@@ -566,7 +596,7 @@ async def chatbot_endpoint(
             receipts_data = cache['receipts_data']
         # --- Caching logic end ---
         # Handle multilingual support
-        detected_lang = detect_language(message)
+        detected_lang, detected_confidence = detect_language_with_confidence(message)
         original_message = message
         
         # Translate message to English for processing if not already in English
@@ -605,6 +635,7 @@ async def chatbot_endpoint(
             "response": response,
             "language": language,
             "detected_language": detected_lang,
+            "detected_language_confidence": detected_confidence,
             "relevant_receipts_count": len(relevant_receipts),
             "total_receipts": len(receipts_data),
             "thinking_text": get_thinking_text(language),
@@ -722,110 +753,608 @@ async def send_chatbot_email(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def storage_path(filename: str, user_id: str, receipt_id: str, folder: str = "receipts_raw") -> str:
+    """Storage object name of a receipt file; the extension is taken from filename"""
+    ext = filename.split('.')[-1]
+    return f"{folder}/{user_id}/{receipt_id}.{ext}"
+
+def upload_bytes_to_firebase(image_bytes, filename: str, content_type: str, user_id: str, receipt_id: str, folder: str = "receipts_raw"):
+    """
+    Upload bytes or a seekable file object (e.g. a spooled upload) to Firebase Storage
+    and return its public URL. Files larger than STORAGE_CHUNK_SIZE are sent as a
+    chunked resumable upload straight from the file, without reading it into memory.
+    """
+    blob = bucket.blob(storage_path(filename, user_id, receipt_id, folder))
+    if isinstance(image_bytes, (bytes, bytearray)):
+        blob.upload_from_string(image_bytes, content_type=content_type)
+    else:
+        size = file_size(image_bytes)
+        if size > STORAGE_CHUNK_SIZE:
+            blob.chunk_size = STORAGE_CHUNK_SIZE
+        image_bytes.seek(0)
+        blob.upload_from_file(image_bytes, content_type=content_type, size=size)
+        image_bytes.seek(0)
+    blob.make_public()
+    return blob.public_url
+
+def delete_from_firebase(filename: str, user_id: str, receipt_id: str, folder: str = "receipts_raw"):
+    """Delete a receipt file uploaded by upload_to_firebase or upload_bytes_to_firebase"""
+    bucket.blob(storage_path(filename, user_id, receipt_id, folder)).delete()
+
+def categorize_with_gemini(parsed_raw: str):
+    """
+    Ask Gemini for free-form categories and extra fields of a parsed receipt, and
+    for the total and budget category that spending analytics read.
+    Returns: (categories list, extraFields dict, spend fields dict)
+    """
+    model = genai.GenerativeModel("gemini-2.5-flash-lite")
+    prompt2 = (
+        "Given the following parsed receipt data, assign one or more categories (e.g., 'grocery', 'electronics', 'restaurant', 'pharmacy', 'utility', etc.) "
+        "based on the vendor, items, and any other relevant fields. "
+        "Also give the total amount paid as 'totalAmount' (a number, no currency symbols) and the single best budget category as 'spendCategory' "
+        f"(one of: {', '.join(BUDGET_CATEGORIES)}). "
+        "Return ONLY a valid JSON object with a 'categories' field (list of strings), 'totalAmount', 'spendCategory', and any extra fields as 'extraFields' (dict of any additional key-value pairs). "
+        "Do not include any explanation, markdown, or code block—just the JSON object.\n\n"
+        "Parsed data:\n" + parsed_raw
+    )
+    result2 = model.generate_content([prompt2])
+    answer2 = result2.text.strip()
+    print("Step 5: Gemini categories/tags result:", answer2)
+    categories = []
+    extra_fields = {}
+    parsed_json = {}
+    try:
+        cleaned = re.sub(r"^```(?:json)?\s*|```$", "", answer2.strip(), flags=re.MULTILINE).strip()
+        parsed_json = json.loads(cleaned)
+        categories = parsed_json.get("categories", [])
+        extra_fields = parsed_json.get("extraFields", {})
+    except Exception:
+        print("Could not parse categories/extraFields as JSON.")
+    return categories, extra_fields, spend_fields(parsed_raw, categories, parsed_json)
+
+def confirm_duplicate(candidates: list, parsed_raw: str, total):
+    """The first possible duplicate whose stored receipt has the same total, vendor and date, or None"""
+    identity = receipt_identity(parsed_raw, total)
+    refs = [db.collection("receipts_parsed").document(candidate["parsedId"]) for candidate in candidates]
+    existing = {doc.id: doc.to_dict() for doc in db.get_all(refs) if doc.exists}
+    for candidate in candidates:
+        receipt = existing.get(candidate["parsedId"])
+        if receipt and same_receipt(identity, receipt_identity(receipt.get("parsedData", {}).get("raw", ""),
+                                                               stored_spend(receipt).get("totalAmount"))):
+            return candidate
+    return None
+
+def process_receipt_upload(
+    receipt_file,
+    user_id: str,
+    receipt_id: str,
+    filename: str,
+    content_type: str,
+    notes: str = None,
+    queued: bool = False,
+    allow_duplicate: bool = False,
+    write_buffer=None,
+    batch_hashes: BatchHashes = None
+):
+    """
+    Parse, categorize and store a receipt. Used by /upload directly and by the
+    ingestion workers in async mode, where a receipts_raw doc with status
+    "queued" already exists (queued=True). Both store the same artifact: the
+    preprocessed image, or the file as uploaded when it cannot be preprocessed.
+    receipt_file is a seekable file object (the spooled upload) or bytes; it is
+    only read in full when it cannot be preprocessed.
+
+    Stages run as a small DAG:
+                                ┌─> storage + thumbnail upload ───────────────┐
+        preprocess ──> dedup ───┤                                             ├──> one batched Firestore write
+                                └─> Gemini parse ──> Gemini categorize ───────┘
+    A duplicate of an existing receipt short-circuits to that receipt unless
+    allow_duplicate: the same SHA-256 before parsing, or a perceptual hash within
+    DEDUP_PHASH_THRESHOLD bits whose parsed total, vendor and date also match.
+    When write_buffer (a WriteGroup) is given the Firestore writes are added to it instead of committed;
+    batch_hashes (shared by a bulk request) then catches exact duplicates whose writes
+    are still uncommitted. The caller settles this receipt's claim once it is done.
+    Per-stage timings (ms) are returned under "timings".
+    """
+    timings = {}
+    pipeline_start = time.perf_counter()
+
+    def timed(stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings[stage] = round((time.perf_counter() - start) * 1000, 1)
+
+    receipt_file = as_file(receipt_file)
+    original_size = file_size(receipt_file)
+    # Step 3a: Multi-page PDFs and tall invoices are extracted page by page / tile by tile
+    document = timed("split_document", split_document, receipt_file)
+    segments = None
+    preprocessed = None
+    thumbnail_bytes, thumbnail_type = None, FORMAT_INFO[RECEIPT_IMAGE_FORMAT][1]
+    if document:
+        segment_type, segment_images = document
+        segments = timed("encode_segments", encode_segments, segment_images)
+        thumbnail_bytes = segment_thumbnail(segment_images[0])
+        overlaps = segment_overlaps(segment_images)
+        del segment_images
+        print(f"Step 3a: Split into {len(segments)} {segment_type}")
+    else:
+        # Step 3b: Fix orientation, downscale and re-encode (None for PDFs and other non-images)
+        preprocessed = timed("preprocess", preprocess_receipt_image, receipt_file)
+    if preprocessed:
+        model_bytes, model_mime = preprocessed["model_bytes"], preprocessed["mime_type"]
+        storage_bytes, storage_type = preprocessed["storage_bytes"], preprocessed["mime_type"]
+        thumbnail_bytes = preprocessed["thumbnail_bytes"]
+        stored_filename = f"{receipt_id}.{preprocessed['ext']}"
+    else:
+        # Documents and files we cannot preprocess are stored as uploaded, streamed from the file
+        model_bytes, model_mime = b"", None
+        if not segments:
+            # Gemini needs the content inline; it reads PDFs natively
+            model_mime = "application/pdf" if is_pdf(receipt_file) else None
+            receipt_file.seek(0)
+            model_bytes = receipt_file.read()
+            receipt_file.seek(0)
+        storage_bytes, storage_type = receipt_file, content_type
+        stored_filename = filename
+    def duplicate_result(duplicate):
+        print(f"Step 3c: Duplicate of receipt {duplicate['receiptId']} ({duplicate['match']}, distance {duplicate['distance']})")
+        if queued:
+            db.collection("receipts_raw").document(receipt_id).update({
+                "status": "duplicate",
+                "duplicateOf": duplicate["receiptId"]
+            })
+        existing = db.collection("receipts_parsed").document(duplicate["parsedId"]).get()
+        return {
+            "receiptId": duplicate["receiptId"],
+            "status": "duplicate",
+            "duplicate": {
+                "match": duplicate["match"],
+                "distance": duplicate["distance"],
+                "rejectedReceiptId": receipt_id
+            },
+            "mediaUrl": existing.get("mediaUrl") if existing.exists else None,
+            "parsedDoc": existing.to_dict() if existing.exists else None,
+            "timings": timings
+        }
+
+    # Step 3c: Skip re-uploads of a receipt this user already has
+    hashes = timed("hash", receipt_hash_index.compute, storage_bytes)
+    similar = []
+    if not allow_duplicate:
+        duplicate = timed("dedup_lookup", receipt_hash_index.find_duplicate, user_id, hashes)
+        if duplicate:
+            return duplicate_result(duplicate)
+        if batch_hashes is not None:
+            first = batch_hashes.claim(hashes["sha256"], receipt_id)
+            if first:
+                print(f"Step 3c: Duplicate of receipt {first} earlier in this upload")
+                return {
+                    "receiptId": first,
+                    "status": "duplicate",
+                    "duplicate": {"match": "exact", "distance": 0, "inRequest": True, "rejectedReceiptId": receipt_id},
+                    "timings": timings
+                }
+        similar = timed("dedup_similar", receipt_hash_index.find_similar, user_id, hashes)
+    # Step 4 + 7: Storage uploads do not depend on the parse, so start them first
+    thumbnail_future = None
+    storage_future = upload_stage_executor.submit(
+        timed, "storage_upload", upload_bytes_to_firebase, storage_bytes, stored_filename, storage_type, user_id, receipt_id
+    )
+    if thumbnail_bytes:
+        thumbnail_filename = f"{receipt_id}.{FORMAT_INFO[RECEIPT_IMAGE_FORMAT][2]}"
+        thumbnail_future = upload_stage_executor.submit(
+            timed, "thumbnail_upload", upload_bytes_to_firebase, thumbnail_bytes, thumbnail_filename,
+            thumbnail_type, user_id, receipt_id, "receipts_thumb"
+        )
+    if segments:
+        parsed = timed("gemini_parse", extract_document_with_gemini, segment_type, segments, overlaps)
+    else:
+        parsed = timed("gemini_parse", verify_and_parse_with_gemini, model_bytes, model_mime)
+    print("Step 4: Gemini verification and parse result:", parsed["raw"])
+    if "not a receipt" in parsed["raw"].lower():
+        print("Step 4b: Not a receipt, aborting upload")
+        # Remove the speculatively uploaded file
+        storage_future.result()
+        delete_from_firebase(stored_filename, user_id, receipt_id)
+        if queued:
+            db.collection("receipts_raw").document(receipt_id).update({"status": "rejected"})
+        if thumbnail_future:
+            thumbnail_future.result()
+            delete_from_firebase(thumbnail_filename, user_id, receipt_id, "receipts_thumb")
+        return {"error": "The uploaded document is not recognized as a receipt. Please upload a valid receipt."}
+    # Step 5: Gemini call for categories/tags (overlaps with the storage upload)
+    categories, extra_fields, spend = timed("gemini_categorize", categorize_with_gemini, parsed["raw"])
+    # Step 5b: A perceptual near-match is only a duplicate if the parsed total, vendor and date agree
+    if similar:
+        duplicate = timed("dedup_confirm", confirm_duplicate, similar, parsed["raw"], spend.get("totalAmount"))
+        if duplicate:
+            storage_future.result()
+            delete_from_firebase(stored_filename, user_id, receipt_id)
+            if thumbnail_future:
+                thumbnail_future.result()
+                delete_from_firebase(thumbnail_filename, user_id, receipt_id, "receipts_thumb")
+            return duplicate_result(duplicate)
+    media_url = storage_future.result()
+    print("Step 7: Uploaded to Firebase, media_url:", media_url)
+    thumbnail_url = thumbnail_future.result() if thumbnail_future else None
+    # Step 6 + 8: Store parsed and raw receipt docs in one batched write
+    parsed_id = str(uuid.uuid4())
+    timestamp = datetime.utcnow().isoformat()
+    parsed_doc = {
+        "parsedId": parsed_id,
+        "receiptId": receipt_id,
+        "userId": user_id,
+        "timestamp": timestamp,
+        "createdAt": receipt_timestamp(timestamp),
+        "vendor": None,
+        "mediaUrl": media_url,
+        "thumbnailUrl": thumbnail_url,
+        "parsedData": parsed,
+        "walletPassGenerated": False,
+        "geminiRawOutput": parsed["raw"],
+        "inventoryProcessed": False,
+        "categories": categories,
+        "extraFields": extra_fields,
+        **spend,
+    }
+    raw_doc = {
+        "receiptId": receipt_id,
+        "userId": user_id,
+        "mediaUrl": media_url,
+        "thumbnailUrl": thumbnail_url,
+        "mediaType": content_type.split('/')[0],
+        "timestamp": timestamp,
+        "status": "parsed",
+        "linkedParsedId": parsed_id,
+        "fileName": filename,
+        "notes": notes,
+    }
+    write_start = time.perf_counter()
+    hash_ref, hash_entry = receipt_hash_index.entry(user_id, hashes, receipt_id, parsed_id)
+    writes = [
+        (db.collection("receipts_parsed").document(parsed_id), parsed_doc),
+        (db.collection("receipts_raw").document(receipt_id), raw_doc),
+        (hash_ref, hash_entry),
+    ]
+
+    def committed():
+        receipt_hash_index.remember(user_id, hash_entry)
+        # Only once the receipt is stored, so an upload that fails and is retried counts once
+        if spending_alerts is not None and "totalAmount" in spend:
+            spending_alerts.submit(user_id, parsed_id, parsed_doc["createdAt"].date(), spend.get("spendCategory"),
+                                   spend["totalAmount"], parse_vendor(parsed["raw"]))
+
+    if write_buffer is not None:
+        # Bulk uploads pass a group of one shared writer that is committed in large batches
+        write_buffer.add(writes)
+        record_receipt(write_buffer, db, parsed_doc)
+        write_buffer.on_commit(committed)
+    else:
+        with BatchWriter(db) as writer:
+            writer.add(writes)
+            record_receipt(writer, db, parsed_doc)
+        committed()
+    timings["firestore_write"] = round((time.perf_counter() - write_start) * 1000, 1)
+    print("Step 8: Stored parsed and raw receipt in Firestore (receipts_parsed, receipts_raw)")
+    # Invalidate RAG cache for this user
+    if user_id in user_rag_cache:
+        del user_rag_cache[user_id]
+    # Step 9: Add the new receipt's items to inventory in the background
+    # (bulk uploads trigger this once their shared buffer is flushed)
+    if INVENTORY_AUTO_UPDATE and write_buffer is None:
+        inventory_update_scheduler.request(user_id)
+    timings["total"] = round((time.perf_counter() - pipeline_start) * 1000, 1)
+    payload_sizes = {
+        "original_bytes": original_size,
+        "model_bytes": sum(len(segment) for segment in segments) if segments else len(model_bytes),
+        "storage_bytes": len(storage_bytes) if preprocessed else original_size,
+    }
+    return {
+        "receiptId": receipt_id,
+        "mediaUrl": media_url,
+        "status": "parsed",
+        "parseResult": f"Parsed and stored as {parsed_id}",
+        "parsedDoc": parsed_doc,
+        # Look-alike receipts whose parsed details differ; stored anyway, for the client to review
+        "possibleDuplicates": [{"receiptId": match["receiptId"], "distance": match["distance"]} for match in similar],
+        "timings": timings,
+        "payloadSizes": payload_sizes
+    }
+
 @app.post("/upload")
 async def upload_receipt(
     file: UploadFile = File(...),
     user_id: str = Form(...),
-    notes: str = Form(None)
+    notes: str = Form(None),
+    async_mode: bool = Form(False),
+    callback_url: str = Form(None),
+    notify_token: str = Form(None),
+    allow_duplicate: bool = Form(False)
 ):
+    """
+    Upload and process a receipt. With async_mode the file is stored, a job is
+    queued and 202 Accepted is returned immediately; poll /upload/status/{job_id}
+    or pass callback_url / notify_token (FCM) to be told when it finishes.
+    Re-uploads of an existing receipt return status "duplicate" unless allow_duplicate.
+    callback_url must be https on a host in INGESTION_CALLBACK_HOSTS.
+    """
+    if callback_url and not callback_allowed(callback_url):
+        raise HTTPException(status_code=400, detail="callback_url must be an https URL on a configured callback host")
     try:
         print("Step 1: Received upload request")
         # Step 2: Generate receipt_id
         receipt_id = str(uuid.uuid4())
         print("Step 2: Generated receipt_id:", receipt_id)
-        ext = file.filename.split('.')[-1].lower()
-        mime_type = file.content_type
-        # Step 3: Read file bytes
+        # Step 3: Use the spooled upload as-is (on disk beyond Starlette's threshold) instead of reading it into memory
         file.file.seek(0)
-        image_bytes = file.file.read()
-        print("Step 3: Read file bytes")
-        # Step 4: Verify and parse with Gemini
-        parsed = verify_and_parse_with_gemini(image_bytes)
-        print("Step 4: Gemini verification and parse result:", parsed["raw"])
-        if "not a receipt" in parsed["raw"].lower():
-            print("Step 4b: Not a receipt, aborting upload")
-            return {"error": "The uploaded document is not recognized as a receipt. Please upload a valid receipt."}
-        # Step 5: Gemini call for categories/tags
-        model = genai.GenerativeModel("gemini-2.5-flash-lite")
-        prompt2 = (
-            "Given the following parsed receipt data, assign one or more categories (e.g., 'grocery', 'electronics', 'restaurant', 'pharmacy', 'utility', etc.) "
-            "based on the vendor, items, and any other relevant fields. "
-            "Return ONLY a valid JSON object with a 'categories' field (list of strings) and any extra fields as 'extraFields' (dict of any additional key-value pairs). "
-            "Do not include any explanation, markdown, or code block—just the JSON object.\n\n"
-            "Parsed data:\n" + parsed["raw"]
-        )
-        result2 = model.generate_content([prompt2])
-        answer2 = result2.text.strip()
-        print("Step 5: Gemini categories/tags result:", answer2)
-        categories = []
-        extra_fields = {}
-        try:
-            cleaned = re.sub(r"^```(?:json)?\s*|```$", "", answer2.strip(), flags=re.MULTILINE).strip()
-            parsed_json = json.loads(cleaned)
-            categories = parsed_json.get("categories", [])
-            extra_fields = parsed_json.get("extraFields", {})
-        except Exception:
-            print("Could not parse categories/extraFields as JSON.")
-        # Step 6: Store parsed data in Firestore (receipts_parsed)
-        parsed_id = str(uuid.uuid4())
-        parsed_doc = {
-            "parsedId": parsed_id,
+        print("Step 3: Received file,", file_size(file.file), "bytes")
+        if not async_mode:
+            return process_receipt_upload(
+                file.file, user_id, receipt_id, file.filename, file.content_type, notes,
+                allow_duplicate=allow_duplicate
+            )
+        # Async mode: keep our own spooled copy (the upload is closed after the response)
+        # and stage the original in Storage so the job survives this request. The job
+        # stores the same preprocessed artifact as the sync path and then drops the staged copy.
+        receipt_file = spool_file(file.file)
+        staged_path = storage_path(file.filename, user_id, receipt_id, RECEIPT_STAGING_FOLDER)
+        upload_bytes_to_firebase(receipt_file, file.filename, file.content_type, user_id, receipt_id, RECEIPT_STAGING_FOLDER)
+        db.collection("receipts_raw").document(receipt_id).set({
             "receiptId": receipt_id,
             "userId": user_id,
+            "mediaUrl": None,
+            "mediaType": file.content_type.split('/')[0],
             "timestamp": datetime.utcnow().isoformat(),
-            "vendor": None,
-            "mediaUrl": None,  # Will update after upload
-            "parsedData": parsed,
-            "walletPassGenerated": False,
-            "geminiRawOutput": parsed["raw"],
-            "categories": categories,
-            "extraFields": extra_fields,
-        }
-        db.collection("receipts_parsed").document(parsed_id).set(parsed_doc)
-        print("Step 6: Stored parsed data in Firestore (receipts_parsed)")
-        # Invalidate RAG cache for this user
-        if user_id in user_rag_cache:
-            del user_rag_cache[user_id]
-        # Step 7: Upload file to Firebase Storage
-        # Rewind file for upload
-        from io import BytesIO
-        file_stream = BytesIO(image_bytes)
-        file_for_upload = UploadFile(filename=file.filename, file=file_stream)
-        media_url = upload_to_firebase(file_for_upload, user_id, receipt_id)
-        print("Step 7: Uploaded to Firebase, media_url:", media_url)
-        media_type = file.content_type.split('/')[0]
-        timestamp = datetime.utcnow().isoformat()
-        # Step 8: Store raw receipt in Firestore (receipts_raw)
-        doc = {
-            "receiptId": receipt_id,
-            "userId": user_id,
-            "mediaUrl": media_url,
-            "mediaType": media_type,
-            "timestamp": timestamp,
-            "status": "parsed",
-            "linkedParsedId": parsed_id,
+            "status": "queued",
+            "linkedParsedId": None,
             "fileName": file.filename,
             "notes": notes,
-        }
-        db.collection("receipts_raw").document(receipt_id).set(doc)
-        # Step 9: Update receipts_parsed with mediaUrl
-        db.collection("receipts_parsed").document(parsed_id).update({
-            "mediaUrl": media_url
         })
-        print("Step 8: Stored raw receipt in Firestore (receipts_raw) and updated parsed doc with mediaUrl")
-        return {
+        job_id = ingestion_queue.submit(
+            process_spooled_receipt_upload,
+            {
+                "receipt_file": receipt_file,
+                "user_id": user_id,
+                "receipt_id": receipt_id,
+                "filename": file.filename,
+                "content_type": file.content_type,
+                "notes": notes,
+                "queued": True,
+                "allow_duplicate": allow_duplicate,
+                "staged_path": staged_path,
+            },
+            user_id=user_id,
+            receipt_id=receipt_id,
+            callback_url=callback_url,
+            notify_token=notify_token,
+            job_input={
+                "storagePath": staged_path,
+                "filename": file.filename,
+                "contentType": file.content_type,
+                "notes": notes,
+                "allowDuplicate": allow_duplicate,
+            }
+        )
+        print("Step 4: Queued ingestion job:", job_id)
+        return JSONResponse(status_code=202, content={
             "receiptId": receipt_id,
-            "mediaUrl": media_url,
-            "status": "parsed",
-            "parseResult": f"Parsed and stored as {parsed_id}",
-            "parsedDoc": {**parsed_doc, "mediaUrl": media_url}
-        }
+            "jobId": job_id,
+            "status": "queued",
+            "statusUrl": f"/upload/status/{job_id}?user_id={user_id}"
+        })
     except Exception as e:
         import traceback
         print("Exception occurred:", e)
         traceback.print_exc()
         return {"error": str(e)}
 
+def process_spooled_receipt_upload(receipt_file, staged_path: str = None, **kwargs):
+    """
+    process_receipt_upload for a spooled copy that outlives its request; closes (and deletes) it afterwards.
+    staged_path is an async upload's original in Storage, removed once the receipt has been processed
+    (and kept if processing raised, so the upload can still be retried).
+    """
+    try:
+        result = process_receipt_upload(receipt_file, **kwargs)
+    finally:
+        receipt_file.close()
+    if staged_path:
+        try:
+            bucket.blob(staged_path).delete()
+        except Exception as e:
+            print(f"Could not delete staged upload {staged_path}: {e}")
+    return result
+
+def rebuild_upload_job(job: dict) -> dict:
+    """Payload for process_spooled_receipt_upload from a job's stored input, re-reading the file from Storage"""
+    job_input = job.get("input") or {}
+    if not job_input.get("storagePath"):
+        raise ValueError("job has no stored input")
+    receipt_file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD)
+    bucket.blob(job_input["storagePath"]).download_to_file(receipt_file)
+    receipt_file.seek(0)
+    return {
+        "receipt_file": receipt_file,
+        "user_id": job["userId"],
+        "receipt_id": job["receiptId"],
+        "filename": job_input["filename"],
+        "content_type": job_input["contentType"],
+        "notes": job_input.get("notes"),
+        "queued": True,
+        "allow_duplicate": job_input.get("allowDuplicate", False),
+        "staged_path": job_input["storagePath"],
+    }
+
+@app.on_event("startup")
+def recover_ingestion_jobs():
+    """Requeue async uploads whose jobs were lost with a previous instance (in the background)"""
+    def run():
+        try:
+            summary = ingestion_queue.recover(process_spooled_receipt_upload, rebuild_upload_job)
+            print(f"Ingestion recovery: {summary['requeued']} requeued, {summary['failed']} failed")
+        except Exception as e:
+            print(f"Ingestion recovery failed: {e}")
+    threading.Thread(target=run, daemon=True).start()
+
+@app.get("/upload/status/{job_id}")
+def upload_status(job_id: str, user_id: str = Query(...)):
+    """Get the status (queued, processing, completed, failed) of one of the user's async upload jobs"""
+    job = ingestion_queue.status(job_id)
+    # Another user's job is reported as missing rather than forbidden, so job ids can't be probed
+    if not job or job.get("userId") != user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {key: value for key, value in job.items() if key not in ("callbackUrl", "notifyToken", "input")}
+
+def expand_bulk_files(files: List[tuple]) -> List[tuple]:
+    """
+    Expand zip archives into (filename, content_type, spooled file) entries for each
+    receipt inside. Archives are read from their spooled file and closed once expanded.
+    Raises UploadTooLarge past BULK_UPLOAD_MAX_FILES files, an entry larger than
+    BULK_ZIP_MAX_ENTRY_BYTES, or BULK_ZIP_MAX_TOTAL_BYTES expanded in all (sizes
+    are checked while decompressing, not taken from the archive's headers).
+    """
+    expanded = []
+    expanded_bytes = 0
+    try:
+        for filename, content_type, data in files:
+            if filename.lower().endswith(".zip") or content_type in ("application/zip", "application/x-zip-compressed"):
+                with data, zipfile.ZipFile(data) as archive:
+                    for info in archive.infolist():
+                        name = info.filename
+                        if info.is_dir() or name.startswith("__MACOSX/") or os.path.basename(name).startswith("."):
+                            continue
+                        guessed_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                        if not (guessed_type.startswith("image/") or guessed_type == "application/pdf"):
+                            continue
+                        if len(expanded) >= BULK_UPLOAD_MAX_FILES:
+                            raise UploadTooLarge(f"more than {BULK_UPLOAD_MAX_FILES} files")
+                        limit = min(BULK_ZIP_MAX_ENTRY_BYTES, BULK_ZIP_MAX_TOTAL_BYTES - expanded_bytes)
+                        with archive.open(info) as entry:
+                            try:
+                                spooled = spool_file(entry, max_bytes=limit)
+                            except UploadTooLarge:
+                                raise UploadTooLarge(f"{name} expands past the size limit")
+                        expanded_bytes += file_size(spooled)
+                        expanded.append((os.path.basename(name), guessed_type, spooled))
+            else:
+                expanded.append((filename, content_type, data))
+    except Exception:
+        for _, _, data in files + expanded:
+            data.close()
+        raise
+    return expanded
+
+@app.post("/upload/bulk")
+async def upload_bulk(
+    files: List[UploadFile] = File(...),
+    user_id: str = Form(...),
+    notes: str = Form(None),
+    allow_duplicate: bool = Form(False)
+):
+    """
+    Upload many receipts (or zip archives of receipts) at once. Files run through
+    the /upload pipeline with bounded concurrency (BULK_UPLOAD_CONCURRENCY) and
+    Firestore writes are committed in shared batches. Results are streamed as
+    NDJSON, one line per file once the batch holding its writes has committed
+    (so a failed commit is reported on every file it held), followed by a summary line.
+    Files identical to one earlier in the same request are reported as duplicates.
+    """
+    # Spool everything before streaming: the uploaded files are closed once this handler returns
+    received = [(f.filename, f.content_type, spool_file(f.file)) for f in files]
+    try:
+        items = expand_bulk_files(received)
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"Invalid zip archive: {e}")
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"Bulk upload too large: {e}")
+    if len(items) > BULK_UPLOAD_MAX_FILES:
+        for _, _, data in items:
+            data.close()
+        raise HTTPException(status_code=413, detail=f"Too many files ({len(items)}), limit is {BULK_UPLOAD_MAX_FILES}")
+
+    write_buffer = BatchWriter(db)
+    semaphore = asyncio.Semaphore(BULK_UPLOAD_CONCURRENCY)
+    batch_hashes = BatchHashes()
+    # receipt id -> write group, so copies of a file in this request report its commit
+    groups = {}
+
+    def run(data, group, **kwargs):
+        stored = False
+        try:
+            result = process_spooled_receipt_upload(data, write_buffer=group, batch_hashes=batch_hashes, **kwargs)
+            group.submit()
+            stored = not result.get("error") and result.get("status") != "duplicate"
+            return result
+        finally:
+            batch_hashes.settle(kwargs["receipt_id"], stored)
+
+    async def process(index, filename, content_type, data):
+        group = write_buffer.group()
+        async with semaphore:
+            receipt_id = str(uuid.uuid4())
+            groups[receipt_id] = group
+            try:
+                result = await asyncio.to_thread(
+                    run, data, group,
+                    user_id=user_id, receipt_id=receipt_id, filename=filename, content_type=content_type,
+                    notes=notes, allow_duplicate=allow_duplicate
+                )
+            except Exception as e:
+                result = {"error": str(e)}
+        return {"index": index, "fileName": filename, **result}, group
+
+    async def report(task):
+        result, group = await task
+        if result.get("error"):
+            return result
+        if result.get("duplicate", {}).get("inRequest"):
+            # A copy of a file in this request is only a duplicate once that file is committed
+            group = groups[result["receiptId"]]
+        try:
+            await asyncio.wrap_future(group.done)
+        except Exception as e:
+            return {"index": result["index"], "fileName": result["fileName"], "receiptId": result.get("receiptId"),
+                    "error": f"Parsed but not stored: {e}"}
+        return result
+
+    async def flush_when_processed(tasks):
+        # The last partial batch is only committed once every file has added its writes
+        await asyncio.gather(*tasks)
+        await asyncio.to_thread(write_buffer.flush)
+
+    async def stream_results():
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(process(i, *item)) for i, item in enumerate(items)]
+        flusher = asyncio.create_task(flush_when_processed(tasks))
+        counts = {"parsed": 0, "duplicate": 0, "error": 0}
+        for next_done in asyncio.as_completed([report(task) for task in tasks]):
+            result = await next_done
+            status = "error" if result.get("error") else result.get("status", "parsed")
+            counts[status] = counts.get(status, 0) + 1
+            yield json.dumps(result, default=str) + "\n"
+        flush_error = None
+        try:
+            await flusher
+        except Exception as e:
+            flush_error = str(e)
+        if INVENTORY_AUTO_UPDATE and counts["parsed"]:
+            inventory_update_scheduler.request(user_id)
+        yield json.dumps({
+            "summary": True,
+            "userId": user_id,
+            "files": len(items),
+            "counts": counts,
+            "firestoreWrites": write_buffer.committed,
+            "firestoreStats": write_buffer.stats(),
+            "flushError": flush_error,
+            "elapsedMs": round((time.perf_counter() - started) * 1000, 1)
+        }) + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
 @app.post("/upload-minimal")
 async def upload_minimal(
     file: UploadFile = File(...),
@@ -836,11 +1365,10 @@ async def upload_minimal(
         # Step 2: Generate receipt_id
         receipt_id = str(uuid.uuid4())
         print("[Minimal] Step 2: Generated receipt_id:", receipt_id)
-        # Step 3: Read file bytes and verify/parse with Gemini
+        # Step 3: Decode the spooled upload in place and verify/parse with Gemini
         file.file.seek(0)
-        image_bytes = file.file.read()
-        print("[Minimal] Step 3: Read file bytes, passing to Gemini")
-        parsed = verify_and_parse_with_gemini(image_bytes)
+        print("[Minimal] Step 3: Passing spooled file to Gemini")
+        parsed = verify_and_parse_with_gemini(file.file)
         print("[Minimal] Step 3: Gemini verification and parse result:", parsed["raw"])
         return {
             "receiptId": receipt_id,
@@ -961,6 +1489,60 @@ def extract_items_with_gemini(raw_data):
         print(f"Gemini API error for items extraction: {e}")
         return []
 
+@lru_cache(maxsize=1024)
+def _extract_inventory_items_answer(data_str: str):
+    """Gemini's combined item extraction for one receipt, cached per receipt text"""
+    model = genai.GenerativeModel("gemini-2.0-flash")
+    prompt = (
+        "Extract every purchased item from the following receipt data in a single JSON array. "
+        "For each item return an object with these keys:\n"
+        "- 'raw_name': the item name as printed on the receipt\n"
+        "- 'canonical_name': a short, generic, lowercase name for the product without brand or pack size "
+        "(for example 'Amul Taaza 500ml' -> 'milk', 'ckn breast' -> 'chicken', 'Tur Dal 1kg' -> 'toor dal')\n"
+        "- 'quantity': number of units bought (number, default 1)\n"
+        "- 'unit': unit of the quantity such as 'kg', 'g', 'l', 'ml', 'pcs', or null\n"
+        "- 'price': total price paid for the item (number), or null\n"
+        "- 'expiry_date': the expiry / best-before / use-by date printed on the receipt for this item in YYYY-MM-DD format, "
+        "or null if none is printed. Do not guess an expiry date.\n"
+        "Return ONLY the JSON array, without markdown or explanation. If no items are found, return [].\n"
+        "Receipt data:\n" + data_str
+    )
+    result = model.generate_content(prompt)
+    return result.text.strip()
+
+def extract_inventory_items_with_gemini(raw_data):
+    """
+    Extract all items of a receipt with one structured Gemini call: raw name,
+    canonical name, quantity, unit, price and printed expiry date (if any).
+    Returns: list of item dictionaries, or None if the call or its parsing failed
+    (callers then fall back to the per-item helpers)
+    """
+    if isinstance(raw_data, dict) and 'raw' in raw_data:
+        data_str = raw_data['raw']
+        if isinstance(data_str, dict):
+            data_str = json.dumps(data_str)
+    else:
+        data_str = raw_data if isinstance(raw_data, str) else json.dumps(raw_data)
+    try:
+        answer = _extract_inventory_items_answer(data_str)
+        json_match = re.search(r'\[.*\]', answer, re.DOTALL)
+        if not json_match:
+            return None
+        items = json.loads(json_match.group())
+        return [item for item in items if isinstance(item, dict)]
+    except Exception as e:
+        print(f"Gemini combined item extraction error: {e}")
+        return None
+
+def future_date_or_none(date_str):
+    """Return date_str if it is a valid YYYY-MM-DD date after today, else None"""
+    try:
+        expiry_date = datetime.strptime(str(date_str), '%Y-%m-%d')
+    except ValueError:
+        return None
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return date_str if expiry_date > today else None
+
 def normalize_item_name_with_gemini(item_name: str, existing_items: list = None):
     """
     Use Gemini to normalize item names and identify similar items.
@@ -992,19 +1574,35 @@ def normalize_item_name_with_gemini(item_name: str, existing_items: list = None)
         print(f"Gemini normalization error: {e}")
         return item_name
 
-def extract_expiry_date_with_gemini(item_name: str, raw_data: dict):
+@lru_cache(maxsize=4096)
+def read_printed_expiry_with_gemini(item_name: str, data_str: str):
     """
-    Use Gemini to extract expiry date for a specific item from receipt data.
-    If no expiry date is found, automatically assign one based on item type.
-    Returns: expiry date string or None if not found
+    Ask Gemini for the expiry date printed on a receipt for one item.
+    Cached per (item, receipt text), so re-processing a receipt does not ask again.
+    Returns: Gemini's answer, lowercased
     """
-    try:
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        
-        # Get current date
-        from datetime import datetime
-        current_date = datetime.now().strftime('%Y-%m-%d')
+    model = genai.GenerativeModel("gemini-2.0-flash")
+    prompt = (
+        f"Look for expiry date information for the item '{item_name}' in the following receipt data. "
+        "Look for terms like 'expiry', 'expires', 'best before', 'use by', 'sell by', 'BB', 'EXP', etc. "
+        f"Return only the expiry date in YYYY-MM-DD format if found, or 'None' if no expiry date is found. "
+        "If the date is in a different format, convert it to YYYY-MM-DD. "
+        f"Receipt data:\n{data_str}"
+    )
+    result = model.generate_content(prompt)
+    return result.text.strip().lower()
 
+def extract_expiry_date_with_gemini(item_name: str, raw_data: dict, canonical_name: str = None,
+                                    purchase_date: datetime = None):
+    """
+    Extract the expiry date for a specific item from receipt data. Gemini is only
+    asked when the receipt has a printed expiry date; otherwise, or if none is found
+    for the item, one is assigned from the shelf-life table based on item type
+    (looked up by canonical_name when given), counted from purchase_date.
+    Returns: expiry date string in YYYY-MM-DD format
+    """
+    shelf_life_name = canonical_name or item_name
+    try:
         # Prepare the data string for Gemini
         if isinstance(raw_data, dict) and 'raw' in raw_data:
             data_str = raw_data['raw']
@@ -1013,18 +1611,10 @@ def extract_expiry_date_with_gemini(item_name: str, raw_data: dict):
         else:
             data_str = json.dumps(raw_data)
 
-        prompt = (
-            f"Look for expiry date information for the item '{item_name}' in the following receipt data. "
-            f"Today's date is {current_date}. "
-            "Look for terms like 'expiry', 'expires', 'best before', 'use by', 'sell by', 'BB', 'EXP', etc. "
-            f"Return only the expiry date in YYYY-MM-DD format if found, or 'None' if no expiry date is found. "
-            "If the date is in a different format, convert it to YYYY-MM-DD. "
-            f"IMPORTANT: If the extracted date is in the past relative to today ({current_date}), return 'None' instead. "
-            f"Receipt data:\n{data_str}"
-        )
+        if not has_printed_expiry(data_str):
+            return assign_expiry_date_by_item_type(shelf_life_name, purchase_date)
 
-        result = model.generate_content(prompt)
-        answer = result.text.strip().lower()
+        answer = read_printed_expiry_with_gemini(item_name, data_str)
 
         # Try to extract date from response
         import re
@@ -1073,200 +1663,384 @@ def extract_expiry_date_with_gemini(item_name: str, raw_data: dict):
 
         # Check if Gemini explicitly said "None" or "not found"
         if 'none' in answer or 'not found' in answer or 'no expiry' in answer:
-            # No expiry date found in receipt, use Gemini to assign one based on item type
-            return assign_expiry_date_by_item_type(item_name)
+            # No expiry date found for this item, assign one based on item type
+            return assign_expiry_date_by_item_type(shelf_life_name, purchase_date)
 
         # If we get here, no valid future date was found, use fallback
-        return assign_expiry_date_by_item_type(item_name)
+        return assign_expiry_date_by_item_type(shelf_life_name, purchase_date)
         
     except Exception as e:
         print(f"Gemini expiry extraction error: {e}")
         # Fallback to assigning expiry date by item type
-        return assign_expiry_date_by_item_type(item_name)
+        return assign_expiry_date_by_item_type(shelf_life_name, purchase_date)
 
-def assign_expiry_date_by_item_type(item_name: str):
+def assign_expiry_date_by_item_type(item_name: str, purchase_date: datetime = None):
     """
-    Use Gemini to assign an appropriate expiry date based on the item type.
+    Assign an expiry date from the typical shelf life of the item (or its class:
+    dairy, produce, dry goods, frozen, ...) in the local shelf-life table, counted
+    from purchase_date (today if not known).
     Returns: expiry date string in YYYY-MM-DD format
     """
+    return estimate_expiry_date(item_name, purchase_date)
+
+def purchase_date_of(timestamp):
+    """Receipt timestamp (ISO string or datetime) as a naive datetime, or None"""
+    if isinstance(timestamp, datetime):
+        return timestamp.replace(tzinfo=None)
     try:
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        
-        # Get current date
-        from datetime import datetime
-        current_date = datetime.now().strftime('%Y-%m-%d')
+        return datetime.fromisoformat(str(timestamp).replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
 
-        prompt = (
-            f"Given the item '{item_name}' and today's date is {current_date}, assign an appropriate expiry date based on typical shelf life. "
-            "Consider factors like: "
-            "- Dairy products (milk, cheese, yogurt): 7-14 days from today "
-            "- Bread and baked goods: 5-7 days from today "
-            "- Fresh produce (fruits, vegetables): 3-7 days from today "
-            "- Meat and fish: 3-5 days from today "
-            "- Canned goods: 1-2 years from today "
-            "- Dry goods (rice, pasta): 1-2 years from today "
-            "- Snacks and packaged foods: 3-6 months from today "
-            "- Beverages: 1-2 weeks from today "
-            "- Frozen foods: 6-12 months from today "
-            f"Return only the expiry date in YYYY-MM-DD format, calculated from today's date ({current_date}). "
-            "Be conservative with perishable items and generous with non-perishable items. "
-            "IMPORTANT: The expiry date must be in the future relative to today's date."
-        )
+def earliest_future_expiry(current: str, new: str):
+    """Keep the earliest expiry date that has not passed yet"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    candidates = [d for d in (current, new) if d and d >= today]
+    return min(candidates) if candidates else (new or current)
 
-        result = model.generate_content(prompt)
-        answer = result.text.strip()
+def _combined_item_resolver(model_canonical_name: str):
+    """Canonicalizer resolver that uses the name from the combined extraction instead of another Gemini call"""
+    def resolve(item_name, candidates):
+        return model_canonical_name or normalize_item_name_with_gemini(item_name, candidates)
+    return resolve
 
-        # Extract date from response
-        import re
-        date_patterns = [
-            r'(\d{4}-\d{2}-\d{2})',  # YYYY-MM-DD
-            r'(\d{2}/\d{2}/\d{4})',  # MM/DD/YYYY
-            r'(\d{2}-\d{2}-\d{4})',  # MM-DD-YYYY
-            r'(\d{1,2}/\d{1,2}/\d{2,4})',  # M/D/YY or M/D/YYYY
-        ]
+def extract_receipt_inventory(receipt: dict, normalization_sources: dict):
+    """
+    Extract the items of one parsed receipt, aggregated by canonical name.
+    With INVENTORY_EXTRACTION_MODE=combined (default) this is one Gemini call per
+    receipt; the per-item helpers (extract_items_with_gemini, normalize_item_name_with_gemini,
+    extract_expiry_date_with_gemini) are only used if that call fails, or in per_item mode.
+    Returns: {item_name: {count, quantity, unit, last_price, last_bought_date, first_bought_date,
+             purchases, purchase_dates, userId, original_names, expiryDate}}
+    """
+    parsed_data = receipt.get('parsedData', {})
+    raw_data = parsed_data.get('raw', {})
+    timestamp = receipt.get('timestamp', '')
+    purchase_date = purchase_date_of(timestamp)
+    owner = receipt.get('userId')
+
+    items = None
+    if INVENTORY_EXTRACTION_MODE == "combined":
+        items = extract_inventory_items_with_gemini(raw_data)
+    combined = items is not None
+    if not combined:
+        # Fallback: extract items using Gemini, then normalize and look up expiry per item
+        items = extract_items_with_gemini(raw_data)
+
+    inventory_items = {}
+    for item in items:
+        original_item_name = str(item.get('raw_name' if combined else 'name') or item.get('name') or '').lower().strip()
+        if not original_item_name:
+            continue
+        # Normalize the item name locally; unseen names take the combined call's canonical
+        # name (or ask Gemini in the fallback), which is remembered for next time
+        resolver = _combined_item_resolver(item.get('canonical_name')) if combined else normalize_item_name_with_gemini
+        normalized_name, source = item_canonicalizer.canonicalize(owner, original_item_name, resolver)
+        normalization_sources[source] = normalization_sources.get(source, 0) + 1
+
+        # Printed expiry from the combined call, else the shelf-life table
+        if combined:
+            expiry_date = (future_date_or_none(item.get('expiry_date'))
+                           or assign_expiry_date_by_item_type(normalized_name, purchase_date))
+        else:
+            expiry_date = extract_expiry_date_with_gemini(original_item_name, raw_data, normalized_name, purchase_date)
 
-        for pattern in date_patterns:
-            match = re.search(pattern, answer)
-            if match:
-                date_str = match.group(1)
-                # Convert to YYYY-MM-DD format if needed
-                if '/' in date_str:
-                    parts = date_str.split('/')
-                    if len(parts) == 3:
-                        if len(parts[2]) == 2:  # YY format
-                            parts[2] = '20' + parts[2]
-                        if len(parts[0]) == 1:  # Single digit month
-                            parts[0] = '0' + parts[0]
-                        if len(parts[1]) == 1:  # Single digit day
-                            parts[1] = '0' + parts[1]
-                        date_str = f"{parts[2]}-{parts[0]}-{parts[1]}"
-                elif '-' in date_str and len(date_str.split('-')[0]) == 2:
-                    # MM-DD-YYYY format
-                    parts = date_str.split('-')
-                    if len(parts[2]) == 2:  # YY format
-                        parts[2] = '20' + parts[2]
-                    date_str = f"{parts[2]}-{parts[0]}-{parts[1]}"
+        try:
+            quantity = float(item.get('quantity') or 1)
+        except (TypeError, ValueError):
+            quantity = 1.0
+        entry = inventory_items.setdefault(normalized_name, {
+            'count': 0,
+            'quantity': 0.0,
+            'unit': item.get('unit'),
+            'last_price': None,
+            'last_bought_date': timestamp,
+            'first_bought_date': timestamp,
+            'purchases': 1,
+            'purchase_dates': [timestamp[:10]] if timestamp else [],
+            'userId': owner,
+            'original_names': [],
+            'expiryDate': expiry_date
+        })
+        entry['count'] += 1
+        entry['quantity'] += quantity
+        entry['unit'] = entry['unit'] or item.get('unit')
+        if item.get('price') is not None:
+            entry['last_price'] = item.get('price')
+        if original_item_name not in entry['original_names']:
+            entry['original_names'].append(original_item_name)
+        entry['expiryDate'] = earliest_future_expiry(entry['expiryDate'], expiry_date)
+    return inventory_items
+
+def rebuild_inventory(user_id: str, normalization_sources: dict):
+    """
+    Full rebuild: re-process every receipt of the user, replace their inventory
+    documents, flag every receipt as processed and move the watermark to the newest one.
+    The writes span several batches, so the new documents are written before stale
+    ones are deleted: a failure part way leaves every rebuilt item in place (plus
+    some stale ones), never a half-emptied inventory, and the rebuild can be rerun.
+    Returns: (item names, number of receipts processed)
+    """
+    snapshots = list(db.collection("receipts_parsed").where("userId", "==", user_id).stream())
+    snapshots.sort(key=lambda snap: snap.to_dict().get('timestamp', ''))
+
+    inventory_items = {}
+    for snapshot in snapshots:
+        for name, item in extract_receipt_inventory(snapshot.to_dict(), normalization_sources).items():
+            if name not in inventory_items:
+                inventory_items[name] = item
+                continue
+            current = inventory_items[name]
+            current['count'] += item['count']
+            current['quantity'] += item['quantity']
+            current['unit'] = current['unit'] or item['unit']
+            current['last_price'] = item['last_price'] if item['last_price'] is not None else current['last_price']
+            current['last_bought_date'] = max(current['last_bought_date'], item['last_bought_date'])
+            current['first_bought_date'] = min(current['first_bought_date'], item['first_bought_date'])
+            current['purchases'] += item['purchases']
+            current['purchase_dates'] += [d for d in item['purchase_dates'] if d not in current['purchase_dates']]
+            current['original_names'] += [n for n in item['original_names'] if n not in current['original_names']]
+            current['expiryDate'] = earliest_future_expiry(current['expiryDate'], item['expiryDate'])
+
+    now = datetime.utcnow().isoformat()
+    writer = BatchWriter(db)
+    rebuilt = set()
+    for item_name, item_data in inventory_items.items():
+        ref = inventory_item_ref(db, user_id, item_name)
+        rebuilt.add(ref.id)
+        writer.set(ref, {
+            'item_name': item_name,
+            'count': item_data['count'],
+            'quantity': item_data['quantity'],
+            'unit': item_data['unit'],
+            'last_price': item_data['last_price'],
+            'last_bought_date': item_data['last_bought_date'],
+            'first_bought_date': item_data['first_bought_date'],
+            'purchases': item_data['purchases'],
+            'purchase_dates': item_data['purchase_dates'],
+            'userId': user_id,
+            'original_names': item_data['original_names'],
+            'expiryDate': item_data['expiryDate'],
+            'expiresAt': expiry_timestamp(item_data['expiryDate']),
+            'created_at': now
+        })
+    # Queued after the sets, so they commit in later batches (or the same one)
+    for doc in user_inventory(db, user_id).stream():
+        if doc.id not in rebuilt:
+            writer.delete(doc.reference)
+    for snapshot in snapshots:
+        writer.update(snapshot.reference, {"inventoryProcessed": True, "inventoryProcessedAt": now})
+    if snapshots:
+        newest = snapshots[-1].to_dict()
+        writer.set(db.collection("inventory_watermarks").document(user_id), {
+            "userId": user_id,
+            "lastReceiptTimestamp": newest.get('timestamp', ''),
+            "lastParsedId": snapshots[-1].id,
+            "updatedAt": now
+        })
+    writer.flush()
+    expiry_cache.invalidate(user_id)
+    expiry_notifier.invalidate()
+    recipe_cache.inventory_changed(user_id)
+    print(f"Inventory rebuild for {user_id}: {writer.stats()}")
+    return list(inventory_items.keys()), len(snapshots)
+
+def apply_receipt_inventory(user_id: str, snapshot, inventory_items: dict):
+    """
+    Merge one receipt's items into the user's inventory with Firestore increments,
+    flag the receipt and advance the watermark in the same batch. The receipt update
+    is conditional on the snapshot we read, so a receipt is only counted once even
+    if two updates race for it.
+    """
+    receipt = snapshot.to_dict()
+    now = datetime.utcnow().isoformat()
+    refs = {name: inventory_item_ref(db, user_id, name) for name in inventory_items}
+    existing = {doc.id: doc.to_dict() for doc in db.get_all(list(refs.values())) if doc.exists}
+
+    # One atomic batch; a failed precondition is not retried
+    writer = BatchWriter(db, auto_flush=False)
+    cached = {}
+    for item_name, item_data in inventory_items.items():
+        ref = refs[item_name]
+        current = existing.get(ref.id, {})
+        expiry_date = earliest_future_expiry(current.get('expiryDate'), item_data['expiryDate'])
+        update = {
+            'item_name': item_name,
+            'userId': user_id,
+            'count': firestore.Increment(item_data['count']),
+            'quantity': firestore.Increment(item_data['quantity']),
+            'last_bought_date': max(current.get('last_bought_date') or '', item_data['last_bought_date']),
+            'first_bought_date': min(d for d in (current.get('first_bought_date'), item_data['first_bought_date']) if d is not None),
+            'purchases': firestore.Increment(item_data['purchases']),
+            'purchase_dates': firestore.ArrayUnion(item_data['purchase_dates']),
+            'original_names': firestore.ArrayUnion(item_data['original_names']),
+            'expiryDate': expiry_date,
+            'expiresAt': expiry_timestamp(expiry_date),
+            'updated_at': now
+        }
+        if item_data['unit']:
+            update['unit'] = item_data['unit']
+        if item_data['last_price'] is not None:
+            update['last_price'] = item_data['last_price']
+        if not current:
+            update['created_at'] = now
+        writer.set(ref, update, merge=True)
+        # The document as it will read after the increments, for the expiry cache
+        cached[ref.id] = {
+            **current, **update,
+            'count': current.get('count', 0) + item_data['count'],
+            'quantity': current.get('quantity', 0) + item_data['quantity'],
+            'purchases': current.get('purchases', 0) + item_data['purchases'],
+            'purchase_dates': list(dict.fromkeys((current.get('purchase_dates') or []) + item_data['purchase_dates'])),
+            'original_names': list(dict.fromkeys((current.get('original_names') or []) + item_data['original_names'])),
+        }
+    writer.update(
+        snapshot.reference,
+        {"inventoryProcessed": True, "inventoryProcessedAt": now},
+        option=db.write_option(last_update_time=snapshot.update_time)
+    )
+    writer.set(db.collection("inventory_watermarks").document(user_id), {
+        "userId": user_id,
+        "lastReceiptTimestamp": receipt.get('timestamp', ''),
+        "lastParsedId": snapshot.id,
+        "updatedAt": now
+    }, merge=True)
+    writer.flush()
+    for item_id, data in cached.items():
+        inventory_item_changed(user_id, item_id, data)
+    recipe_cache.inventory_changed(user_id)
+
+def update_inventory_incremental(user_id: str, normalization_sources: dict = None):
+    """
+    Process the user's receipts not yet flagged inventoryProcessed, oldest first.
+    Selecting on the flag rather than on the watermark's timestamp also picks up
+    receipts committed out of order and ones a previous run could not apply.
+    A user without a watermark gets one full rebuild.
+    Returns: (item names touched, number of receipts processed)
+    """
+    normalization_sources = normalization_sources if normalization_sources is not None else {}
+    watermark = db.collection("inventory_watermarks").document(user_id).get()
+    if not watermark.exists:
+        return rebuild_inventory(user_id, normalization_sources)
+
+    query = (
+        db.collection("receipts_parsed")
+        .where("userId", "==", user_id)
+        .where("inventoryProcessed", "==", False)
+        .order_by("timestamp")
+    )
+    items_touched = []
+    processed = 0
+    for snapshot in query.stream():
+        inventory_items = extract_receipt_inventory(snapshot.to_dict(), normalization_sources)
+        applied = False
+        for _ in range(INVENTORY_APPLY_ATTEMPTS):
+            try:
+                apply_receipt_inventory(user_id, snapshot, inventory_items)
+                applied = True
+                break
+            except FailedPrecondition:
+                # The receipt changed since it was read (e.g. a spend write-back) or
+                # another instance applied it; re-read it and try again if still unprocessed
+                snapshot = snapshot.reference.get()
+                if not snapshot.exists or snapshot.to_dict().get("inventoryProcessed"):
+                    break
+            except Exception as e:
+                # Left unprocessed, so the next update retries it
+                print(f"Skipping receipt {snapshot.id} for inventory: {e}")
+                break
+        if not applied:
+            continue
+        processed += 1
+        items_touched += [name for name in inventory_items if name not in items_touched]
+    return items_touched, processed
+
+# Soonest-expiring items per user for /retrieve_expirations, kept current by the writers above
+expiry_cache = ExpiryCache(db)
+
+def email_expiry_notification(notification: dict):
+    """Email an expiry notification to the address on the user's profile, if there is one"""
+    profile = db.collection("users").document(notification["userId"]).get()
+    email = (profile.to_dict() or {}).get("email") if profile.exists else None
+    if email:
+        EmailService().send_email(email, notification["title"], notification["message"])
+
+# Notifies users when items become critical; only the lease holder in the cluster sends
+expiry_notifier = ExpiryNotifier(
+    db, senders=[email_expiry_notification] if os.getenv("EXPIRY_NOTIFY_EMAIL", "false").lower() == "true" else []
+)
+
+# Recipes per inventory set, shared across users and refreshed in the background
+recipe_cache = RecipeCache(
+    db,
+    generate=lambda items: generate_recipes_with_gemini(items)[0],
+    load_items=lambda uid: load_inventory_item_names(db, uid)
+)
+
+# Per-user spending forecast models, fitted incrementally on daily spend
+spending_forecaster = SpendingForecaster(db)
+
+def inventory_item_changed(user_id: str, item_id: str, data: dict = None):
+    """Tell the expiry cache and notifier about a written (or, with data=None, removed) item"""
+    if data is None:
+        expiry_cache.remove(user_id, item_id)
+        expiry_notifier.item_removed(user_id, item_id)
+    else:
+        expiry_cache.upsert(user_id, item_id, data.get('expiresAt'), data)
+        expiry_notifier.item_changed(user_id, item_id, data.get('expiresAt'), data)
 
-                # Validate that the date is in the future
-                try:
-                    expiry_date = datetime.strptime(date_str, '%Y-%m-%d')
-                    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                    if expiry_date > today:
-                        return date_str
-                    else:
-                        print(f"Warning: Gemini returned past date {date_str} for {item_name}, using fallback")
-                except ValueError:
-                    print(f"Warning: Invalid date format {date_str} for {item_name}, using fallback")
+@app.on_event("startup")
+def start_expiry_notifier():
+    if EXPIRY_NOTIFICATIONS_ENABLED:
+        expiry_notifier.start()
 
-        # Fallback: return a default expiry date (7 days from now)
-        from datetime import timedelta
-        default_expiry = datetime.now() + timedelta(days=7)
-        return default_expiry.strftime('%Y-%m-%d')
+@app.on_event("shutdown")
+def stop_expiry_notifier():
+    if EXPIRY_NOTIFICATIONS_ENABLED:
+        expiry_notifier.stop()
 
-    except Exception as e:
-        print(f"Gemini expiry assignment error: {e}")
-        # Fallback: return a default expiry date (7 days from now)
-        from datetime import datetime, timedelta
-        default_expiry = datetime.now() + timedelta(days=7)
-        return default_expiry.strftime('%Y-%m-%d')
+# Keeps inventory current after uploads without anyone calling /add_inventories
+inventory_update_scheduler = InventoryUpdateScheduler(update_inventory_incremental)
 
 # Owner: Mohamed Fazil
 @app.post("/add_inventories")
 def add_inventories(user_id: str = Form(None), process_all: bool = Form(False)):
+    """
+    Update inventory from parsed receipts. By default only receipts that have not
+    been added yet are processed and merged into the existing counts; process_all
+    rebuilds the inventory from every receipt. Without user_id, every user with
+    unprocessed receipts is updated.
+    """
     try:
-        # Filter receipts by user_id if provided
         if user_id:
-            receipts_ref = db.collection("receipts_parsed").where("userId", "==", user_id)
+            user_ids = [user_id]
         else:
-            receipts_ref = db.collection("receipts_parsed")
-            
-        docs = receipts_ref.stream()
-        
-        # Convert to list and sort by timestamp to get the latest receipt
-        receipts_list = []
-        for doc in docs:
-            receipt_data = doc.to_dict()
-            receipt_data['doc_id'] = doc.id
-            receipts_list.append(receipt_data)
-        
-        # Sort by timestamp (newest first)
-        receipts_list.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        
-        # If process_all is False, only process the latest receipt
-        if not process_all and receipts_list:
-            receipts_list = [receipts_list[0]]  # Only the latest receipt
-        
-        # Dictionary to store item counts and last bought dates
-        inventory_items = {}
-        existing_items = []
-        
-        for receipt in receipts_list:
-            parsed_data = receipt.get('parsedData', {})
-            raw_data = parsed_data.get('raw', {})
-            timestamp = receipt.get('timestamp', '')
-            
-            # Extract items using Gemini
-            items = extract_items_with_gemini(raw_data)
-            
-            for item in items:
-                original_item_name = item.get('name', '').lower().strip()
-                if original_item_name:
-                    # Normalize the item name using Gemini
-                    normalized_name = normalize_item_name_with_gemini(original_item_name, existing_items)
-                    
-                    # Extract expiry date for this item
-                    expiry_date = extract_expiry_date_with_gemini(original_item_name, raw_data)
-                    
-                    if normalized_name not in inventory_items:
-                        inventory_items[normalized_name] = {
-                            'count': 0,
-                            'last_bought_date': timestamp,
-                            'first_bought_date': timestamp,
-                            'userId': user_id if user_id else None,
-                            'original_names': [original_item_name],
-                            'expiryDate': expiry_date
-                        }
-                        existing_items.append(normalized_name)
-                    
-                    inventory_items[normalized_name]['count'] += 1
-                    # Update last bought date if this receipt is more recent
-                    if timestamp > inventory_items[normalized_name]['last_bought_date']:
-                        inventory_items[normalized_name]['last_bought_date'] = timestamp
-                    
-                    # Add original name to the list if not already present
-                    if original_item_name not in inventory_items[normalized_name]['original_names']:
-                        inventory_items[normalized_name]['original_names'].append(original_item_name)
-                    
-                    # Update expiry date to the earliest one if a new expiry date is found
-                    if expiry_date:
-                        current_expiry = inventory_items[normalized_name]['expiryDate']
-                        if current_expiry is None or expiry_date < current_expiry:
-                            inventory_items[normalized_name]['expiryDate'] = expiry_date
-        
-        # Store in inventories collection
-        inventories_ref = db.collection("inventories")
-        for item_name, item_data in inventory_items.items():
-            doc_id = item_name.replace(' ', '_').replace('-', '_')  # Create safe document ID
-            inventory_doc = {
-                'item_name': item_name,
-                'count': item_data['count'],
-                'last_bought_date': item_data['last_bought_date'],
-                'first_bought_date': item_data['first_bought_date'],
-                'userId': item_data['userId'],
-                'original_names': item_data['original_names'],
-                'expiryDate': item_data['expiryDate'],
-                'created_at': datetime.utcnow().isoformat()
-            }
-            inventories_ref.document(doc_id).set(inventory_doc)
-        
+            user_ids = sorted({
+                doc.get("userId")
+                for doc in db.collection("receipts_parsed").select(["userId", "inventoryProcessed"]).stream()
+                if doc.get("userId") and (process_all or not doc.to_dict().get("inventoryProcessed"))
+            })
+
+        normalization_sources = {}
+        items = []
+        receipts_processed = 0
+        for uid in user_ids:
+            # Through the scheduler, so a rebuild never runs alongside a background update
+            update = rebuild_inventory if process_all else update_inventory_incremental
+            user_items, processed = inventory_update_scheduler.run(uid, lambda u: update(u, normalization_sources))
+            items += [name for name in user_items if name not in items]
+            receipts_processed += processed
+
         return {
-            "message": f"Successfully added {len(inventory_items)} items to inventory",
-            "items_count": len(inventory_items),
-            "items": list(inventory_items.keys()),
+            "message": f"Successfully added {len(items)} items to inventory",
+            "items_count": len(items),
+            "items": items,
             "user_id": user_id,
             "process_all": process_all,
-            "receipts_processed": len(receipts_list),
+            "mode": "full_rebuild" if process_all else "incremental",
+            "receipts_processed": receipts_processed,
             "normalization_applied": True,
+            "normalization_sources": normalization_sources,
             "expiry_tracking_enabled": True
         }
         
@@ -1282,27 +2056,19 @@ def generate_chart(user_id: str = Query(None)):
             receipts_ref = db.collection("receipts_parsed").where("userId", "==", user_id)
         else:
             receipts_ref = db.collection("receipts_parsed")
-            
-        docs = receipts_ref.stream()
-        stats = {
-            "groceries": [0, 0.0],
-            "utilities": [0, 0.0],
-            "transportation": [0, 0.0],
-            "dining": [0, 0.0],
-            "travel": [0, 0.0],
-            "reimbursement": [0, 0.0],
-            "home": [0, 0.0]
+        receipt_docs = [(doc.id, doc.to_dict()) for doc in receipts_ref.stream()]
+
+        # Categories from the ones stored at ingestion and totals as stored; receipts
+        # without a total go to Gemini a bounded number at a time and count as 0 until then
+        spend, _ = resolved_spend(db, receipt_docs)
+        groups = SpendingTable.from_rows(
+            (doc_id, None, spend[doc_id].get("totalAmount", 0.0), chart_category(receipt), None, SOURCE_RECEIPT)
+            for doc_id, receipt in receipt_docs
+        ).group_by("category")
+        return {
+            category: [groups[category]["count"], groups[category]["total"]] if category in groups else [0, 0.0]
+            for category in CHART_CATEGORIES
         }
-        for doc in docs:
-            receipt = doc.to_dict()
-            parsed_data = receipt.get('parsedData', {})
-            raw_data = parsed_data.get('raw', {})
-            gemini_category = classify_with_gemini(raw_data)
-            amount_val = extract_total_amount_with_gemini(raw_data)
-            if gemini_category in stats:
-                stats[gemini_category][0] += 1
-                stats[gemini_category][1] += amount_val
-        return stats
     except Exception as e:
         return {"error": str(e)}
 
@@ -1368,21 +2134,67 @@ def get_inventories(order: str = Query('desc', enum=['asc', 'desc']), user_id: s
 
 @app.get("/get_recipes")
 def get_recipes_endpoint(user_id: str = Query(None)):
-    return get_recipes(user_id)
+    return get_recipes(user_id, cache=recipe_cache)
 
 @app.get("/retrieve_expirations")
 def retrieve_expirations(user_id: str = "testuser123"):
     """
     Retrieve top 5 products that are going to expire soon from user's inventory.
     """
-    return retrieve_expirations_data(user_id)
+    return retrieve_expirations_data(user_id, cache=expiry_cache)
+
+@app.get("/notifications")
+def get_notifications(user_id: str = Query(...), unread_only: bool = Query(False), limit: int = Query(50)):
+    """The user's notifications (expiry alerts and others), newest first"""
+    try:
+        query = db.collection("notifications").where("userId", "==", user_id)
+        if unread_only:
+            query = query.where("read", "==", False)
+        docs = query.order_by("createdAt", direction=firestore.Query.DESCENDING).limit(limit).stream()
+        notifications = []
+        for doc in docs:
+            data = doc.to_dict()
+            data['id'] = doc.id
+            data['createdAt'] = data['createdAt'].isoformat() if data.get('createdAt') else None
+            notifications.append(data)
+        return {"notifications": notifications, "user_id": user_id}
+    except Exception as e:
+        return {"error": str(e)}
+
+@app.post("/consume_inventory")
+def consume_inventory(user_id: str = Form(...), item_name: str = Form(...), count: int = Form(1)):
+    """
+    Mark items as used up: decrement the item's count. When nothing is left the
+    item is taken out of the expiry cache and recipes, but its document is kept
+    at count 0 so its purchase history still feeds the shopping list.
+    """
+    try:
+        ref = inventory_item_ref(db, user_id, item_name)
+        snapshot = ref.get()
+        if not snapshot.exists:
+            return {"error": f"Item '{item_name}' not found in inventory"}
+        data = snapshot.to_dict()
+        remaining = max(data.get('count', 0) - count, 0)
+        update = {'count': remaining, 'updated_at': datetime.utcnow().isoformat()}
+        if remaining == 0:
+            update.update({'expiryDate': None, 'expiresAt': None, 'consumed_at': update['updated_at']})
+        # Conditional on the snapshot, so a concurrent receipt update is not lost
+        ref.update(update, option=db.write_option(last_update_time=snapshot.update_time))
+        if remaining == 0:
+            inventory_item_changed(user_id, ref.id, None)
+            recipe_cache.inventory_changed(user_id)
+        else:
+            inventory_item_changed(user_id, ref.id, {**data, **update})
+        return {"item_name": item_name, "user_id": user_id, "remaining": remaining, "removed": remaining == 0}
+    except Exception as e:
+        return {"error": str(e)}
 
 @app.get("/budget_insights")
 def budget_insights(user_id: str = "testuser123", period: str = "monthly"):
     """
     Generate budget insights and spending analysis for the user.
     """
-    return budget_insights_data(user_id, period)
+    return budget_insights_data(user_id, period, forecaster=spending_forecaster)
 
 # --- Preset monthly budget and categories ---
 PRESET_BUDGET = {
@@ -1395,6 +2207,12 @@ PRESET_BUDGET = {
 }
 AVAILABLE_CATEGORIES = list(PRESET_BUDGET.keys())
 
+# Budget crossings and unusual amounts, checked as receipts and message expenses are stored
+spending_alerts = SpendingAlerts(
+    db, PRESET_BUDGET,
+    category_aliases={"food": "groceries", "transportation": "transport", "healthcare": "health"}
+) if SPEND_ALERTS_ENABLED else None
+
 
 # --- Robust Normalization ---
 def normalize_receipt(receipt: dict) -> dict:
@@ -1543,32 +2361,30 @@ def manual_categorize_receipt(normalized: dict) -> str:
 def analyze_spending(user_id: str):
     try:
         receipts_ref = db.collection("receipts_parsed").where("userId", "==", user_id)
-        docs = receipts_ref.stream()
-        spending = {category: 0 for category in AVAILABLE_CATEGORIES}
-        categorized_receipts = []
-        for doc in docs:
-            data = doc.to_dict()
-            receipt_data = data.get("data", data)
-            normalized = normalize_receipt(receipt_data)
-            category = manual_categorize_receipt(normalized)
-            total = normalized['total']
-            date = normalized.get('date') or 'unknown'
-            spending[category] += total
-            categorized_receipts.append({
-                "receiptId": doc.id,
-                "category": category,
-                "amount": total,
-                "date": date
-            })
-        overspent = {}
-        for category, spent_amount in spending.items():
-            budget = PRESET_BUDGET.get(category, 0)
-            if spent_amount > budget:
-                overspent[category] = {
-                    "spent": spent_amount,
-                    "budget": budget,
-                    "overspent_by": spent_amount - budget
-                }
+        dates = {}
+
+        def spending_record(doc_id, data):
+            normalized = normalize_receipt(data.get("data", data))
+            dates[doc_id] = normalized.get('date') or 'unknown'
+            return normalized.get('date'), normalized['total'], manual_categorize_receipt(normalized), None, None
+
+        table = SpendingTable.from_documents(receipts_ref.stream(), spending_record)
+        groups = table.group_by("category")
+        spending = {category: groups.get(category, {}).get("total", 0) for category in AVAILABLE_CATEGORIES}
+        categorized_receipts = [
+            {"receiptId": receipt_id, "category": category, "amount": float(amount), "date": dates[receipt_id]}
+            for receipt_id, category, amount in zip(table.ids, table.column("category"), table.amounts)
+        ]
+        spent = np.array([spending[category] for category in AVAILABLE_CATEGORIES])
+        budgets = np.array([PRESET_BUDGET.get(category, 0) for category in AVAILABLE_CATEGORIES])
+        overspent = {
+            AVAILABLE_CATEGORIES[i]: {
+                "spent": float(spent[i]),
+                "budget": int(budgets[i]),
+                "overspent_by": float(spent[i] - budgets[i])
+            }
+            for i in np.flatnonzero(spent > budgets)
+        }
         return {
             "spending_by_category": spending,
             "overspent_categories": overspent,
@@ -1671,13 +2487,19 @@ def read_message(message: str = Form(...), user_id: str = Form("testuser123")):
                         'category': category.lower(),
                         'userId': user_id,
                         'date': current_date,
+                        'spentAt': expense_timestamp(current_date),
                         'original_message': message,
                         'created_at': datetime.utcnow().isoformat()
                     }
                     
                     # Create a unique document ID
                     doc_id = f"{user_id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
-                    expenses_ref.document(doc_id).set(expense_doc)
+                    with BatchWriter(db) as writer:
+                        writer.set(expenses_ref.document(doc_id), expense_doc)
+                        record_expense(writer, db, expense_doc)
+                    if spending_alerts is not None:
+                        spending_alerts.submit(user_id, doc_id, expense_doc['spentAt'].date(),
+                                               expense_doc['category'], expense_doc['amount'])
                     
                     return {
                         "success": True,
@@ -2053,61 +2875,64 @@ def create_pass(
     except Exception as e:
         return {"error": str(e)}
 
+DEFAULT_SHOPPING_LIST = "Milk, Bread, Eggs, Bananas, Chicken, Rice, Vegetables, Yogurt, Cheese, Tomatoes"
+
+@lru_cache(maxsize=256)
+def phrase_shopping_list_with_gemini(item_names: tuple) -> str:
+    """Optional pass that turns canonical item names into a friendly comma-separated shopping list"""
+    model = genai.GenerativeModel("gemini-2.0-flash")
+    prompt = f"""
+    Rewrite these grocery items as a friendly shopping list, in the same order.
+    Keep exactly these items: do not add, drop or merge any.
+
+    Items: {json.dumps(list(item_names))}
+
+    Return ONLY a comma-separated list of items, no explanations or formatting.
+    Example: "Milk, Bread, Eggs, Bananas, Chicken, Rice, Vegetables"
+    """
+    result = model.generate_content(prompt)
+    shopping_list = result.text.strip()
+    # Clean up the response
+    shopping_list = re.sub(r'^["\']|["\']$', '', shopping_list)  # Remove quotes
+    shopping_list = re.sub(r'\n+', ', ', shopping_list)  # Replace newlines with commas
+    return re.sub(r'\s*,\s*', ', ', shopping_list)  # Clean up spacing
+
 @app.post("/generate-shopping-list")
-async def generate_shopping_list(user_id: str = Body(...)):
+async def generate_shopping_list(user_id: str = Body(...), horizon_days: int = Body(None), phrase: bool = Body(False)):
     """
-    Generate a smart shopping list using Gemini based on user's spending patterns.
+    Generate a shopping list from the user's purchase history: items whose predicted
+    depletion date (from purchase intervals, shelf life and expiry) falls within
+    horizon_days. With phrase=true, Gemini rewrites the names into a friendlier list.
     """
     try:
-        # Get user's recent receipts to analyze spending patterns
-        receipts_ref = db.collection("receipts_parsed").where("userId", "==", user_id)
-        receipts = receipts_ref.stream()
-        
-        receipts_data = []
-        for receipt in receipts:
-            receipt_data = receipt.to_dict()
-            receipts_data.append(receipt_data)
-        
-        if not receipts_data:
-            # Return a default shopping list if no receipts found
-            default_list = "Milk, Bread, Eggs, Bananas, Chicken, Rice, Vegetables, Yogurt, Cheese, Tomatoes"
-            return {"shopping_list": default_list}
-        
-        # Prepare data for Gemini
-        parsed_list = [r.get("parsedData", {}) for r in receipts_data]
-        
-        # Use Gemini to generate a smart shopping list
-        model = genai.GenerativeModel("gemini-2.0-flash")
-        prompt = f"""
-        Based on the user's recent spending patterns from their receipts, generate a smart shopping list.
-        
-        Receipt data: {json.dumps(parsed_list[:10])}  # Limit to last 10 receipts
-        
-        Generate a shopping list that:
-        1. Includes common household essentials
-        2. Suggests items the user might need based on their spending patterns
-        3. Is practical and realistic for a typical shopping trip
-        4. Includes 8-12 items maximum
-        
-        Return ONLY a comma-separated list of items, no explanations or formatting.
-        Example: "Milk, Bread, Eggs, Bananas, Chicken, Rice, Vegetables"
-        """
-        
-        result = model.generate_content(prompt)
-        shopping_list = result.text.strip()
-        
-        # Clean up the response
-        shopping_list = re.sub(r'^["\']|["\']$', '', shopping_list)  # Remove quotes
-        shopping_list = re.sub(r'\n+', ', ', shopping_list)  # Replace newlines with commas
-        shopping_list = re.sub(r'\s*,\s*', ', ', shopping_list)  # Clean up spacing
-        
-        return {"shopping_list": shopping_list}
-        
+        inventory = [doc.to_dict() for doc in user_inventory(db, user_id).stream()]
+        if not inventory:
+            # Return a default shopping list if the user has no purchase history yet
+            return {"shopping_list": DEFAULT_SHOPPING_LIST, "items": [], "source": "default"}
+
+        items = replenishment_list(inventory, horizon_days)
+        shopping_list = ", ".join(item["item_name"].title() for item in items)
+        source = "replenishment"
+        if phrase and items:
+            try:
+                phrased = phrase_shopping_list_with_gemini(tuple(item["item_name"] for item in items))
+                if phrased:
+                    shopping_list, source = phrased, "replenishment+gemini"
+            except Exception as e:
+                # The local list stands on its own
+                print(f"Error phrasing shopping list: {e}")
+
+        return {
+            "shopping_list": shopping_list,
+            "items": items,
+            "horizon_days": REPLENISH_HORIZON_DAYS if horizon_days is None else horizon_days,
+            "source": source
+        }
+
     except Exception as e:
         print(f"Error generating shopping list: {e}")
         # Return a default list on error
-        default_list = "Milk, Bread, Eggs, Bananas, Chicken, Rice, Vegetables, Yogurt, Cheese, Tomatoes"
-        return {"shopping_list": default_list}
+        return {"shopping_list": DEFAULT_SHOPPING_LIST, "items": [], "source": "default"}
 
 @app.get("/receipt_stats")
 def get_receipt_stats(user_id: str = Query(...)):
@@ -2130,44 +2955,17 @@ def get_receipt_stats(user_id: str = Query(...)):
     try:
         # Get all parsed receipts for the user
         receipts_ref = db.collection("receipts_parsed").where("userId", "==", user_id)
-        receipts = receipts_ref.stream()
-        
-        # Initialize category counters
-        category_breakdown = {
-            "groceries": 0,
-            "utilities": 0,
-            "transportation": 0,
-            "dining": 0,
-            "travel": 0,
-            "reimbursement": 0,
-            "home": 0
-        }
-        
-        total_receipts = 0
-        
-        # Process each receipt
-        for receipt in receipts:
-            receipt_data = receipt.to_dict()
-            total_receipts += 1
-            
-            # Get the parsed data
-            parsed_data = receipt_data.get('parsedData', {})
-            raw_data = parsed_data.get('raw', {})
-            
-            # Classify the receipt using the existing function
-            category = classify_with_gemini(raw_data)
-            
-            # Increment the appropriate category counter
-            if category and category in category_breakdown:
-                category_breakdown[category] += 1
-            else:
-                # If classification fails or returns unknown category, count as "home"
-                category_breakdown["home"] += 1
-        
+
+        def stats_record(doc_id, receipt):
+            # Classified from the categories stored at ingestion; receipts they don't place count as "home"
+            return None, None, chart_category(receipt) or "home", None, SOURCE_RECEIPT
+
+        table = SpendingTable.from_documents(receipts_ref.stream(), stats_record)
+        counts = table.counts("category")
         return {
             "user_id": user_id,
-            "total_receipts": total_receipts,
-            "category_breakdown": category_breakdown
+            "total_receipts": len(table),
+            "category_breakdown": {category: counts.get(category, 0) for category in CHART_CATEGORIES}
         }
         
     except Exception as e:
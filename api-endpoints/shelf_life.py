@@ -0,0 +1,138 @@
+import re
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+# Typical shelf life in days per item class, from purchase
+CLASS_SHELF_LIFE_DAYS = {
+    "leafy_greens": 3,
+    "meat": 3,
+    "fish": 2,
+    "produce": 7,
+    "fruit": 7,
+    "dairy": 10,
+    "eggs": 21,
+    "bakery": 6,
+    "beverages": 14,
+    "condiments": 180,
+    "snacks": 120,
+    "frozen": 240,
+    "canned": 540,
+    "dry_goods": 365,
+    "spices": 365,
+    "oils": 270,
+    "household": 730,
+}
+
+DEFAULT_CLASS = "produce"
+
+# Canonical items (see item_canonicalizer.CANONICAL_ITEMS) whose shelf life differs from their class
+ITEM_SHELF_LIFE_DAYS = {
+    "milk": 7,
+    "curd": 7,
+    "yogurt": 10,
+    "paneer": 5,
+    "cream": 7,
+    "cheese": 30,
+    "butter": 60,
+    "ghee": 270,
+    "bread": 6,
+    "bun": 4,
+    "cake": 4,
+    "biscuits": 180,
+    "cookies": 180,
+    "rusk": 120,
+    "potato": 30,
+    "onion": 30,
+    "garlic": 60,
+    "ginger": 21,
+    "carrot": 21,
+    "cabbage": 14,
+    "lemon": 21,
+    "apple": 30,
+    "orange": 21,
+    "banana": 5,
+    "papaya": 5,
+    "watermelon": 10,
+    "honey": 730,
+    "jaggery": 365,
+    "ice cream": 180,
+    "juice": 7,
+    "water": 365,
+    "soft drink": 180,
+}
+
+# Words that identify an item's class, matched against whole words of the item name
+CLASS_KEYWORDS = {
+    "leafy_greens": ("spinach", "palak", "lettuce", "coriander", "dhania", "mint", "methi", "leaves", "greens", "herbs"),
+    "meat": ("chicken", "mutton", "lamb", "beef", "pork", "meat", "sausage", "keema", "ham", "bacon"),
+    "fish": ("fish", "prawns", "prawn", "shrimp", "salmon", "tuna", "seafood", "crab"),
+    "frozen": ("frozen", "ice cream"),
+    "canned": ("canned", "tinned", "tin", "can"),
+    "dairy": ("milk", "curd", "dahi", "yogurt", "paneer", "cheese", "butter", "cream", "lassi", "buttermilk"),
+    "eggs": ("egg", "eggs"),
+    "bakery": ("bread", "bun", "pav", "cake", "croissant", "muffin", "bagel", "loaf"),
+    "fruit": ("apple", "banana", "orange", "mango", "grapes", "papaya", "melon", "pomegranate", "berries", "kiwi", "pear", "guava", "fruit"),
+    "produce": ("tomato", "potato", "onion", "carrot", "cabbage", "cauliflower", "capsicum", "cucumber",
+                "brinjal", "beans", "peas", "chilli", "vegetable", "veg", "gourd", "okra", "bhindi"),
+    "beverages": ("juice", "drink", "soda", "cola", "water", "tea", "coffee"),
+    "condiments": ("ketchup", "sauce", "jam", "pickle", "mayonnaise", "honey", "spread"),
+    "snacks": ("chips", "biscuits", "cookies", "namkeen", "chocolate", "snack", "crackers", "wafers"),
+    "dry_goods": ("rice", "atta", "flour", "maida", "sooji", "rava", "dal", "pasta", "noodles", "oats",
+                  "poha", "sugar", "salt", "rajma", "chickpeas", "chana", "cereal", "lentils"),
+    "spices": ("masala", "turmeric", "haldi", "cumin", "jeera", "powder", "spice", "pepper", "cardamom"),
+    "oils": ("oil",),
+    "household": ("soap", "shampoo", "toothpaste", "detergent", "dishwash", "tissues", "paper", "cleaner",
+                  "toothbrush", "sanitizer", "bulb", "battery"),
+}
+
+# Classes named by how the item is preserved win over what the item is ("frozen peas")
+PRESERVATION_CLASSES = ("frozen", "canned")
+
+# Printed expiry markers on receipts, e.g. "EXP 12/08/25", "Best before: 2025-08-12", or
+# the same as JSON fields in Gemini's parse ("expiry_date": "2025-08-12")
+_EXPIRY_MARKER = re.compile(
+    r"\b(?:exp(?:iry|ires|\.)?(?:[_\s]?date)?|best[_\s]+before|use[_\s]+by|sell[_\s]+by|bb|bbe)\b[\s:.\-\"']*"
+    r"(?:\d{1,4}[/\-.]\d{1,2}(?:[/\-.]\d{1,4})?|\d{1,2}\s*[a-z]{3,9}\s*\d{2,4}|[a-z]{3,9}\s*\d{2,4})",
+    re.IGNORECASE
+)
+
+
+def has_printed_expiry(receipt_text: str) -> bool:
+    """True when the receipt text has an expiry marker followed by a date."""
+    return bool(_EXPIRY_MARKER.search(receipt_text or ""))
+
+
+def classify_item(item_name: str) -> Optional[str]:
+    """Item class from keywords: preservation words first, then the last word (the head noun)."""
+    name = (item_name or "").lower()
+    words = re.findall(r"[a-z]+", name)
+    if not words:
+        return None
+    for item_class in PRESERVATION_CLASSES:
+        if any(word in CLASS_KEYWORDS[item_class] for word in words):
+            return item_class
+    for word in [words[-1]] + words[:-1]:
+        for item_class, keywords in CLASS_KEYWORDS.items():
+            if word in keywords:
+                return item_class
+    for item_class, keywords in CLASS_KEYWORDS.items():
+        if any(" " in keyword and keyword in name for keyword in keywords):
+            return item_class
+    return None
+
+
+def shelf_life_days(item_name: str) -> Tuple[int, str]:
+    """Return (days, source) where source is the matched item, class, or "default"."""
+    name = " ".join(re.findall(r"[a-z]+", (item_name or "").lower()))
+    if name in ITEM_SHELF_LIFE_DAYS:
+        return ITEM_SHELF_LIFE_DAYS[name], name
+    item_class = classify_item(name)
+    if item_class:
+        return CLASS_SHELF_LIFE_DAYS[item_class], item_class
+    return CLASS_SHELF_LIFE_DAYS[DEFAULT_CLASS], "default"
+
+
+def estimate_expiry_date(item_name: str, purchase_date: datetime = None) -> str:
+    """Expiry date (YYYY-MM-DD) from the shelf-life table, counted from purchase_date or today."""
+    days, _ = shelf_life_days(item_name)
+    return ((purchase_date or datetime.now()) + timedelta(days=days)).strftime('%Y-%m-%d')
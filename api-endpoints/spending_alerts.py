@@ -0,0 +1,231 @@
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+from google.api_core import exceptions as google_exceptions
+
+# Check receipts and message expenses for budget crossings and unusual amounts as they are stored
+SPEND_ALERTS_ENABLED = os.getenv("SPEND_ALERTS_ENABLED", "true").lower() == "true"
+# Fractions of a category's monthly budget that raise an alert when first crossed
+SPEND_ALERT_THRESHOLDS = [float(t) for t in os.getenv("SPEND_ALERT_THRESHOLDS", "0.8,1.0").split(",") if t.strip()]
+# Weight of the newest amount in the exponentially weighted statistics
+SPEND_ALERT_ALPHA = float(os.getenv("SPEND_ALERT_ALPHA", "0.1"))
+# z-score (and MAD score) above which an amount is unusual
+SPEND_ANOMALY_Z = float(os.getenv("SPEND_ANOMALY_Z", "3.0"))
+# Amounts seen in a category or at a vendor before its statistics are trusted
+SPEND_ANOMALY_MIN_HISTORY = int(os.getenv("SPEND_ANOMALY_MIN_HISTORY", "5"))
+# Amounts below this are never reported as unusual
+SPEND_ANOMALY_MIN_AMOUNT = float(os.getenv("SPEND_ANOMALY_MIN_AMOUNT", "20"))
+# Vendors whose statistics are kept per user (least recently seen dropped first)
+SPEND_ALERT_MAX_VENDORS = int(os.getenv("SPEND_ALERT_MAX_VENDORS", "100"))
+# Spend ids remembered per user so the same receipt or expense is never counted twice
+SPEND_ALERT_RECENT_IDS = int(os.getenv("SPEND_ALERT_RECENT_IDS", "200"))
+
+# Mean absolute deviation of a normal distribution is sigma * sqrt(2 / pi)
+MAD_TO_SIGMA = math.sqrt(math.pi / 2)
+
+
+def update_stats(stats: Dict[str, float], value: float, alpha: float) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Score value against exponentially weighted mean, variance and mean absolute
+    deviation, then fold it in. Returns (z-score, MAD score) from before the
+    update; None while there is no spread to compare with.
+    """
+    n = stats.get("n", 0)
+    if not n:
+        stats.update({"n": 1, "mean": value, "var": 0.0, "mad": 0.0})
+        return None, None
+    diff = value - stats["mean"]
+    z = diff / math.sqrt(stats["var"]) if stats["var"] > 0 else None
+    robust = diff / (MAD_TO_SIGMA * stats["mad"]) if stats["mad"] > 0 else None
+    increment = alpha * diff
+    stats["mean"] += increment
+    stats["var"] = (1 - alpha) * (stats["var"] + diff * increment)
+    stats["mad"] = (1 - alpha) * stats["mad"] + alpha * abs(diff)
+    stats["n"] = n + 1
+    return z, robust
+
+
+def previous_month(month: str) -> str:
+    year, number = int(month[:4]), int(month[5:7])
+    return f"{year - 1}-12" if number == 1 else f"{year}-{number - 1:02d}"
+
+
+def month_state(state: Dict[str, Any], month: str) -> Tuple[Optional[Dict[str, float]], Optional[Dict[str, float]]]:
+    """
+    The month's (category totals, highest threshold crossed per category). Spends
+    arrive slightly out of order around month ends, so the newest month and the one
+    before are kept; anything older is pruned, and a spend dated before both gets
+    (None, None) so it cannot touch the budget totals.
+    """
+    if "month" in state:
+        # State written when only the current month was kept
+        old = state.pop("month")
+        state["totals"], state["crossed"] = {old: state.get("totals", {})}, {old: state.get("crossed", {})}
+    totals, crossed = state.setdefault("totals", {}), state.setdefault("crossed", {})
+    oldest = previous_month(max([month, *totals]))
+    for stale in [m for m in totals if m < oldest]:
+        totals.pop(stale)
+        crossed.pop(stale, None)
+    if month < oldest:
+        return None, None
+    return totals.setdefault(month, {}), crossed.setdefault(month, {})
+
+
+def evaluate(state: Dict[str, Any], month: str, category: str, amount: float, vendor: Optional[str],
+             budget: Optional[float], budget_category: Optional[str], thresholds: List[float], alpha: float,
+             z_limit: float, min_history: int, min_amount: float, max_vendors: int) -> List[Dict[str, Any]]:
+    """
+    Fold one amount into a user's alert state (modified in place) and return the
+    alerts it raises. Touches one category total and the category's and vendor's
+    statistics, so it is O(1) in the user's history.
+    """
+    alerts = []
+    totals = crossed = None
+    if budget_category and budget:
+        totals, crossed = month_state(state, month)
+    if totals is not None:
+        before = totals.get(budget_category, 0.0)
+        totals[budget_category] = before + amount
+        passed = [t for t in thresholds if before < t * budget <= totals[budget_category] and t > crossed.get(budget_category, 0)]
+        if passed:
+            crossed[budget_category] = max(passed)
+            alerts.append({"type": "budget", "category": budget_category, "threshold": max(passed),
+                           "spent": totals[budget_category], "budget": budget})
+
+    # Amounts are compared on a log scale, where spend is far closer to normal
+    value = math.log1p(max(amount, 0.0))
+    state["seq"] = sequence = state.get("seq", 0) + 1
+    histories = [("category", category)] + ([("vendor", vendor)] if vendor else [])
+    for kind, name in histories:
+        group = state.setdefault("stats", {}).setdefault(kind, {})
+        stats = group.setdefault(name, {})
+        typical = math.expm1(stats["mean"]) if stats.get("n") else None
+        enough = stats.get("n", 0) >= min_history
+        z, robust = update_stats(stats, value, alpha)
+        if kind == "vendor":
+            stats["seen"] = sequence
+            while len(group) > max_vendors:
+                group.pop(min((v for v in group if v != name), key=lambda v: group[v].get("seen", 0)))
+        if (enough and amount >= min_amount and z is not None and robust is not None
+                and z >= z_limit and robust >= z_limit):
+            alerts.append({"type": "anomaly", "scope": kind, "name": name, "amount": amount,
+                           "typical": typical, "zScore": round(z, 2), "madScore": round(robust, 2)})
+    return alerts
+
+
+class SpendingAlerts:
+    """
+    Ingestion-time overspend and anomaly checks. Per user, a `spending_alert_state`
+    document keeps the latest two months' totals per budget category and exponentially
+    weighted statistics per category and vendor; observe() updates it in a
+    transaction and writes any alerts to the `notifications` collection, so each
+    receipt costs one document read and write whatever the user's history.
+
+    The state also keeps the ids of the user's most recent spends, so observing
+    the same spend again (a retried upload or check) changes nothing. Callers
+    observe a spend only once its documents are committed.
+    """
+
+    def __init__(self, db, budgets: Dict[str, float], category_aliases: Dict[str, str] = None,
+                 thresholds: List[float] = None, alpha: float = None, z_limit: float = None,
+                 min_history: int = None, min_amount: float = None, max_vendors: int = None,
+                 recent_ids: int = None, collection: str = "notifications", state_collection: str = "spending_alert_state"):
+        self.db = db
+        self.budgets = budgets
+        self.category_aliases = category_aliases or {}
+        self.thresholds = sorted(thresholds or SPEND_ALERT_THRESHOLDS)
+        self.alpha = alpha or SPEND_ALERT_ALPHA
+        self.z_limit = z_limit or SPEND_ANOMALY_Z
+        self.min_history = SPEND_ANOMALY_MIN_HISTORY if min_history is None else min_history
+        self.min_amount = SPEND_ANOMALY_MIN_AMOUNT if min_amount is None else min_amount
+        self.max_vendors = max_vendors or SPEND_ALERT_MAX_VENDORS
+        self.recent_ids = recent_ids or SPEND_ALERT_RECENT_IDS
+        self.collection = db.collection(collection)
+        self.state_collection = db.collection(state_collection)
+        self._executor = ThreadPoolExecutor(max_workers=2)
+
+    def budget_category(self, category: str) -> Optional[str]:
+        category = self.category_aliases.get(category, category)
+        return category if category in self.budgets else None
+
+    def observe(self, user_id: str, spend_id: str, day: date, category: Optional[str], amount: Optional[float],
+                vendor: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Check one receipt or message expense; returns the notifications written (none if spend_id was seen)"""
+        if not user_id or not amount or amount <= 0:
+            return []
+        category = category or "miscellaneous"
+        budget_category = self.budget_category(category)
+        ref = self.state_collection.document(user_id)
+
+        @firestore.transactional
+        def apply(transaction) -> List[Dict[str, Any]]:
+            snapshot = ref.get(transaction=transaction)
+            state = snapshot.to_dict() if snapshot.exists else {"userId": user_id}
+            seen = state.get("spendIds", [])
+            if spend_id in seen:
+                return []
+            state["spendIds"] = (seen + [spend_id])[-self.recent_ids:]
+            alerts = evaluate(state, day.strftime("%Y-%m"), category, float(amount), vendor,
+                              self.budgets.get(budget_category), budget_category, self.thresholds, self.alpha,
+                              self.z_limit, self.min_history, self.min_amount, self.max_vendors)
+            transaction.set(ref, state)
+            return alerts
+
+        written = []
+        for alert in apply(self.db.transaction()):
+            notification = self._notification(user_id, spend_id, day, alert)
+            if alert["type"] == "budget":
+                doc_id = f"budget_{user_id}_{alert['category']}_{day:%Y%m}_{int(alert['threshold'] * 100)}"
+            else:
+                doc_id = f"anomaly_{user_id}_{spend_id}_{alert['scope']}"
+            try:
+                self.collection.document(doc_id).create(notification)
+            except google_exceptions.AlreadyExists:
+                continue
+            written.append(notification)
+        return written
+
+    def submit(self, *args, **kwargs):
+        """observe() in the background, so uploads don't wait for the transaction"""
+        def run():
+            try:
+                self.observe(*args, **kwargs)
+            except Exception as e:
+                print(f"Spending alert check failed: {e}")
+        self._executor.submit(run)
+
+    def _notification(self, user_id: str, spend_id: str, day: date, alert: Dict[str, Any]) -> Dict[str, Any]:
+        notification = {"userId": user_id, "spendId": spend_id, "read": False, "createdAt": datetime.now(timezone.utc)}
+        if alert["type"] == "budget":
+            category, percent = alert["category"], int(alert["threshold"] * 100)
+            over = alert["threshold"] >= 1
+            return {
+                **notification,
+                "type": "budget",
+                "category": category,
+                "spent": round(alert["spent"], 2),
+                "budget": alert["budget"],
+                "threshold": alert["threshold"],
+                "title": f"{category.title()} budget {'exceeded' if over else f'{percent}% used'}",
+                "message": (f"You've spent ${alert['spent']:.2f} on {category} in {day:%B}, "
+                            f"{'over' if over else 'reaching ' + str(percent) + '% of'} your ${alert['budget']:.2f} budget."),
+            }
+        where = f"at {alert['name'].title()}" if alert["scope"] == "vendor" else f"on {alert['name']}"
+        return {
+            **notification,
+            "type": "anomaly",
+            "scope": alert["scope"],
+            "name": alert["name"],
+            "amount": round(alert["amount"], 2),
+            "typical": round(alert["typical"], 2) if alert["typical"] is not None else None,
+            "zScore": alert["zScore"],
+            "madScore": alert["madScore"],
+            "title": f"Unusual spend {where}",
+            "message": (f"${alert['amount']:.2f} {where} is well above your usual "
+                        f"${alert['typical']:.2f}." if alert["typical"] is not None else
+                        f"${alert['amount']:.2f} {where} is well above your usual spending."),
+        }
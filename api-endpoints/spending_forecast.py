@@ -0,0 +1,263 @@
+import os
+import math
+import threading
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from spending_analytics import SpendingTable
+from spending_store import spend_records
+
+# Days of daily spend a user's models are first fitted on
+SPENDING_FORECAST_HISTORY_DAYS = int(os.getenv("SPENDING_FORECAST_HISTORY_DAYS", "120"))
+# Days ahead next_month_prediction covers
+SPENDING_FORECAST_HORIZON_DAYS = int(os.getenv("SPENDING_FORECAST_HORIZON_DAYS", "30"))
+# Users whose fitted models are kept in memory
+SPENDING_FORECAST_CACHE_SIZE = int(os.getenv("SPENDING_FORECAST_CACHE_SIZE", "1024"))
+
+SEASON = 7
+# Days of one-step-ahead errors a model needs before it can be chosen over EWMA
+WARMUP_DAYS = 14
+# Weight of the newest one-step error in each model's running error
+ERROR_DECAY = 0.05
+# Two-sided 80% prediction interval
+INTERVAL_Z = 1.2816
+# Interval widening that brings the backtested coverage of the chosen model to 80%
+# (benchmarks/bench_spending_forecast.py: 73% without it); errors of spend totals
+# have heavier tails than the normal quantile assumes
+INTERVAL_CALIBRATION = 1.15
+# Until a model's horizon totals are scored, the variance of a total is taken as
+# this many times the sum of one-step variances (see SeriesForecaster); 3 gives
+# 80% coverage in the same backtest for forecasts made after 4-6 weeks of history
+CORRELATED_ERROR_FACTOR = 3.0
+
+
+class SeasonalNaive:
+    """Each day is forecast as the same weekday last week"""
+
+    def __init__(self):
+        self.last = np.zeros(SEASON)
+        self.t = 0
+
+    def predict(self, horizon: int) -> np.ndarray:
+        return self.last[(self.t + np.arange(horizon)) % SEASON]
+
+    def update(self, value: float):
+        self.last[self.t % SEASON] = value
+        self.t += 1
+
+
+class EWMA:
+    """Simple exponential smoothing: a flat forecast at the smoothed level"""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.level = None
+
+    def predict(self, horizon: int) -> np.ndarray:
+        return np.full(horizon, self.level or 0.0)
+
+    def update(self, value: float):
+        self.level = value if self.level is None else self.level + self.alpha * (value - self.level)
+
+
+class HoltWinters:
+    """
+    Additive Holt-Winters with a damped trend and weekly seasonality. The first
+    two weeks initialise level, trend and season; until then it forecasts their mean.
+    """
+
+    def __init__(self, alpha: float = 0.2, beta: float = 0.05, gamma: float = 0.3, phi: float = 0.9):
+        self.alpha, self.beta, self.gamma, self.phi = alpha, beta, gamma, phi
+        self.warmup = []
+        self.level = self.trend = 0.0
+        self.season = np.zeros(SEASON)
+        self.t = 0
+
+    def predict(self, horizon: int) -> np.ndarray:
+        if self.warmup is not None:
+            return np.full(horizon, float(np.mean(self.warmup)) if self.warmup else 0.0)
+        steps = np.arange(1, horizon + 1)
+        damped = np.cumsum(self.phi ** steps)
+        return self.level + damped * self.trend + self.season[(self.t + steps - 1) % SEASON]
+
+    def update(self, value: float):
+        if self.warmup is not None:
+            self.warmup.append(value)
+            if len(self.warmup) == 2 * SEASON:
+                first, second = np.array(self.warmup[:SEASON]), np.array(self.warmup[SEASON:])
+                self.trend = (second.mean() - first.mean()) / SEASON
+                self.level = second.mean() + self.trend * (SEASON - 1) / 2
+                self.season = (first + second) / 2 - (first.mean() + second.mean()) / 2
+                self.t = 2 * SEASON
+                self.warmup = None
+            return
+        index = self.t % SEASON
+        previous_level = self.level
+        self.level = self.alpha * (value - self.season[index]) + (1 - self.alpha) * (previous_level + self.phi * self.trend)
+        self.trend = self.beta * (self.level - previous_level) + (1 - self.beta) * self.phi * self.trend
+        self.season[index] = self.gamma * (value - self.level) + (1 - self.gamma) * self.season[index]
+        self.t += 1
+
+
+def default_models() -> Dict[str, Any]:
+    return {
+        "seasonal_naive": SeasonalNaive(),
+        "ewma_fast": EWMA(0.3),
+        "ewma_slow": EWMA(0.05),
+        "holt_winters": HoltWinters(),
+    }
+
+
+class SeriesForecaster:
+    """
+    Candidate models for one daily series, all updated one day at a time. Each
+    keeps an exponentially weighted mean squared one-step-ahead error, which picks
+    the model that forecasts.
+
+    The prediction interval is sized from the errors of the horizon-day totals
+    each model forecast in the past, scored once those days have passed. Daily
+    errors are correlated (a missed monthly bill or a level shift carries over
+    many days), so one-step errors scaled by the horizon understate the spread
+    of a total; they are only used, and widened, until the totals are scored.
+    """
+
+    def __init__(self, models: Dict[str, Any] = None, horizon: int = None):
+        self.models = models or default_models()
+        self.horizon = horizon or SPENDING_FORECAST_HORIZON_DAYS
+        self.mse = {name: 0.0 for name in self.models}
+        self.scored = {name: 0 for name in self.models}
+        # Mean squared error of horizon-day totals, and the totals not yet scored
+        self.total_mse = {name: 0.0 for name in self.models}
+        self.totals_scored = {name: 0 for name in self.models}
+        self._pending = {name: deque() for name in self.models}
+        self._window = deque(maxlen=self.horizon)
+        self.days = 0
+
+    @staticmethod
+    def _decay(mse: float, error: float, scored: int) -> float:
+        weight = max(ERROR_DECAY, 1.0 / (scored + 1))
+        return mse + weight * (error * error - mse)
+
+    def update(self, value: float):
+        self._window.append(value)
+        window_total = sum(self._window)
+        for name, model in self.models.items():
+            if self.days:
+                error = value - float(model.predict(1)[0])
+                self.mse[name] = self._decay(self.mse[name], error, self.scored[name])
+                self.scored[name] += 1
+            self._pending[name].append(float(np.clip(model.predict(self.horizon), 0, None).sum()))
+            if len(self._pending[name]) == self.horizon:
+                # Made horizon - 1 days ago, before the first day now in the window
+                error = window_total - self._pending[name].popleft()
+                self.total_mse[name] = self._decay(self.total_mse[name], error, self.totals_scored[name])
+                self.totals_scored[name] += 1
+            model.update(value)
+        self.days += 1
+
+    def update_many(self, values):
+        for value in values:
+            self.update(float(value))
+
+    def best(self) -> str:
+        ready = [name for name in self.models if self.scored[name] >= WARMUP_DAYS]
+        if not ready:
+            return "ewma_fast" if "ewma_fast" in self.models else next(iter(self.models))
+        return min(ready, key=lambda name: self.mse[name])
+
+    def forecast(self, horizon: int, model: str = None) -> Dict[str, Any]:
+        """Total over the next `horizon` days with an 80% interval"""
+        model = model or self.best()
+        point = float(np.clip(self.models[model].predict(horizon), 0, None).sum())
+        if self.totals_scored[model] >= WARMUP_DAYS:
+            # Variance of a total taken to grow with its length
+            variance = self.total_mse[model] * horizon / self.horizon
+        else:
+            variance = self.mse[model] * horizon * CORRELATED_ERROR_FACTOR
+        spread = INTERVAL_Z * INTERVAL_CALIBRATION * math.sqrt(variance)
+        return {"total": point, "low": max(point - spread, 0.0), "high": point + spread, "model": model}
+
+
+class _UserForecast:
+    def __init__(self, start: date, horizon: int):
+        self.categories: Dict[str, SeriesForecaster] = {}
+        self.start = start
+        self.horizon = horizon
+        # Last complete day the models have seen
+        self.through = start - timedelta(days=1)
+        self.lock = threading.Lock()
+
+    def extend(self, table: SpendingTable, start: date, end: date):
+        """Feed days [start, end); categories seen for the first time get zeros for earlier days"""
+        for category in set(self.categories) | {str(c) for c in table.vocab["category"][np.unique(table.codes["category"])]}:
+            forecaster = self.categories.get(category)
+            if forecaster is None:
+                forecaster = self.categories[category] = SeriesForecaster(horizon=self.horizon)
+                forecaster.update_many(np.zeros((start - self.start).days))
+            _, totals = table.where(table.is_("category", category)).daily_series(start, end)
+            forecaster.update_many(totals)
+        self.through = end - timedelta(days=1)
+
+
+class SpendingForecaster:
+    """
+    Per-user, per-category spend forecasts over the daily series of receipts and
+    message expenses. A user's models are fitted on SPENDING_FORECAST_HISTORY_DAYS
+    the first time and then only fed the days since, so a cached user costs one
+    small range query per day at most. Only complete (UTC) days are used.
+    """
+
+    def __init__(self, db, history_days: int = None, horizon_days: int = None, size: int = None):
+        self.db = db
+        self.history_days = history_days or SPENDING_FORECAST_HISTORY_DAYS
+        self.horizon_days = horizon_days or SPENDING_FORECAST_HORIZON_DAYS
+        self.size = size or SPENDING_FORECAST_CACHE_SIZE
+        self._users: "OrderedDict[str, _UserForecast]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, user_id: str, start: date, end: date) -> SpendingTable:
+        return SpendingTable.from_rows(
+            (None, day, amount, category or "miscellaneous", None, source)
+            for day, source, category, amount in spend_records(self.db, user_id, start, end)
+        )
+
+    def _entry(self, user_id: str, end: date) -> _UserForecast:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or (end - entry.through).days > self.history_days:
+                entry = self._users[user_id] = _UserForecast(end - timedelta(days=self.history_days), self.horizon_days)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+            return entry
+
+    def forecast(self, user_id: str, today: date = None, horizon_days: int = None) -> Dict[str, Any]:
+        """
+        {"total", "low", "high", "horizon_days", "history_days", "categories":
+        {category: {"total", "low", "high", "model"}}} for the days from today on
+        """
+        end = today or datetime.now(timezone.utc).date()
+        horizon = horizon_days or self.horizon_days
+        entry = self._entry(user_id, end)
+        with entry.lock:
+            start = entry.through + timedelta(days=1)
+            if start < end:
+                entry.extend(self._load(user_id, start, end), start, end)
+            categories = {category: forecaster.forecast(horizon) for category, forecaster in entry.categories.items()}
+        total = sum(c["total"] for c in categories.values())
+        # Category errors taken as independent: variances add
+        spread = math.sqrt(sum((c["high"] - c["total"]) ** 2 for c in categories.values()))
+        return {
+            "total": round(total, 2),
+            "low": round(max(total - spread, 0.0), 2),
+            "high": round(total + spread, 2),
+            "horizon_days": horizon,
+            "history_days": (entry.through - entry.start).days + 1,
+            "categories": {
+                category: {**c, "total": round(c["total"], 2), "low": round(c["low"], 2), "high": round(c["high"], 2)}
+                for category, c in sorted(categories.items(), key=lambda item: -item[1]["total"])
+            },
+        }
@@ -0,0 +1,351 @@
+import os
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from firebase_admin import firestore
+
+from firestore_batch import BatchWriter
+from spending_analytics import SOURCE_RECEIPT, SOURCE_MESSAGE
+from spending_store import spend_records
+
+# Read budget periods from rollups instead of raw receipts when they cover the period
+SPENDING_ROLLUPS_ENABLED = os.getenv("SPENDING_ROLLUPS_ENABLED", "true").lower() == "true"
+# Months (the current one included) every compaction run recomputes from raw documents
+ROLLUP_COMPACT_MONTHS = int(os.getenv("ROLLUP_COMPACT_MONTHS", "2"))
+
+ROLLUPS_COLLECTION = "spending_rollups"
+ROLLUP_STATE_COLLECTION = "spending_rollup_state"
+GRANULARITIES = ("day", "week", "month")
+SOURCES = (SOURCE_RECEIPT, SOURCE_MESSAGE)
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def week_start(day: date) -> date:
+    """Monday of the ISO week"""
+    return day - timedelta(days=day.weekday())
+
+
+def bucket_key(granularity: str, day: date) -> str:
+    """2026-10-19 (day), 2026-W43 (ISO week) or 2026-10 (month)"""
+    if granularity == "day":
+        return day.isoformat()
+    if granularity == "week":
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}"
+    return day.strftime("%Y-%m")
+
+
+def bucket_bounds(granularity: str, day: date) -> Tuple[date, date]:
+    """[start, end) of the bucket containing day"""
+    if granularity == "day":
+        return day, day + timedelta(days=1)
+    if granularity == "week":
+        start = week_start(day)
+        return start, start + timedelta(days=7)
+    return month_start(day), next_month(day)
+
+
+def rollup_ref(db, user_id: str, granularity: str, key: str):
+    return db.collection(ROLLUPS_COLLECTION).document(f"{user_id}_{granularity}_{key}")
+
+
+def state_ref(db, user_id: str):
+    return db.collection(ROLLUP_STATE_COLLECTION).document(user_id)
+
+
+def _field(name: Optional[str]) -> str:
+    # Category names become map keys; keep them valid field path segments
+    name = str(name or "miscellaneous").strip().lower()
+    return "".join(c if c.isalnum() or c in "_-" else "_" for c in name) or "miscellaneous"
+
+
+def _utc(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+
+
+def record_spend(writer: BatchWriter, db, user_id: str, day: date, source: str,
+                 category: Optional[str], amount: float, complete: bool = True):
+    """
+    Add one receipt or message expense to its day, week and month rollups with
+    increments. Spend without a known total is counted with amount 0 and its
+    month marked for compaction (complete=False).
+    """
+    category = _field(category)
+    for granularity in GRANULARITIES:
+        start, _ = bucket_bounds(granularity, day)
+        key = bucket_key(granularity, day)
+        writer.set(rollup_ref(db, user_id, granularity, key), {
+            "userId": user_id,
+            "granularity": granularity,
+            "bucket": key,
+            "start": _utc(start),
+            "updatedAt": firestore.SERVER_TIMESTAMP,
+            source: {
+                "categories": {category: {"total": firestore.Increment(amount), "count": firestore.Increment(1)}},
+                "daily": {day.isoformat(): firestore.Increment(amount)},
+            },
+        }, merge=True)
+    if not complete:
+        mark_dirty(writer, db, user_id, day)
+
+
+def record_receipt(writer: BatchWriter, db, parsed_doc: Dict[str, Any]):
+    """Roll up a receipts_parsed document as it is written"""
+    record_spend(writer, db, parsed_doc["userId"], parsed_doc["createdAt"].date(), SOURCE_RECEIPT,
+                 parsed_doc.get("spendCategory"), float(parsed_doc.get("totalAmount") or 0.0),
+                 complete="totalAmount" in parsed_doc and "spendCategory" in parsed_doc)
+
+
+def record_expense(writer: BatchWriter, db, expense_doc: Dict[str, Any]):
+    """Roll up an expenses_from_messages document as it is written"""
+    record_spend(writer, db, expense_doc["userId"], expense_doc["spentAt"].date(), SOURCE_MESSAGE,
+                 expense_doc.get("category"), float(expense_doc.get("amount") or 0.0))
+
+
+def mark_dirty(writer: BatchWriter, db, user_id: str, day: date):
+    """Queue the month of day for the next compaction run"""
+    writer.set(state_ref(db, user_id), {"userId": user_id, "dirtyMonths": firestore.ArrayUnion([bucket_key("month", day)])},
+               merge=True)
+
+
+def month_keys(start: date, end: date) -> List[str]:
+    """Keys of the months overlapping [start, end)"""
+    keys = []
+    month = month_start(start)
+    while month < end:
+        keys.append(bucket_key("month", month))
+        month = next_month(month)
+    return keys
+
+
+def decompose(start: date, end: date) -> List[Tuple[str, date]]:
+    """
+    The fewest (granularity, day) buckets covering [start, end): whole months,
+    then ISO weeks, then days. A week that would swallow the first day of a whole
+    month in the range is split into days instead.
+    """
+    buckets = []
+    day = start
+    while day < end:
+        if day.day == 1 and next_month(day) <= end:
+            buckets.append(("month", day))
+            day = next_month(day)
+            continue
+        week_end = day + timedelta(days=7)
+        if day.weekday() == 0 and week_end <= end:
+            first = next_month(day)
+            if not (first < week_end and next_month(first) <= end):
+                buckets.append(("week", day))
+                day = week_end
+                continue
+        buckets.append(("day", day))
+        day += timedelta(days=1)
+    return buckets
+
+
+def category_breakdown(categories: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """{category: {total, count, average, percentage}}, the shape of SpendingTable.group_by"""
+    grand_total = sum(group["total"] for group in categories.values())
+    return {
+        category: {
+            "total": group["total"],
+            "count": group["count"],
+            "average": group["total"] / group["count"] if group["count"] else 0,
+            "percentage": group["total"] / grand_total * 100 if grand_total > 0 else 0,
+        }
+        for category, group in categories.items() if group["count"]
+    }
+
+
+def spending_between(db, user_id: str, start: date, end: date) -> Optional[Dict[str, Any]]:
+    """
+    Spending for [start, end) from the coarsest rollups that cover it:
+    {source: {"categories": {category: {total, count}}, "daily": {YYYY-MM-DD: total}}, "buckets": n}.
+    None if the user's rollups have not been compacted back to start, or a month
+    in the range is dirty (it holds spend counted without its total or category).
+    """
+    state = state_ref(db, user_id).get()
+    state_data = state.to_dict() if state.exists else {}
+    covered_from = state_data.get("coveredFrom")
+    if covered_from is None or _utc(start) < covered_from:
+        return None
+    if set(state_data.get("dirtyMonths") or []) & set(month_keys(start, end)):
+        return None
+    buckets = decompose(start, end)
+    refs = [rollup_ref(db, user_id, granularity, bucket_key(granularity, day)) for granularity, day in buckets]
+    result = {source: {"categories": {}, "daily": {}} for source in SOURCES}
+    for doc in db.get_all(refs):
+        if not doc.exists:
+            continue
+        data = doc.to_dict()
+        for source in SOURCES:
+            rollup = data.get(source) or {}
+            categories = result[source]["categories"]
+            for category, group in (rollup.get("categories") or {}).items():
+                merged = categories.setdefault(category, {"total": 0.0, "count": 0})
+                merged["total"] += group.get("total", 0.0)
+                merged["count"] += group.get("count", 0)
+            for day, total in (rollup.get("daily") or {}).items():
+                result[source]["daily"][day] = result[source]["daily"].get(day, 0.0) + total
+    result["buckets"] = len(buckets)
+    return result
+
+
+def _empty_bucket(user_id: str, granularity: str, day: date) -> Dict[str, Any]:
+    key = bucket_key(granularity, day)
+    return {"userId": user_id, "granularity": granularity, "bucket": key,
+            "start": _utc(bucket_bounds(granularity, day)[0]), **{s: {"categories": {}, "daily": {}} for s in SOURCES}}
+
+
+def _add_spend(data: Dict[str, Any], source: str, category: str, day: str, total: float, count: int):
+    group = data[source]["categories"].setdefault(category, {"total": 0.0, "count": 0})
+    group["total"] += total
+    group["count"] += count
+    data[source]["daily"][day] = data[source]["daily"].get(day, 0.0) + total
+
+
+def _merge_open_days(db, user_id: str, open_days: List[date], open_buckets: Dict[Tuple[str, str], date],
+                     buckets: Dict[Tuple[str, str], Dict[str, Any]]):
+    """
+    Write the week and month buckets that still take increments: their recomputed
+    earlier days plus the open days' spend as ingestion recorded it in their day
+    buckets. Reading those in the transaction keeps increments committed meanwhile.
+    """
+    @firestore.transactional
+    def apply(transaction):
+        stored_days = []
+        for day in open_days:
+            snapshot = rollup_ref(db, user_id, "day", bucket_key("day", day)).get(transaction=transaction)
+            stored_days.append((day, snapshot.to_dict() if snapshot.exists else {}))
+        for (granularity, key), bucket_day in open_buckets.items():
+            data = _empty_bucket(user_id, granularity, bucket_day)
+            recomputed = buckets.get((granularity, key))
+            for source in SOURCES if recomputed else ():
+                for category, group in recomputed[source]["categories"].items():
+                    data[source]["categories"][category] = dict(group)
+                data[source]["daily"].update(recomputed[source]["daily"])
+            for day, stored in stored_days:
+                if bucket_key(granularity, day) != key:
+                    continue
+                for source in SOURCES:
+                    for category, group in ((stored.get(source) or {}).get("categories") or {}).items():
+                        _add_spend(data, source, category, day.isoformat(), group.get("total", 0.0), group.get("count", 0))
+            ref = rollup_ref(db, user_id, granularity, key)
+            if any(data[source]["categories"] for source in SOURCES):
+                transaction.set(ref, {**data, "updatedAt": firestore.SERVER_TIMESTAMP})
+            else:
+                transaction.delete(ref)
+
+    apply(db.transaction())
+
+
+def compact(db, user_id: str, first_month: date, end_month: date, writer: BatchWriter = None,
+            extractor=None) -> Dict[str, int]:
+    """
+    Recompute the user's rollups for the months in [first_month, end_month) from
+    raw documents and overwrite them, fixing late, edited or re-extracted spend
+    and any increment applied twice by a retried commit. The ISO weeks that
+    straddle either end are recomputed whole. Receipts without a stored total or
+    category go to extractor (a SpendExtractor) if given; months where one is
+    still missing stay dirty, so budget insights keep reading their documents.
+
+    Today and tomorrow (message expenses are dated by local day) still take
+    increments: their day buckets are kept as ingestion wrote them, and the week
+    and month holding them are written in a transaction with that spend added.
+    """
+    first_month, end_month = month_start(first_month), month_start(end_month)
+    start, end = week_start(first_month), week_start(end_month - timedelta(days=1)) + timedelta(days=7)
+    today = datetime.now(timezone.utc).date()
+    open_days = [day for day in (today, today + timedelta(days=1)) if start <= day < end]
+    buckets: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    records = 0
+    pending: List[date] = []
+    for day, source, category, amount in spend_records(db, user_id, start, end, extractor, pending):
+        records += 1
+        if day in open_days:
+            continue
+        for granularity in GRANULARITIES:
+            bucket_start, bucket_end = bucket_bounds(granularity, day)
+            if granularity == "month" and not (first_month <= bucket_start and bucket_end <= end_month):
+                continue
+            data = buckets.setdefault((granularity, bucket_key(granularity, day)), _empty_bucket(user_id, granularity, day))
+            _add_spend(data, source, _field(category), day.isoformat(), amount, 1)
+    # Week and month buckets holding an open day, with that day
+    open_buckets = {}
+    for day in open_days:
+        open_buckets[("week", bucket_key("week", day))] = day
+        bucket_start, bucket_end = bucket_bounds("month", day)
+        if first_month <= bucket_start and bucket_end <= end_month:
+            open_buckets[("month", bucket_key("month", day))] = day
+    open_day_keys = {("day", bucket_key("day", day)) for day in open_days}
+    owns_writer = writer is None
+    writer = writer or BatchWriter(db)
+    # Buckets in the window that no longer have any spend are removed
+    existing = (db.collection(ROLLUPS_COLLECTION).where("userId", "==", user_id)
+                .where("start", ">=", _utc(start)).where("start", "<", _utc(end))
+                .select(["granularity", "bucket", "start"]).stream())
+    removed = 0
+    for doc in existing:
+        data = doc.to_dict()
+        key = (data.get("granularity"), data.get("bucket"))
+        if key in buckets or key in open_buckets or key in open_day_keys:
+            continue
+        # The month after the window can start inside its last week
+        if data.get("granularity") == "month" and data["start"].date() >= end_month:
+            continue
+        writer.delete(doc.reference)
+        removed += 1
+    for (granularity, key), data in buckets.items():
+        if (granularity, key) not in open_buckets:
+            writer.set(rollup_ref(db, user_id, granularity, key), {**data, "updatedAt": firestore.SERVER_TIMESTAMP})
+    if open_buckets:
+        _merge_open_days(db, user_id, open_days, open_buckets, buckets)
+
+    months = month_keys(first_month, end_month)
+    unresolved = {bucket_key("month", day) for day in pending}
+    clean = [key for key in months if key not in unresolved]
+    if clean:
+        writer.set(state_ref(db, user_id), {"userId": user_id, "dirtyMonths": firestore.ArrayRemove(clean)}, merge=True)
+    if unresolved & set(months):
+        writer.set(state_ref(db, user_id), {"userId": user_id,
+                                            "dirtyMonths": firestore.ArrayUnion(sorted(unresolved & set(months)))}, merge=True)
+    if owns_writer:
+        writer.flush()
+    return {"records": records, "buckets": len(buckets), "removed": removed, "months": len(months),
+            "unresolved": sum(1 for day in pending if first_month <= day < end_month)}
+
+
+def compact_user(db, user_id: str, months: int = None, writer: BatchWriter = None,
+                 extractor=None) -> Dict[str, int]:
+    """
+    Recompute the last `months` months and any older months marked dirty. Rollups
+    are complete from the earliest recent month on, since ingestion keeps them current.
+    """
+    today = datetime.now(timezone.utc).date()
+    first_month = month_start(today)
+    for _ in range((months or ROLLUP_COMPACT_MONTHS) - 1):
+        first_month = month_start(first_month - timedelta(days=1))
+    owns_writer = writer is None
+    writer = writer or BatchWriter(db)
+
+    state = state_ref(db, user_id).get()
+    state_data = state.to_dict() if state.exists else {}
+    summary = compact(db, user_id, first_month, next_month(today), writer, extractor)
+    for key in sorted(set(state_data.get("dirtyMonths") or [])):
+        month = datetime.strptime(key, "%Y-%m").date()
+        if month < first_month:
+            older = compact(db, user_id, month, next_month(month), writer, extractor)
+            summary = {name: summary[name] + older[name] for name in summary}
+    covered_from = state_data.get("coveredFrom")
+    if covered_from is None or _utc(first_month) < covered_from:
+        writer.set(state_ref(db, user_id), {"userId": user_id, "coveredFrom": _utc(first_month)}, merge=True)
+    if owns_writer:
+        writer.flush()
+    return summary
@@ -0,0 +1,77 @@
+from datetime import date, datetime, timezone
+from typing import Iterable, Optional, Tuple
+
+from spending_analytics import SOURCE_RECEIPT, SOURCE_MESSAGE
+from receipt_spend import stored_spend
+
+RECEIPTS_COLLECTION = "receipts_parsed"
+EXPENSES_COLLECTION = "expenses_from_messages"
+
+
+def to_utc(moment: datetime) -> datetime:
+    """An aware UTC datetime; naive datetimes are taken as local time, like datetime.now()"""
+    return moment.astimezone(timezone.utc)
+
+
+def receipt_timestamp(timestamp: Optional[str]) -> Optional[datetime]:
+    """createdAt for a receipt's ISO `timestamp` string, which is written in UTC"""
+    try:
+        moment = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return None
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment.astimezone(timezone.utc)
+
+
+def expense_timestamp(expense_date: Optional[str]) -> Optional[datetime]:
+    """spentAt for an expense's date (YYYY-MM-DD): the start of that day, stored as UTC"""
+    try:
+        return datetime.strptime(expense_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+def receipts_between(db, user_id: Optional[str], start: datetime, end: datetime = None):
+    """Parsed receipts uploaded from start up to end (uses the (userId, createdAt) index)"""
+    query = db.collection(RECEIPTS_COLLECTION)
+    if user_id:
+        query = query.where("userId", "==", user_id)
+    query = query.where("createdAt", ">=", to_utc(start))
+    return query.where("createdAt", "<", to_utc(end)) if end else query
+
+
+def expenses_between(db, user_id: Optional[str], start_date: str, end_date: str = None):
+    """Message expenses dated from start_date up to end_date, both YYYY-MM-DD (uses the (userId, spentAt) index)"""
+    query = db.collection(EXPENSES_COLLECTION)
+    if user_id:
+        query = query.where("userId", "==", user_id)
+    query = query.where("spentAt", ">=", expense_timestamp(start_date))
+    return query.where("spentAt", "<", expense_timestamp(end_date)) if end_date else query
+
+
+def spend_records(db, user_id: str, start: date, end: date, extractor=None,
+                  pending: list = None) -> Iterable[Tuple[date, str, str, float]]:
+    """
+    (day, source, category, amount) for the user's receipts and message expenses
+    dated in [start, end), with receipt totals and categories as stored (or parsed
+    locally); receipts are dated by their UTC upload day. Receipts missing either
+    are sent to extractor (a SpendExtractor) when given; the days of those still
+    missing one are appended to pending.
+    """
+    receipts = [(doc.id, doc.to_dict()) for doc in receipts_between(db, user_id, _utc_day(start), _utc_day(end)).stream()]
+    spend = {doc_id: stored_spend(receipt) for doc_id, receipt in receipts}
+    missing = [(doc_id, receipt.get("parsedData", {}).get("raw", "")) for doc_id, receipt in receipts if len(spend[doc_id]) < 2]
+    if extractor is not None and missing:
+        for doc_id, fields in extractor.resolve(db, missing).items():
+            spend[doc_id] = {**fields, **spend[doc_id]}
+    for doc_id, receipt in receipts:
+        day = receipt["createdAt"].date()
+        if pending is not None and len(spend[doc_id]) < 2:
+            pending.append(day)
+        yield day, SOURCE_RECEIPT, spend[doc_id].get("spendCategory"), float(spend[doc_id].get("totalAmount") or 0.0)
+    for doc in expenses_between(db, user_id, start.isoformat(), end.isoformat()).stream():
+        expense = doc.to_dict()
+        yield expense["spentAt"].date(), SOURCE_MESSAGE, expense.get("category"), float(expense.get("amount") or 0.0)
+
+
+def _utc_day(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
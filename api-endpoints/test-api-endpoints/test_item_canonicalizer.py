@@ -0,0 +1,69 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from item_canonicalizer import ItemCanonicalizer
+
+# Labelled receipt item names: (raw name, expected canonical name)
+ACCURACY_SET = [
+    ("CKN", "chicken"),
+    ("Chkn Breast 500g", "chicken"),
+    ("Amul Milk 500ml", "milk"),
+    ("Toned Milk 1L", "milk"),
+    ("milk 2%", "milk"),
+    ("Tomatoes 1kg", "tomato"),
+    ("Onion 2 kg", "onion"),
+    ("potatos", "potato"),
+    ("Toor Dhal 1kg", "toor dal"),
+    ("Arhar Dal", "toor dal"),
+    ("Basmati Rice 5 KG", "basmati rice"),
+    ("Fortune Sunflower Oil 1L", "sunflower oil"),
+    ("Bread loaf", "bread"),
+    ("Brown Bread", "bread"),
+    ("Lays Potato Chips", "chips"),
+    ("Dairy Milk Chocolate", "chocolate"),
+    ("Bananas", "banana"),
+    ("Dahi 400g", "curd"),
+    ("Aashirvaad Atta 5kg", "atta"),
+    ("Colgate Toothpaste", "toothpaste"),
+]
+
+# Names that contain or resemble a canonical item but are a different product,
+# so they must be left for the model rather than matched locally
+DIFFERENT_PRODUCTS = ["Mango Pickle", "Peanut Butter", "Coconut Water", "Butter Milk"]
+
+
+def run_accuracy_test():
+    """Canonicalize the labelled set without any model calls and report accuracy"""
+    canonicalizer = ItemCanonicalizer()
+    correct = 0
+    for raw_name, expected in ACCURACY_SET:
+        canonical, source = canonicalizer.canonicalize("testuser123", raw_name)
+        ok = canonical == expected
+        correct += ok
+        print(f"{'✅' if ok else '❌'} {raw_name!r} -> {canonical!r} ({source}), expected {expected!r}")
+
+    accuracy = correct / len(ACCURACY_SET)
+    print(f"\nAccuracy: {correct}/{len(ACCURACY_SET)} ({accuracy:.0%})")
+    return accuracy
+
+
+def run_different_product_test():
+    """Names of other products must stay unmatched without a resolver"""
+    canonicalizer = ItemCanonicalizer()
+    unmatched = 0
+    for raw_name in DIFFERENT_PRODUCTS:
+        canonical, source = canonicalizer.canonicalize("testuser123", raw_name)
+        ok = source == "unmatched"
+        unmatched += ok
+        print(f"{'✅' if ok else '❌'} {raw_name!r} -> {canonical!r} ({source}), expected unmatched")
+
+    print(f"\nLeft for the model: {unmatched}/{len(DIFFERENT_PRODUCTS)}")
+    return unmatched == len(DIFFERENT_PRODUCTS)
+
+
+if __name__ == "__main__":
+    print("🧪 TESTING ITEM NAME CANONICALIZATION")
+    run_accuracy_test()
+    run_different_product_test()
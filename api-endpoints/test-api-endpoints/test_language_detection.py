@@ -0,0 +1,54 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from language_detection import detect_language_with_confidence
+
+# Labelled sentences: (text, expected language code)
+ACCURACY_SET = [
+    ("Show my recent expenses", "en"),
+    ("How much did I spend on groceries last month?", "en"),
+    ("Hi", "en"),
+    ("मेरे हाल के खर्च दिखाएं", "hi"),
+    ("पिछले महीने मैंने किराने पर कितना खर्च किया?", "hi"),
+    ("क्या मेरा बजट ठीक है?", "hi"),
+    ("नमस्ते, आप कैसे हैं?", "hi"),
+    ("मुझे दूध और ब्रेड खरीदना है", "hi"),
+    ("माझे अलीकडील खर्च दाखवा", "mr"),
+    ("मागच्या महिन्यात मी किराणा मालावर किती खर्च केला?", "mr"),
+    ("नमस्कार, तुम्ही कसे आहात?", "mr"),
+    ("माझा बजेट ठीक आहे का?", "mr"),
+    ("मला दूध आणि ब्रेड घ्यायचे आहे", "mr"),
+    ("எனது சமீபத்திய செலவுகளைக் காட்டு", "ta"),
+    ("கடந்த மாதம் மளிகைப் பொருட்களுக்கு எவ்வளவு செலவு செய்தேன்?", "ta"),
+    ("வணக்கம்", "ta"),
+    ("నా ఇటీవలి ఖర్చులను చూపించు", "te"),
+    ("గత నెల కిరాణా సామాన్లకు ఎంత ఖర్చు చేశాను?", "te"),
+    ("నమస్కారం", "te"),
+    ("আমার সাম্প্রতিক খরচ দেখাও", "bn"),
+    ("গত মাসে মুদিখানায় কত খরচ করেছি?", "bn"),
+    ("নমস্কার", "bn"),
+    ("मेरे Swiggy orders कितने के थे?", "hi"),
+    ("माझे Amazon चे खर्च किती आहेत?", "mr"),
+    ("Zomato-வில் எவ்வளவு செலவு?", "ta"),
+]
+
+
+def run_accuracy_test():
+    """Run the labelled set through the detector and report accuracy"""
+    correct = 0
+    for text, expected in ACCURACY_SET:
+        detected, confidence = detect_language_with_confidence(text)
+        ok = detected == expected
+        correct += ok
+        print(f"{'✅' if ok else '❌'} expected={expected} detected={detected} confidence={confidence:.2f}  {text}")
+
+    accuracy = correct / len(ACCURACY_SET)
+    print(f"\nAccuracy: {correct}/{len(ACCURACY_SET)} ({accuracy:.0%})")
+    return accuracy
+
+
+if __name__ == "__main__":
+    print("🧪 TESTING LANGUAGE DETECTION ACCURACY")
+    run_accuracy_test()
@@ -0,0 +1,33 @@
+import requests
+import json
+import time
+
+# API endpoint for translation
+translate_url = "http://127.0.0.1:8080/translate"
+
+# Test data (two sentences so the batched path is exercised)
+test_data = {
+    "text": "Show my recent expenses. How much did I spend on groceries?",
+    "target_language": "hi",
+    "source_language": "en"
+}
+
+# The second request should be served from the translation cache
+for attempt in ["COLD", "CACHED"]:
+    try:
+        start = time.time()
+        response = requests.post(translate_url, data=test_data)
+        elapsed = time.time() - start
+
+        print("Status code:", response.status_code)
+
+        if response.status_code == 200:
+            result = response.json()
+            print(f"\n=== TRANSLATE API RESPONSE ({attempt}, {elapsed * 1000:.0f} ms) ===")
+            print(json.dumps(result, indent=2, ensure_ascii=False))
+        else:
+            print("Error:", response.status_code)
+            print("Response text:", response.text)
+
+    except Exception as e:
+        print(f"Exception occurred: {e}")
@@ -0,0 +1,42 @@
+import requests
+import json
+import sys
+import time
+
+# API endpoints for async upload
+upload_url = "http://127.0.0.1:8080/upload"
+status_url = "http://127.0.0.1:8080/upload/status/{job_id}?user_id={user_id}"
+
+# Receipt image to upload (pass a path as the first argument)
+image_path = sys.argv[1] if len(sys.argv) > 1 else "image.png"
+
+try:
+    with open(image_path, "rb") as f:
+        files = {"file": (image_path.split("/")[-1], f, "image/png")}
+        data = {"user_id": "testuser123", "async_mode": "true"}
+        start = time.time()
+        response = requests.post(upload_url, files=files, data=data)
+
+    print("Status code:", response.status_code, f"({(time.time() - start) * 1000:.0f} ms)")
+
+    if response.status_code == 202:
+        accepted = response.json()
+        print("\n=== UPLOAD ACCEPTED ===")
+        print(json.dumps(accepted, indent=2))
+
+        # Poll the job until it finishes
+        job_id = accepted["jobId"]
+        for _ in range(60):
+            status = requests.get(status_url.format(job_id=job_id, user_id=data["user_id"])).json()
+            print(f"Job {job_id}: {status.get('status')}")
+            if status.get("status") in ("completed", "failed"):
+                print("\n=== UPLOAD JOB RESULT ===")
+                print(json.dumps(status, indent=2))
+                break
+            time.sleep(2)
+    else:
+        print("Error:", response.status_code)
+        print("Response text:", response.text)
+
+except Exception as e:
+    print(f"Exception occurred: {e}")
@@ -0,0 +1,41 @@
+import requests
+import json
+import sys
+import mimetypes
+
+# API endpoint for bulk receipt upload
+upload_bulk_url = "http://127.0.0.1:8080/upload/bulk"
+
+# Receipt images or zip archives to upload (pass paths as arguments)
+paths = sys.argv[1:] or ["image.png"]
+
+try:
+    files = [
+        ("files", (path.split("/")[-1], open(path, "rb"), mimetypes.guess_type(path)[0] or "application/octet-stream"))
+        for path in paths
+    ]
+    data = {"user_id": "testuser123"}
+
+    # Stream the NDJSON response so results print as each file completes
+    with requests.post(upload_bulk_url, files=files, data=data, stream=True) as response:
+        print("Status code:", response.status_code)
+
+        if response.status_code == 200:
+            print("\n=== BULK UPLOAD RESULTS ===")
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                result = json.loads(line)
+                if result.get("summary"):
+                    print("\n=== SUMMARY ===")
+                    print(json.dumps(result, indent=2))
+                else:
+                    status = "error" if result.get("error") else result.get("status")
+                    print(f"[{result['index']}] {result['fileName']}: {status} "
+                          f"receiptId={result.get('receiptId')} timings={result.get('timings', {}).get('total')} ms")
+        else:
+            print("Error:", response.status_code)
+            print("Response text:", response.text)
+
+except Exception as e:
+    print(f"Exception occurred: {e}")
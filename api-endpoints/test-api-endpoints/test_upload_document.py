@@ -0,0 +1,39 @@
+import requests
+import json
+import sys
+import mimetypes
+
+# API endpoint for receipt upload
+upload_url = "http://127.0.0.1:8080/upload"
+
+# A multi-page PDF invoice or a tall e-commerce receipt screenshot
+path = sys.argv[1] if len(sys.argv) > 1 else "invoice.pdf"
+
+try:
+    with open(path, "rb") as f:
+        files = {"file": (path.split("/")[-1], f, mimetypes.guess_type(path)[0] or "application/octet-stream")}
+        data = {"user_id": "testuser123", "allow_duplicate": "true"}
+        response = requests.post(upload_url, files=files, data=data)
+    print("Status code:", response.status_code)
+
+    if response.status_code == 200:
+        result = response.json()
+        if result.get("error"):
+            print("Error:", result["error"])
+        else:
+            parsed = json.loads(result["parsedDoc"]["geminiRawOutput"])
+            print("\n=== DOCUMENT UPLOAD RESULT ===")
+            print("Receipt ID:", result["receiptId"])
+            print("Segments:", json.dumps(parsed.get("segments"), indent=2))
+            print("Vendor:", parsed.get("vendor"))
+            print("Line items:", len(parsed.get("items", [])))
+            for item in parsed.get("items", []):
+                print(f"  - {item.get('name')}: {item.get('total_price')}")
+            print("Total:", parsed.get("total"), "| Sum of items:", parsed.get("itemsTotal"))
+            print("Timings (ms):", json.dumps(result.get("timings"), indent=2))
+    else:
+        print("Error:", response.status_code)
+        print("Response text:", response.text)
+
+except Exception as e:
+    print(f"Exception occurred: {e}")
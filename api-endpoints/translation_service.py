@@ -0,0 +1,287 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# MyMemory only accepts short queries, so sentences are packed into chunks below this size
+MYMEMORY_MAX_QUERY_CHARS = 450
+
+# Separator used to pack several sentences into one provider request
+BATCH_SEPARATOR = "\n"
+
+# The capturing group keeps separators in split() output, so text can be rebuilt exactly
+SENTENCE_SPLIT_PATTERN = re.compile(r'((?<=[.!?।॥])\s+|\n+)')
+
+
+def join_sentences(pieces: List[str], sentences: List[str]) -> str:
+    """
+    Put sentences back in place of the non-blank pieces of
+    SENTENCE_SPLIT_PATTERN.split(text), keeping the original separators and the
+    whitespace around each sentence, so newlines and markdown lists survive.
+    """
+    replacements = iter(sentences)
+    parts = []
+    for i, piece in enumerate(pieces):
+        core = piece.strip()
+        if i % 2 or not core:
+            parts.append(piece)
+            continue
+        start = piece.index(core)
+        parts.append(piece[:start] + next(replacements) + piece[start + len(core):])
+    return "".join(parts)
+
+
+class TranslationCache:
+    """
+    Two-level (source, target, text-hash) cache: an in-process LRU in front of a
+    SQLite file so translations survive server restarts.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_memory_entries: int = 5000):
+        self.db_path = db_path or os.getenv(
+            "TRANSLATION_CACHE_PATH",
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "translation_cache.sqlite3")
+        )
+        self.max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "source_lang TEXT NOT NULL, target_lang TEXT NOT NULL, text_hash TEXT NOT NULL, "
+            "translated_text TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (source_lang, target_lang, text_hash))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(text: str, source_lang: str, target_lang: str) -> Tuple[str, str, str]:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return (source_lang, target_lang, text_hash)
+
+    def get(self, text: str, source_lang: str, target_lang: str) -> Optional[str]:
+        key = self.make_key(text, source_lang, target_lang)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            row = self._conn.execute(
+                "SELECT translated_text FROM translations WHERE source_lang = ? AND target_lang = ? AND text_hash = ?",
+                key
+            ).fetchone()
+            if row is None:
+                return None
+            self._remember(key, row[0])
+            return row[0]
+
+    def set_many(self, entries: List[Tuple[str, str, str, str]]):
+        """Store (text, source_lang, target_lang, translated_text) tuples."""
+        if not entries:
+            return
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, source_lang, target_lang, translated in entries:
+                key = self.make_key(text, source_lang, target_lang)
+                self._remember(key, translated)
+                rows.append((*key, translated, now))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def set(self, text: str, source_lang: str, target_lang: str, translated_text: str):
+        self.set_many([(text, source_lang, target_lang, translated_text)])
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures or slow calls and stays open
+    for `reset_timeout` seconds. While open, callers should skip the provider entirely.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0, slow_call_seconds: float = 2.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_seconds = slow_call_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow_request(self) -> bool:
+        return self.state != "open"
+
+    def record(self, success: bool, elapsed: float):
+        with self._lock:
+            if success and elapsed <= self.slow_call_seconds:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold or self._opened_at is not None:
+                # A failed probe while half-open re-opens the breaker for another full window
+                self._opened_at = time.monotonic()
+
+
+class MyMemoryProvider:
+    """MyMemory Translation API client backed by a pooled HTTP session."""
+
+    name = "mymemory"
+
+    def __init__(self, api_url: str = "https://api.mymemory.translated.net/get", timeout: float = 3.0, pool_size: int = 10):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def translate(self, text: str, source_lang: str, target_lang: str) -> str:
+        params = {
+            'q': text,
+            'langpair': f"{source_lang}|{target_lang}"
+        }
+        response = self.session.get(self.api_url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if data.get('responseStatus') != 200:
+            raise RuntimeError(f"Translation API error: {data.get('responseDetails', 'Unknown error')}")
+        return data['responseData']['translatedText']
+
+
+class StubTranslationProvider:
+    """
+    Deterministic local provider for tests and benchmarks. Prefixes every line with
+    the target language and can simulate provider latency or outages.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0, fail: bool = False):
+        self.latency = latency
+        self.fail = fail
+        self.calls = 0
+
+    def translate(self, text: str, source_lang: str, target_lang: str) -> str:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError("Stub provider failure")
+        return BATCH_SEPARATOR.join(f"[{target_lang}] {line}" for line in text.split(BATCH_SEPARATOR))
+
+
+class TranslationService:
+    """
+    Sentence-level translation with per-sentence caching. Uncached sentences are
+    packed into as few provider requests as possible, and the circuit breaker
+    returns the original text while the provider is failing or slow.
+    """
+
+    def __init__(self, provider=None, cache: Optional[TranslationCache] = None,
+                 breaker: Optional[CircuitBreaker] = None, max_query_chars: int = MYMEMORY_MAX_QUERY_CHARS):
+        self.provider = provider or MyMemoryProvider()
+        self.cache = cache or TranslationCache()
+        self.breaker = breaker or CircuitBreaker()
+        self.max_query_chars = max_query_chars
+        self.stats = {"requests": 0, "cache_hits": 0, "provider_calls": 0, "fallbacks": 0}
+
+    def translate(self, text: str, target_lang: str, source_lang: str = 'auto') -> str:
+        """
+        Translate text to target language.
+
+        Args:
+            text: Text to translate
+            target_lang: Target language code (e.g., 'en', 'hi', 'ta')
+            source_lang: Source language code (default: 'auto' for auto-detection)
+
+        Returns:
+            Translated text or original text if translation fails
+        """
+        self.stats["requests"] += 1
+        if not text or not text.strip() or target_lang == source_lang:
+            return text
+
+        pieces = SENTENCE_SPLIT_PATTERN.split(text)
+        sentences = [piece.strip() for piece in pieces[::2] if piece.strip()]
+        translated: Dict[int, str] = {}
+        missing: List[int] = []
+        for i, sentence in enumerate(sentences):
+            cached = self.cache.get(sentence, source_lang, target_lang)
+            if cached is not None:
+                translated[i] = cached
+                self.stats["cache_hits"] += 1
+            else:
+                missing.append(i)
+
+        for batch in self._pack(sentences, missing):
+            if not self.breaker.allow_request():
+                self.stats["fallbacks"] += 1
+                break
+            results = self._translate_batch([sentences[i] for i in batch], source_lang, target_lang)
+            if results is None:
+                self.stats["fallbacks"] += 1
+                continue
+            self.cache.set_many([
+                (sentences[i], source_lang, target_lang, result)
+                for i, result in zip(batch, results)
+            ])
+            translated.update(zip(batch, results))
+
+        # Untranslated sentences fall back to the original text
+        return join_sentences(pieces, [translated.get(i, sentence) for i, sentence in enumerate(sentences)])
+
+    def _pack(self, sentences: List[str], indices: List[int]) -> List[List[int]]:
+        batches, current, size = [], [], 0
+        for i in indices:
+            length = len(sentences[i]) + len(BATCH_SEPARATOR)
+            if current and size + length > self.max_query_chars:
+                batches.append(current)
+                current, size = [], 0
+            current.append(i)
+            size += length
+        if current:
+            batches.append(current)
+        return batches
+
+    def _translate_batch(self, sentences: List[str], source_lang: str, target_lang: str) -> Optional[List[str]]:
+        started = time.monotonic()
+        try:
+            self.stats["provider_calls"] += 1
+            result = self.provider.translate(BATCH_SEPARATOR.join(sentences), source_lang, target_lang)
+            parts = [p.strip() for p in result.split(BATCH_SEPARATOR)]
+            if len(parts) != len(sentences):
+                # Provider merged or split lines; translate one sentence at a time instead
+                parts = []
+                for sentence in sentences:
+                    self.stats["provider_calls"] += 1
+                    parts.append(self.provider.translate(sentence, source_lang, target_lang).strip())
+            self.breaker.record(True, time.monotonic() - started)
+            return parts
+        except Exception as e:
+            print(f"Translation error: {e}")
+            self.breaker.record(False, time.monotonic() - started)
+            return None
@@ -0,0 +1,66 @@
+import io
+import os
+import shutil
+import hashlib
+import tempfile
+from typing import BinaryIO, Union
+
+# Uploads larger than this are spooled to a temp file instead of being held in memory
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", str(1024 * 1024)))
+# Copy / hash chunk size
+COPY_CHUNK_SIZE = 1024 * 1024
+# Resumable Storage upload chunk size (must be a multiple of 256 KB)
+STORAGE_CHUNK_SIZE = int(os.getenv("STORAGE_CHUNK_SIZE", str(8 * 1024 * 1024)))
+
+
+class UploadTooLarge(ValueError):
+    """A file (or archive entry) is larger than the limit it is copied under."""
+
+
+def spool_file(source: BinaryIO, threshold: int = None, max_bytes: int = None) -> tempfile.SpooledTemporaryFile:
+    """
+    Copy a file object into a SpooledTemporaryFile in chunks. The copy stays in
+    memory up to `threshold` bytes and rolls over to disk beyond that. Used when
+    the data has to outlive the request (async jobs, bulk uploads). With
+    max_bytes, UploadTooLarge is raised as soon as more than that has been read.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=threshold or UPLOAD_SPOOL_THRESHOLD)
+    if source.seekable():
+        source.seek(0)
+    if max_bytes is None:
+        shutil.copyfileobj(source, spooled, COPY_CHUNK_SIZE)
+    else:
+        copied = 0
+        for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+            copied += len(chunk)
+            if copied > max_bytes:
+                spooled.close()
+                raise UploadTooLarge(f"more than {max_bytes} bytes")
+            spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def as_file(data: Union[bytes, BinaryIO]) -> BinaryIO:
+    """Wrap bytes in a file object so callers can handle bytes and spooled files alike."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return io.BytesIO(data)
+    return data
+
+
+def file_size(f: BinaryIO) -> int:
+    position = f.tell()
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(position)
+    return size
+
+
+def sha256_file(f: BinaryIO) -> str:
+    """SHA-256 of a file object, read in chunks."""
+    digest = hashlib.sha256()
+    f.seek(0)
+    for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()